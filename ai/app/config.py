@@ -1,4 +1,5 @@
 import os
+import json
 from typing import Optional
 
 class Settings:
@@ -7,11 +8,105 @@ class Settings:
     AWS_SECRET_ACCESS_KEY: Optional[str] = os.getenv("AWS_SECRET_ACCESS_KEY")
     AWS_REGION: str = os.getenv("AWS_REGION", "ap-south-1")
     AWS_S3_BUCKET: Optional[str] = os.getenv("AWS_S3_BUCKET")
+    # Custom endpoint for S3-compatible stores or a local moto server, e.g. http://localhost:5000
+    AWS_S3_ENDPOINT_URL: Optional[str] = os.getenv("AWS_S3_ENDPOINT_URL")
+    # Background uploads: concurrent files, multipart threshold/part size, retries with exponential backoff
+    S3_UPLOAD_CONCURRENCY: int = int(os.getenv("S3_UPLOAD_CONCURRENCY", "4"))
+    S3_MULTIPART_THRESHOLD_MB: int = int(os.getenv("S3_MULTIPART_THRESHOLD_MB", "8"))
+    S3_MULTIPART_CHUNK_MB: int = int(os.getenv("S3_MULTIPART_CHUNK_MB", "8"))
+    S3_UPLOAD_MAX_ATTEMPTS: int = int(os.getenv("S3_UPLOAD_MAX_ATTEMPTS", "8"))
+    S3_UPLOAD_BACKOFF_SECONDS: float = float(os.getenv("S3_UPLOAD_BACKOFF_SECONDS", "2"))
+    S3_UPLOAD_POLL_SECONDS: float = float(os.getenv("S3_UPLOAD_POLL_SECONDS", "1"))
+    # An upload still marked uploading this long after it was claimed is presumed abandoned by a crashed process
+    S3_UPLOAD_STALE_SECONDS: float = float(os.getenv("S3_UPLOAD_STALE_SECONDS", "900"))
     
     # Application Settings
     UPLOAD_DIR: str = "uploads/images"
     MAX_FILE_SIZE: int = 10 * 1024 * 1024  # 10MB
     ALLOWED_EXTENSIONS: set = {".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".JPG", ".JPEG", ".PNG" }
+    # Resumable uploads (POST /uploads): partial files, how long an idle upload is kept, and how often
+    # expired ones are collected
+    RESUMABLE_UPLOAD_DIR: str = os.getenv("RESUMABLE_UPLOAD_DIR", "uploads/partial")
+    RESUMABLE_UPLOAD_TTL_SECONDS: int = int(os.getenv("RESUMABLE_UPLOAD_TTL_SECONDS", "86400"))
+    RESUMABLE_UPLOAD_GC_SECONDS: float = float(os.getenv("RESUMABLE_UPLOAD_GC_SECONDS", "600"))
+
+    # Inference Settings
+    INFERENCE_WORKERS: int = int(os.getenv("INFERENCE_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+    INFERENCE_QUEUE_SIZE: int = int(os.getenv("INFERENCE_QUEUE_SIZE", "64"))
+    # POST /analyze-batch: most items per request, and most pending jobs the queue takes from batches
+    BATCH_MAX_ITEMS: int = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+    BATCH_QUEUE_LIMIT: int = int(os.getenv("BATCH_QUEUE_LIMIT", "5000"))
+    # Admission control: concurrent requests per endpoint, how many may wait for a slot (and for how
+    # long), and a per-farmer token bucket. Rejections are 429 (farmer rate) or 503 (overload) with Retry-After
+    ANALYZE_MAX_CONCURRENCY: int = int(os.getenv("ANALYZE_MAX_CONCURRENCY", "32"))
+    ANALYZE_MAX_WAITING: int = int(os.getenv("ANALYZE_MAX_WAITING", "64"))
+    ANALYZE_FARMER_RATE_PER_MINUTE: float = float(os.getenv("ANALYZE_FARMER_RATE_PER_MINUTE", "20"))
+    ANALYZE_FARMER_BURST: int = int(os.getenv("ANALYZE_FARMER_BURST", "10"))
+    CHAT_MAX_CONCURRENCY: int = int(os.getenv("CHAT_MAX_CONCURRENCY", "8"))
+    CHAT_MAX_WAITING: int = int(os.getenv("CHAT_MAX_WAITING", "16"))
+    CHAT_FARMER_RATE_PER_MINUTE: float = float(os.getenv("CHAT_FARMER_RATE_PER_MINUTE", "30"))
+    CHAT_FARMER_BURST: int = int(os.getenv("CHAT_FARMER_BURST", "10"))
+    ADMISSION_WAIT_SECONDS: float = float(os.getenv("ADMISSION_WAIT_SECONDS", "2"))
+    ADMISSION_RETRY_AFTER_SECONDS: float = float(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", "5"))
+    # Durable job queue: leases are renewed every JOB_HEARTBEAT_SECONDS while a job runs; the reaper
+    # requeues expired leases every JOB_REAPER_SECONDS and dead-letters jobs after JOB_MAX_ATTEMPTS claims
+    JOB_LEASE_SECONDS: float = float(os.getenv("JOB_LEASE_SECONDS", "120"))
+    JOB_HEARTBEAT_SECONDS: float = float(os.getenv("JOB_HEARTBEAT_SECONDS", "30"))
+    JOB_REAPER_SECONDS: float = float(os.getenv("JOB_REAPER_SECONDS", "30"))
+    JOB_MAX_ATTEMPTS: int = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+    # A batch still running after this long is treated as hung: its leases stop being renewed and its
+    # workers are killed so the jobs are retried (0 disables)
+    JOB_MAX_RUNTIME_SECONDS: float = float(os.getenv("JOB_MAX_RUNTIME_SECONDS", "900"))
+    # Pending jobs the scheduler looks at per claim (every farmer's oldest jobs first, so one backlog
+    # cannot crowd others out), and wait-time samples kept per priority class
+    SCHEDULER_SCAN_LIMIT: int = int(os.getenv("SCHEDULER_SCAN_LIMIT", "1000"))
+    SCHEDULER_WAIT_SAMPLES: int = int(os.getenv("SCHEDULER_WAIT_SAMPLES", "1000"))
+    JOB_POLL_SECONDS: float = float(os.getenv("JOB_POLL_SECONDS", "1"))
+    # Micro-batching: a batch is sent once it is full or its first job has waited this long
+    FASTSAM_BATCH_SIZE: int = int(os.getenv("FASTSAM_BATCH_SIZE", "4"))
+    FASTSAM_BATCH_WAIT_MS: int = int(os.getenv("FASTSAM_BATCH_WAIT_MS", "50"))
+    # FastSAM inference size and thresholds. Under load the size steps down through
+    # ADAPTIVE_IMGSZ_SIZES so the queue drains within LATENCY_SLO_SECONDS (0 = always FASTSAM_IMGSZ)
+    FASTSAM_IMGSZ: int = int(os.getenv("FASTSAM_IMGSZ", "1024"))
+    FASTSAM_CONF: float = float(os.getenv("FASTSAM_CONF", "0.4"))
+    FASTSAM_IOU: float = float(os.getenv("FASTSAM_IOU", "0.9"))
+    ADAPTIVE_IMGSZ_SIZES: list = [int(s) for s in os.getenv("ADAPTIVE_IMGSZ_SIZES", "512,768,1024").split(",") if s.strip()]
+    LATENCY_SLO_SECONDS: float = float(os.getenv("LATENCY_SLO_SECONDS", "60"))
+    # Image-resolution (retina) masks one job may hold while imgsz is stepped down under load;
+    # caps how many FastSAM returns then (0 = no cap). Full-resolution runs use FastSAM's defaults
+    JOB_MEMORY_BUDGET_MB: int = int(os.getenv("JOB_MEMORY_BUDGET_MB", "1024"))
+    # Images of at least TILED_MIN_PIXELS (0 = never) are segmented as overlapping TILE_SIZE tiles
+    # at native resolution; TILE_WORKERS threads post-process tiles while the next ones run through FastSAM
+    TILED_MIN_PIXELS: int = int(os.getenv("TILED_MIN_PIXELS", "20000000"))
+    TILE_SIZE: int = int(os.getenv("TILE_SIZE", "1024"))
+    TILE_OVERLAP: int = int(os.getenv("TILE_OVERLAP", "128"))
+    TILE_WORKERS: int = int(os.getenv("TILE_WORKERS", "2"))
+    # Segments kept across all tiles, best CLIP match first; 1 selects like an untiled image does
+    TILE_PROMPT_TOP_K: int = int(os.getenv("TILE_PROMPT_TOP_K", "1"))
+    # Completed analyses kept in memory for reuse by identical (image hash, crop, prompt, model) requests
+    ANALYSIS_CACHE_SIZE: int = int(os.getenv("ANALYSIS_CACHE_SIZE", "1024"))
+    # "segment_first" always segments; "classify_first" skips segmentation for confidently healthy leaves
+    ANALYSIS_PIPELINE_ORDER: str = os.getenv("ANALYSIS_PIPELINE_ORDER", "segment_first")
+    HEALTHY_SKIP_CONFIDENCE: float = float(os.getenv("HEALTHY_SKIP_CONFIDENCE", "0.85"))
+    # Idle seconds between keepalive comments on /analyze/{job_id}/events
+    SSE_KEEPALIVE_SECONDS: float = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+    # Inference runtime per model: "torch" (native .pt / .h5), "onnxruntime" or "openvino"
+    FASTSAM_ENGINE: str = os.getenv("FASTSAM_ENGINE", "torch")
+    CLASSIFIER_ENGINE: str = os.getenv("CLASSIFIER_ENGINE", "torch")
+    # Serve the INT8 classifier from quantize_classifier.py, only if its FP32 comparison passed these thresholds
+    CLASSIFIER_INT8: bool = os.getenv("CLASSIFIER_INT8", "false").lower() in ("1", "true", "yes")
+    INT8_MIN_TOP1_AGREEMENT: float = float(os.getenv("INT8_MIN_TOP1_AGREEMENT", "0.98"))
+    INT8_MIN_TOP3_OVERLAP: float = float(os.getenv("INT8_MIN_TOP3_OVERLAP", "0.95"))
+    # Overlays are rendered on first request and cached per (image, size bucket) up to OVERLAY_CACHE_MAX_MB
+    # (least recently served first out, 0 = unbounded); optionally queued for S3 upload
+    OVERLAY_CACHE_DIR: str = os.getenv("OVERLAY_CACHE_DIR", "uploads/overlays")
+    OVERLAY_MAX_SIZE: int = int(os.getenv("OVERLAY_MAX_SIZE", "4096"))
+    OVERLAY_CACHE_MAX_MB: int = int(os.getenv("OVERLAY_CACHE_MAX_MB", "2048"))
+    OVERLAY_UPLOAD_S3: bool = os.getenv("OVERLAY_UPLOAD_S3", "false").lower() in ("1", "true", "yes")
+    # Optional per-crop FastSAM text prompts as JSON, e.g. {"rice": "brown lesions on rice leaf"}
+    CROP_TEXT_PROMPTS: dict = {
+        crop.lower(): prompt for crop, prompt in json.loads(os.getenv("CROP_TEXT_PROMPTS", "{}")).items()
+    }
     
     def __init__(self):
         os.makedirs(self.UPLOAD_DIR, exist_ok=True)
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, String, DateTime, Float, Integer, Text, Boolean
+from sqlalchemy import create_engine, inspect, text, Column, String, DateTime, Float, Integer, Text, Boolean
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
@@ -19,4 +19,25 @@ def get_db():
         db.close()
 
 def generate_id():
-    return str(uuid.uuid4())[:8]
\ No newline at end of file
+    return str(uuid.uuid4())[:8]
+
+def migrate_columns():
+    """
+    Add columns and indexes that exist on the models but not yet in the database.
+    create_all only creates missing tables, so existing SQLite files need this
+    whenever a model gains a nullable column.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                    print(f"Added column {table.name}.{column.name}")
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
@@ -1,14 +1,18 @@
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, Request, Response
+from app.metrics import ANALYSIS_QUEUE_DEPTH, ADMISSION_LIMIT, REQUEST_SECONDS, render_metrics
+from app.config import settings
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
-from app.database import engine, get_db
+from app.database import engine, get_db, migrate_columns
 from app.models import Base
-from app.routers import upload, analyze, images, chat, claims
+from app.routers import upload, resumable_upload, analyze, images, chat, claims
 from app.routers import verify_phone_router
+from app.services.inference_pool import inference_pool
+from app.services.upload_queue import upload_queue
+from app.services.resumable_uploads import partial_upload_collector
+import time
 import uvicorn
 
-Base.metadata.create_all(bind=engine)
-
 app = FastAPI(
     title="KhetLink AI - Crop Disease Analysis API",
     description="Backend API for crop disease analysis using computer vision and AI",
@@ -21,15 +25,60 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Resumable upload clients read these to find where to resume
+    expose_headers=["Location", "Upload-Offset", "Upload-Length", "Tus-Resumable"],
 )
 
+_route_paths = {}
+
+def _route_label(request: Request) -> str:
+    """Route template (e.g. /analyze/{job_id}) so metrics do not get one series per id"""
+    endpoint = request.scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    if endpoint not in _route_paths:
+        _route_paths[endpoint] = next(
+            (route.path for route in app.routes if getattr(route, "endpoint", None) is endpoint), "unmatched"
+        )
+    return _route_paths[endpoint]
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUEST_SECONDS.labels(
+            method=request.method, route=_route_label(request), status=str(status)
+        ).observe(time.perf_counter() - started)
+
 app.include_router(upload.router, tags=["Upload"])
+app.include_router(resumable_upload.router, tags=["Upload"])
 app.include_router(analyze.router, tags=["Analysis"])
 app.include_router(images.router, tags=["Images"])
 app.include_router(chat.router, tags=["Chat"])
 app.include_router(claims.router, tags=["Claims"])
 app.include_router(verify_phone_router.router, tags=["Phone Verification"])
 
+@app.on_event("startup")
+async def startup():
+    Base.metadata.create_all(bind=engine)
+    migrate_columns()
+    ANALYSIS_QUEUE_DEPTH.set_function(lambda: inference_pool.depth)
+    ADMISSION_LIMIT.labels(endpoint="analyze", limit="queue_depth").set(settings.INFERENCE_QUEUE_SIZE)
+    inference_pool.start()
+    upload_queue.start()
+    partial_upload_collector.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    inference_pool.shutdown()
+    upload_queue.shutdown()
+    partial_upload_collector.shutdown()
+
 @app.get("/")
 async def root():
     return {
@@ -37,6 +86,7 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "upload": "/upload-photo",
+            "resumable_upload": "/uploads",
             "analyze": "/analyze",
             "images": "/image/{image_id}",
             "masks": "/mask/{image_id}",
@@ -49,6 +99,24 @@ async def root():
 async def health_check():
     return {"status": "very very healthy", "timestamp": "2025-10-05T07:35:21+05:30"}
 
+@app.get("/ready")
+async def readiness_check(response: Response):
+    """Readiness probe: 503 until the inference workers have loaded their models"""
+    status = inference_pool.status()
+    if not status["ready"]:
+        response.status_code = 503
+    return status
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Prometheus metrics: per-stage and per-route latency histograms, queue depth and
+    wait, admission limits and rejections, model load time and worker memory
+    (the API process's own memory is process_resident_memory_bytes)
+    """
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
 if __name__ == "__main__":
     uvicorn.run(
         "app.main:app",
@@ -0,0 +1,103 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Admission control, see services/admission.py
+ADMISSION_LIMIT = Gauge(
+    "khetlink_admission_limit", "Configured admission limits per endpoint", ["endpoint", "limit"]
+)
+ADMISSION_IN_FLIGHT = Gauge(
+    "khetlink_admission_in_flight", "Requests currently holding a concurrency slot", ["endpoint"]
+)
+ADMISSION_WAITING = Gauge(
+    "khetlink_admission_waiting", "Requests waiting for a concurrency slot", ["endpoint"]
+)
+ADMISSION_REJECTED = Counter(
+    "khetlink_admission_rejected_total", "Requests rejected by admission control", ["endpoint", "reason"]
+)
+
+# Inference queue; the value is read from the database on every scrape (see main.py)
+ANALYSIS_QUEUE_DEPTH = Gauge("khetlink_analysis_queue_depth", "Analyses waiting for an inference worker")
+ANALYSIS_QUEUE_WAIT = Histogram(
+    "khetlink_analysis_queue_wait_seconds",
+    "Time from submission to a worker claiming the analysis, per priority class",
+    ["priority"],
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+)
+
+# Analysis stages and serving
+STAGE_SECONDS = Histogram(
+    "khetlink_stage_seconds",
+    "Duration of each analysis stage; batched stages (fastsam_forward, classification) are timed per batch",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+REQUEST_SECONDS = Histogram(
+    "khetlink_request_seconds",
+    "HTTP request latency per route (time to response headers for streams)",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+MODEL_LOAD_SECONDS = Gauge(
+    "khetlink_model_load_seconds", "Model load time in the most recently started inference worker", ["model"]
+)
+WORKER_RSS_BYTES = Gauge(
+    "khetlink_worker_resident_memory_bytes", "Resident memory of each inference worker process", ["pid"]
+)
+
+
+class StageTimer:
+    """
+    Times analysis stages into STAGE_SECONDS. Inference workers are separate
+    processes, so there timings are buffered and shipped to the API process with
+    the job events (see inference_pool.py) rather than observed locally.
+    """
+
+    def __init__(self):
+        self.buffered = False
+        self._buffer = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def time(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def record(self, stage: str, seconds: float):
+        if self.buffered:
+            with self._lock:
+                self._buffer.append((stage, seconds))
+        else:
+            STAGE_SECONDS.labels(stage=stage).observe(seconds)
+
+    def drain(self) -> List[Tuple[str, float]]:
+        with self._lock:
+            timings, self._buffer = self._buffer, []
+        return timings
+
+    def observe_all(self, timings: List[Tuple[str, float]]):
+        for stage, seconds in timings:
+            STAGE_SECONDS.labels(stage=stage).observe(seconds)
+
+
+stage_timer = StageTimer()
+
+
+def process_rss_bytes() -> Optional[int]:
+    """Current resident memory of this process (Linux), or None"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def render_metrics():
+    return generate_latest(), CONTENT_TYPE_LATEST
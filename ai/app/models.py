@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, DateTime, Float, Integer, Text, Boolean, JSON
+from sqlalchemy import Column, String, DateTime, Float, Integer, Text, Boolean, JSON, LargeBinary
 from app.database import Base
 from datetime import datetime
 
@@ -18,23 +18,88 @@ class Image(Base):
     farmer_id = Column(String, index=True)
     crop = Column(String, nullable=False)
     file_path = Column(String, nullable=False)
+    content_hash = Column(String, index=True, nullable=True)  # sha256 of the uploaded bytes
+    width = Column(Integer, nullable=True)  # as displayed, after the EXIF orientation
+    height = Column(Integer, nullable=True)
     latitude = Column(Float, nullable=True)
     longitude = Column(Float, nullable=True)
     capture_ts = Column(DateTime, nullable=True)
     upload_ts = Column(DateTime, default=datetime.utcnow)
 
+class UploadSession(Base):
+    __tablename__ = "upload_sessions"
+
+    # Resumable upload, see routers/resumable_upload.py. status is uploading, finalizing,
+    # complete, failed (not an allowed image) or expired
+    upload_id = Column(String, primary_key=True, index=True)
+    farmer_id = Column(String, index=True, nullable=False)
+    crop = Column(String, nullable=False)
+    latitude = Column(Float, nullable=True)
+    longitude = Column(Float, nullable=True)
+    capture_ts = Column(DateTime, nullable=True)
+    length = Column(Integer, nullable=False)  # declared size in bytes
+    offset = Column(Integer, default=0)  # bytes received so far
+    partial_path = Column(String, nullable=False)
+    status = Column(String, index=True, default="uploading")
+    image_id = Column(String, nullable=True)  # set once the upload is finalized
+    expires_at = Column(DateTime, index=True, nullable=False)  # pushed back by every chunk
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
 class Analysis(Base):
     __tablename__ = "analyses"
     
     job_id = Column(String, primary_key=True, index=True)
     image_id = Column(String, index=True)
+    farmer_id = Column(String, index=True, nullable=True)
     crop = Column(String, nullable=False)
-    status = Column(String, default="pending")
-    mask_path = Column(String, nullable=True)
+    status = Column(String, index=True, default="pending")
+    priority = Column(String, default="normal")  # claim, normal or bulk, see services/job_queue.py
+    batch_id = Column(String, index=True, nullable=True)  # set for jobs created by POST /analyze-batch
+    mask_path = Column(String, nullable=True)  # PNG masks of analyses stored before mask_rle
+    mask_rle = Column(LargeBinary, nullable=True)  # run-length encoded mask, see services/mask_codec.py
+    inference_imgsz = Column(Integer, nullable=True)  # FastSAM input size used, see services/resolution_policy.py
     infected_area_pct = Column(Float, nullable=True)
     severity = Column(String, nullable=True)
     top_diseases = Column(JSON, nullable=True)
     confidence = Column(Float, nullable=True)
+    text_prompt = Column(String, nullable=True)
+    model_version = Column(String, nullable=True)
+    cached_from = Column(String, nullable=True)  # job_id whose results were reused
+    # Durable queue: see services/job_queue.py. status is pending, processing, done, failed or dead
+    attempts = Column(Integer, default=0)
+    lease_owner = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, index=True, nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True)
+    claimed_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    completed_at = Column(DateTime, nullable=True)
+
+class AnalysisBatch(Base):
+    __tablename__ = "analysis_batches"
+    
+    batch_id = Column(String, primary_key=True, index=True)
+    farmer_id = Column(String, index=True, nullable=True)
+    priority = Column(String, default="normal")
+    total = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class S3Upload(Base):
+    """Outbox of local artifacts waiting to be copied to S3 by the upload queue"""
+    __tablename__ = "s3_uploads"
+    
+    upload_id = Column(String, primary_key=True, index=True)
+    job_id = Column(String, index=True, nullable=True)
+    artifact = Column(String, nullable=False)  # "mask" or "overlay"
+    local_path = Column(String, index=True, nullable=False)
+    s3_key = Column(String, nullable=False)
+    status = Column(String, index=True, default="pending")  # pending, uploading, done, failed
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)  # when the current attempt was claimed
+    last_error = Column(Text, nullable=True)
+    s3_url = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     completed_at = Column(DateTime, nullable=True)
 
@@ -1,91 +1,262 @@
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func
 from sqlalchemy.orm import Session
-from app.database import get_db, generate_id
-from app.models import Image, Analysis
-from app.schemas import AnalyzeRequest, AnalyzeResponse
-from app.services.segmentation import SegmentationService
-from datetime import datetime
-import os
+from app.database import get_db, generate_id, SessionLocal
+from app.models import Image, Analysis, AnalysisBatch
+from app.schemas import (
+    AnalyzeRequest,
+    AnalyzeResponse,
+    AnalyzeBatchRequest,
+    AnalyzeBatchResponse,
+    AnalyzeBatchResult,
+    AnalyzeBatchResultsResponse,
+)
+from app.services.inference_pool import inference_pool, QueueFullError
+from app.services.analysis_cache import analysis_cache
+from app.services.segmentation import text_prompt_for_crop
+from app.services import mask_codec
+from app.services.upload_queue import artifact_location
+from app.services.job_events import job_events, TERMINAL_EVENTS
+from app.services.admission import analyze_admission
 from app.config import settings
+from collections import Counter
+from datetime import datetime
+from typing import Optional
+import asyncio
+import json
 
 router = APIRouter()
-segmentation_service = SegmentationService()
-
-def process_analysis(job_id: str, image_id: str, crop: str, db: Session):
-    try:
-        analysis = db.query(Analysis).filter(Analysis.job_id == job_id).first()
-        if not analysis:
-            return
-        
-        analysis.status = "processing"
-        db.commit()
-        
-        image_record = db.query(Image).filter(Image.image_id == image_id).first()
-        if not image_record:
-            analysis.status = "failed"
-            db.commit()
-            return
-        
-        image_path = image_record.file_path
-        if not os.path.exists(image_path):
-            analysis.status = "failed"
-            db.commit()
-            return
-        
-        mask_path, infected_percentage = segmentation_service.segment_infection(image_path, image_id)
-        
-        diseases, confidence = segmentation_service.classify_disease(image_path, crop)
-        
-        severity = segmentation_service.determine_severity(infected_percentage)
-        
-        analysis.mask_path = mask_path
-        analysis.infected_area_pct = infected_percentage
-        analysis.severity = severity
-        analysis.top_diseases = diseases
-        analysis.confidence = confidence
-        analysis.status = "done"
-        analysis.completed_at = datetime.utcnow()
-        
-        db.commit()
-        
-    except Exception as e:
-        print(f"Error processing analysis {job_id}: {e}")
-        analysis = db.query(Analysis).filter(Analysis.job_id == job_id).first()
-        if analysis:
-            analysis.status = "failed"
-            db.commit()
 
 @router.post("/analyze", response_model=AnalyzeResponse)
 async def analyze_image(
     request: AnalyzeRequest,
-    background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    _slot: None = Depends(analyze_admission.slot)
 ):
     image_record = db.query(Image).filter(Image.image_id == request.image_id).first()
     if not image_record:
         raise HTTPException(status_code=404, detail="Image not found")
     
-    job_id = f"job_{generate_id()}"
+    analysis = _new_analysis(db, image_record, request.crop, request.priority)
+    if analysis.status == "done":
+        db.add(analysis)
+        db.commit()
+        return AnalyzeResponse(
+            job_id=analysis.job_id,
+            status="done"
+        )
     
-    analysis = Analysis(
-        job_id=job_id,
-        image_id=request.image_id,
-        crop=request.crop,
+    # Only work that reaches the inference workers counts against the farmer's rate
+    analyze_admission.check_farmer(image_record.farmer_id)
+    try:
+        inference_pool.check_capacity(request.priority)
+    except QueueFullError:
+        raise analyze_admission.reject_queue_full("Analysis queue is full, please retry shortly")
+    
+    # The committed pending row is the queued job; a restart does not lose it
+    db.add(analysis)
+    db.commit()
+    inference_pool.wake()
+    
+    return AnalyzeResponse(
+        job_id=analysis.job_id,
         status="pending"
     )
+
+@router.post("/analyze-batch", response_model=AnalyzeBatchResponse)
+async def analyze_batch(
+    request: AnalyzeBatchRequest,
+    db: Session = Depends(get_db),
+    _slot: None = Depends(analyze_admission.slot)
+):
+    """
+    Queue many analyses at once: every row is inserted in one transaction and the
+    workers claim them in micro-batches like any other job. Track the batch with
+    GET /analyze-batch/{batch_id} and page through GET /analyze-batch/{batch_id}/results.
+    """
+    if not request.items:
+        raise HTTPException(status_code=422, detail="items must not be empty")
+    if len(request.items) > settings.BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=422, detail=f"At most {settings.BATCH_MAX_ITEMS} items per batch")
     
-    db.add(analysis)
+    image_ids = {item.image_id for item in request.items}
+    images = {image.image_id: image for image in db.query(Image).filter(Image.image_id.in_(image_ids)).all()}
+    missing = sorted(image_ids - images.keys())
+    if missing:
+        raise HTTPException(status_code=404, detail={"message": "Images not found", "image_ids": missing})
+    
+    # Every item costs its image's farmer a token, as if it had been analyzed on its own
+    items_per_farmer = Counter(images[item.image_id].farmer_id or request.farmer_id for item in request.items)
+    analyze_admission.check_farmers(items_per_farmer)
+    if inference_pool.depth + len(request.items) > settings.BATCH_QUEUE_LIMIT:
+        raise analyze_admission.reject_queue_full("Analysis queue cannot take this batch now, please retry later")
+    
+    batch = AnalysisBatch(
+        batch_id=f"batch_{generate_id()}",
+        farmer_id=request.farmer_id,
+        priority=request.priority,
+        total=len(request.items)
+    )
+    created_at = datetime.utcnow()
+    analyses = []
+    for item in request.items:
+        analysis = _new_analysis(db, images[item.image_id], item.crop, request.priority)
+        analysis.batch_id = batch.batch_id
+        analysis.created_at = created_at
+        analyses.append(analysis)
+    
+    db.add(batch)
+    db.add_all(analyses)
     db.commit()
+    inference_pool.wake()
     
-    background_tasks.add_task(process_analysis, job_id, request.image_id, request.crop, db)
+    return _batch_progress(db, batch)
+
+@router.get("/analyze-batch/{batch_id}", response_model=AnalyzeBatchResponse)
+async def get_batch_progress(batch_id: str, db: Session = Depends(get_db)):
+    batch = db.query(AnalysisBatch).filter(AnalysisBatch.batch_id == batch_id).first()
+    if not batch:
+        raise HTTPException(status_code=404, detail="Analysis batch not found")
+    return _batch_progress(db, batch)
+
+@router.get("/analyze-batch/{batch_id}/results", response_model=AnalyzeBatchResultsResponse)
+async def get_batch_results(
+    batch_id: str,
+    http_request: Request,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(50, ge=1, le=200),
+    status: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    batch = db.query(AnalysisBatch).filter(AnalysisBatch.batch_id == batch_id).first()
+    if not batch:
+        raise HTTPException(status_code=404, detail="Analysis batch not found")
     
-    return AnalyzeResponse(
-        job_id=job_id,
+    query = db.query(Analysis).filter(Analysis.batch_id == batch_id)
+    if status:
+        query = query.filter(Analysis.status == status)
+    total = query.count()
+    analyses = query.order_by(Analysis.job_id).offset((page - 1) * page_size).limit(page_size).all()
+    
+    items = [
+        AnalyzeBatchResult(
+            job_id=analysis.job_id,
+            image_id=analysis.image_id,
+            crop=analysis.crop,
+            status=analysis.status,
+            results=_analysis_results(analysis, http_request, db) if analysis.status == "done" else None
+        )
+        for analysis in analyses
+    ]
+    return AnalyzeBatchResultsResponse(
+        batch_id=batch_id,
+        page=page,
+        page_size=page_size,
+        total=total,
+        items=items
+    )
+
+def _new_analysis(db: Session, image_record: Image, crop: str, priority: str) -> Analysis:
+    """A pending analysis, or a done one when identical bytes were already analysed"""
+    text_prompt = text_prompt_for_crop(crop)
+    analysis = Analysis(
+        job_id=f"job_{generate_id()}",
+        image_id=image_record.image_id,
+        farmer_id=image_record.farmer_id,
+        crop=crop,
+        text_prompt=text_prompt,
+        priority=priority,
         status="pending"
     )
+    
+    # Identical bytes already analysed with the same crop, prompt and models: reuse the result
+    cached = analysis_cache.lookup(db, image_record.content_hash, crop, text_prompt)
+    if cached:
+        for field, value in cached.items():
+            if field != "job_id":
+                setattr(analysis, field, value)
+        analysis.cached_from = cached["job_id"]
+        analysis.status = "done"
+        analysis.completed_at = datetime.utcnow()
+    return analysis
+
+def _batch_progress(db: Session, batch: AnalysisBatch) -> AnalyzeBatchResponse:
+    counts = dict(
+        db.query(Analysis.status, func.count())
+        .filter(Analysis.batch_id == batch.batch_id)
+        .group_by(Analysis.status)
+        .all()
+    )
+    completed = sum(counts.get(status, 0) for status in TERMINAL_EVENTS)
+    if completed >= batch.total:
+        status = "done"
+    elif counts.get("pending", 0) == batch.total:
+        status = "pending"
+    else:
+        status = "processing"
+    return AnalyzeBatchResponse(
+        batch_id=batch.batch_id,
+        status=status,
+        total=batch.total,
+        completed=completed,
+        progress=round(completed / batch.total, 4) if batch.total else 1.0,
+        counts=counts,
+        created_at=batch.created_at
+    )
+
+def _analysis_results(analysis: Analysis, http_request: Request, db: Session) -> dict:
+    # Overlays are rendered on demand from the stored mask; healthy early exits have none
+    mask_url = None
+    mask_bbox = None
+    artifacts = {}
+    if analysis.mask_rle:
+        mask_url = str(http_request.url_for("get_overlay", image_id=analysis.image_id))
+        mask_bbox = mask_codec.bbox(analysis.mask_rle)
+        # Encoded masks live on the analysis row; /mask rasterizes them on request
+        artifacts["mask"] = {
+            "url": str(http_request.url_for("get_mask", image_id=analysis.image_id)),
+            "location": "database",
+            "s3_url": None,
+            "upload_status": None,
+        }
+    elif analysis.mask_path:
+        mask_url = str(http_request.url_for("get_overlay", image_id=analysis.image_id))
+        artifacts["mask"] = {
+            "url": str(http_request.url_for("get_mask", image_id=analysis.image_id)),
+            **artifact_location(db, analysis.mask_path),
+        }
+    
+    return {
+        "mask_url": mask_url,
+        "mask_bbox": mask_bbox,
+        "inference_imgsz": analysis.inference_imgsz,
+        "infected_area_pct": analysis.infected_area_pct,
+        "severity": analysis.severity,
+        "top_diseases": analysis.top_diseases,
+        "confidence": analysis.confidence,
+        "artifacts": artifacts
+    }
+
+def _snapshot(job_id: str, http_request: Request) -> Optional[dict]:
+    """Current state of a job as an event; uses its own short-lived session"""
+    db = SessionLocal()
+    try:
+        analysis = db.query(Analysis).filter(Analysis.job_id == job_id).first()
+        if not analysis:
+            return None
+        event = {"job_id": job_id, "event": analysis.status, "status": analysis.status}
+        if analysis.status == "done":
+            event["results"] = _analysis_results(analysis, http_request, db)
+        return event
+    finally:
+        db.close()
+
+def _sse(event: dict) -> str:
+    return f"event: {event['event']}\ndata: {json.dumps(event, default=str)}\n\n"
 
 @router.get("/analyze/{job_id}", response_model=AnalyzeResponse)
-async def get_analysis_result(job_id: str, db: Session = Depends(get_db)):
+async def get_analysis_result(job_id: str, http_request: Request, db: Session = Depends(get_db)):
     analysis = db.query(Analysis).filter(Analysis.job_id == job_id).first()
     if not analysis:
         raise HTTPException(status_code=404, detail="Analysis job not found")
@@ -96,15 +267,54 @@ async def get_analysis_result(job_id: str, db: Session = Depends(get_db)):
     }
     
     if analysis.status == "done":
-        mask_url = f"https://{settings.AWS_S3_BUCKET}.s3.{settings.AWS_REGION}.amazonaws.com/masks/{analysis.image_id}_overlay.png"
-        # mask_url = f"https://testimagesuat.s3.ap-south-1.amazonaws.com/masks/{analysis.image_id}_overlay.png"
-        
-        response_data["results"] = {
-            "mask_url": mask_url,
-            "infected_area_pct": analysis.infected_area_pct,
-            "severity": analysis.severity,
-            "top_diseases": analysis.top_diseases,
-            "confidence": analysis.confidence
-        }
+        response_data["results"] = _analysis_results(analysis, http_request, db)
     
-    return AnalyzeResponse(**response_data)
\ No newline at end of file
+    return AnalyzeResponse(**response_data)
+
+@router.get("/analyze/{job_id}/events")
+async def stream_analysis_events(job_id: str, http_request: Request):
+    """
+    Server-sent events for one job: the current status first, then processing,
+    progress (per stage) and finally done (with results), failed or dead.
+    A job that is retried after a worker crash goes back to pending.
+    Replaces polling GET /analyze/{job_id}.
+    """
+    # Subscribe before reading the status so an event in between is not lost
+    events = job_events.subscribe(job_id)
+    snapshot = _snapshot(job_id, http_request)
+    if snapshot is None:
+        job_events.unsubscribe(job_id, events)
+        raise HTTPException(status_code=404, detail="Analysis job not found")
+    
+    async def stream():
+        try:
+            event = snapshot
+            status = snapshot["status"]
+            yield _sse(event)
+            while event["event"] not in TERMINAL_EVENTS:
+                try:
+                    event = await asyncio.wait_for(events.get(), timeout=settings.SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await http_request.is_disconnected():
+                        return
+                    # Events are best effort and only come from this process's pool; a job run
+                    # by another process, or a dropped event, shows up in the database instead
+                    current = _snapshot(job_id, http_request)
+                    if current is not None and current["status"] != status:
+                        event, status = current, current["status"]
+                        yield _sse(event)
+                    else:
+                        yield ": keepalive\n\n"
+                    continue
+                if event["event"] == "done":
+                    event = _snapshot(job_id, http_request) or event
+                status = event.get("status", status)
+                yield _sse(event)
+        finally:
+            job_events.unsubscribe(job_id, events)
+    
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -1,9 +1,11 @@
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from app.database import get_db, generate_id
 from app.models import ChatQuery, Image, Analysis
 from app.schemas import ChatQueryRequest, ChatQueryResponse
 from app.services.llm_service import LLMService
+from app.services.admission import chat_admission
 from datetime import datetime
 
 router = APIRouter()
@@ -12,8 +14,11 @@ llm_service = LLMService()
 @router.post("/chat-query", response_model=ChatQueryResponse)
 async def chat_query(
     request: ChatQueryRequest,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    _slot: None = Depends(chat_admission.slot)
 ):
+    chat_admission.check_farmer(request.farmer_id)
+    
     image_record = db.query(Image).filter(Image.image_id == request.image_id).first()
     if not image_record:
         raise HTTPException(status_code=404, detail="Image not found")
@@ -40,7 +45,9 @@ async def chat_query(
         top_diseases = [{"label": "Unknown Disease", "score": 0.5}]
     
     try:
-        answer, actions, confidence, extracted_facts = llm_service.generate_response(
+        # Off the event loop, so the concurrency limit bounds LLM calls rather than blocking the server
+        answer, actions, confidence, extracted_facts = await run_in_threadpool(
+            llm_service.generate_response,
             question=request.question,
             language=request.lang,
             infected_area_pct=infected_area_pct,
@@ -1,13 +1,16 @@
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse
 from sqlalchemy.orm import Session
 from app.database import get_db, generate_id
 from app.models import ClaimReport, Image, Analysis
 from app.schemas import DownloadClaimRequest, DownloadClaimResponse
 from app.services.pdf_service import PDFService
+from app.services.overlay_service import overlay_service
 import os
 
 router = APIRouter()
+CLAIM_OVERLAY_SIZE = 1024
 pdf_service = PDFService()
 
 @router.post("/download-claim", response_model=DownloadClaimResponse)
@@ -25,24 +28,35 @@ async def download_claim(
     analysis = db.query(Analysis).filter(
         Analysis.image_id == request.image_id,
         Analysis.status == "done"
-    ).first()
+    ).order_by(Analysis.completed_at.desc(), Analysis.created_at.desc()).first()
     
     if not analysis:
         raise HTTPException(status_code=404, detail="Analysis not found or not completed")
     
     claim_id = f"claim_{generate_id()}"
     
-    mask_path = analysis.mask_path if request.include_mask else None
-    
-    mask_dir = os.path.dirname(analysis.mask_path) if analysis.mask_path else None
+    # The report shows the rendered overlay; older analyses stored the overlay as mask_path
     overlay_path = None
-    if mask_dir:
-        overlay_path = os.path.join(mask_dir, f"{request.image_id}_overlay.png")
-        if not os.path.exists(overlay_path):
-            overlay_path = None
+    mask = analysis.mask_rle
+    if mask is None and analysis.mask_path and os.path.exists(analysis.mask_path):
+        if analysis.mask_path.endswith("_overlay.png"):
+            overlay_path = analysis.mask_path
+        else:
+            mask = analysis.mask_path
+    if mask is not None:
+        try:
+            overlay_path, _ = await run_in_threadpool(
+                overlay_service.render, request.image_id, image_record.file_path, mask, CLAIM_OVERLAY_SIZE
+            )
+        except ValueError as e:
+            print(f"Error rendering overlay: {e}")
+    
+    mask_path = overlay_path if request.include_mask else None
     
     try:
-        pdf_path = pdf_service.generate_claim_report(
+        # Rendering the report is CPU and disk work; keep it off the event loop
+        pdf_path = await run_in_threadpool(
+            pdf_service.generate_claim_report,
             claim_id=claim_id,
             farmer_id=request.farmer_id,
             image_path=image_record.file_path,
@@ -1,12 +1,32 @@
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, RedirectResponse, Response
+from sqlalchemy import or_
 from sqlalchemy.orm import Session
 from app.database import get_db
 from app.models import Image, Analysis
+from app.services import mask_codec
+from app.services.overlay_service import overlay_service
+from app.services.upload_queue import enqueue_upload, upload_queue, artifact_location
+from app.config import settings
+from typing import Optional
 import os
 
 router = APIRouter()
 
+def _latest_masked_analysis(db: Session, image_id: str) -> Optional[Analysis]:
+    """Newest finished analysis of the image that has a mask; healthy early exits have none"""
+    return (
+        db.query(Analysis)
+        .filter(
+            Analysis.image_id == image_id,
+            Analysis.status == "done",
+            or_(Analysis.mask_rle.isnot(None), Analysis.mask_path.isnot(None)),
+        )
+        .order_by(Analysis.completed_at.desc(), Analysis.created_at.desc())
+        .first()
+    )
+
 @router.get("/image/{image_id}")
 async def get_image(image_id: str, db: Session = Depends(get_db)):
     image_record = db.query(Image).filter(Image.image_id == image_id).first()
@@ -24,11 +44,24 @@ async def get_image(image_id: str, db: Session = Depends(get_db)):
 
 @router.get("/mask/{image_id}")
 async def get_mask(image_id: str, db: Session = Depends(get_db)):
-    analysis = db.query(Analysis).filter(Analysis.image_id == image_id, Analysis.status == "done").first()
-    if not analysis or not analysis.mask_path:
+    analysis = _latest_masked_analysis(db, image_id)
+    if not analysis:
         raise HTTPException(status_code=404, detail="Mask not found")
     
+    # Masks are stored run-length encoded and only rasterized when a client asks for one
+    if analysis.mask_rle:
+        png = await run_in_threadpool(mask_codec.to_png, analysis.mask_rle)
+        return Response(
+            content=png,
+            media_type="image/png",
+            headers={"Content-Disposition": f'attachment; filename="{image_id}_mask.png"'}
+        )
+    
     if not os.path.exists(analysis.mask_path):
+        # The local copy may have been cleaned up after its upload finished
+        location = artifact_location(db, analysis.mask_path)
+        if location["s3_url"]:
+            return RedirectResponse(location["s3_url"])
         raise HTTPException(status_code=404, detail="Mask file not found")
     
     return FileResponse(
@@ -38,19 +71,48 @@ async def get_mask(image_id: str, db: Session = Depends(get_db)):
     )
 
 @router.get("/overlay/{image_id}")
-async def get_overlay(image_id: str, db: Session = Depends(get_db)):
-    analysis = db.query(Analysis).filter(Analysis.image_id == image_id, Analysis.status == "done").first()
-    if not analysis or not analysis.mask_path:
+async def get_overlay(
+    image_id: str,
+    # Rounded up to the next cached bucket (see OVERLAY_SIZES)
+    size: Optional[int] = Query(None, ge=16, le=settings.OVERLAY_MAX_SIZE),
+    db: Session = Depends(get_db)
+):
+    analysis = _latest_masked_analysis(db, image_id)
+    if not analysis:
         raise HTTPException(status_code=404, detail="Overlay not found")
     
-    mask_dir = os.path.dirname(analysis.mask_path)
-    overlay_path = os.path.join(mask_dir, f"{image_id}_overlay.png")
+    mask = analysis.mask_rle
+    if mask is None:
+        # Analyses from before lazy rendering stored the overlay itself
+        if analysis.mask_path.startswith("http"):
+            return RedirectResponse(analysis.mask_path)
+        if analysis.mask_path.endswith("_overlay.png"):
+            if not os.path.exists(analysis.mask_path):
+                raise HTTPException(status_code=404, detail="Overlay file not found")
+            return FileResponse(path=analysis.mask_path, media_type="image/png", filename=f"{image_id}_overlay.png")
+        if not os.path.exists(analysis.mask_path):
+            raise HTTPException(status_code=404, detail="Overlay file not found")
+        mask = analysis.mask_path
     
-    if not os.path.exists(overlay_path):
+    image_record = db.query(Image).filter(Image.image_id == image_id).first()
+    if not image_record:
         raise HTTPException(status_code=404, detail="Overlay file not found")
     
+    try:
+        overlay_path, created = await run_in_threadpool(
+            overlay_service.render, image_id, image_record.file_path, mask, size
+        )
+    except ValueError as e:
+        print(f"Error rendering overlay: {e}")
+        raise HTTPException(status_code=404, detail="Overlay file not found")
+    
+    if created and settings.OVERLAY_UPLOAD_S3:
+        if enqueue_upload(db, overlay_path, overlay_service.s3_key(overlay_path), "overlay"):
+            db.commit()
+            upload_queue.wake()
+    
     return FileResponse(
         path=overlay_path,
         media_type="image/png",
         filename=f"{image_id}_overlay.png"
-    )
\ No newline at end of file
+    )
@@ -0,0 +1,241 @@
+from fastapi import APIRouter, Depends, HTTPException, Header, Request
+from fastapi.responses import Response
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+from starlette.requests import ClientDisconnect
+from app.database import get_db, generate_id
+from app.models import UploadSession
+from app.schemas import CreateUploadRequest, UploadSessionResponse
+from app.services.ingest import check_format, create_image, ingest_file, sniff_format
+from app.services.resumable_uploads import TUS_VERSION, get_session, next_expiry, partial_path, remove_partial
+from app.config import settings
+from datetime import datetime
+from typing import Optional
+import aiofiles
+import os
+
+# tus-style resumable uploads for slow or flaky connections: create a session with
+# the total size, PATCH the bytes from the current offset (as many requests as it
+# takes), and HEAD the session after a dropped connection to learn where to resume.
+# The request carrying the last byte finalizes the upload into an Image exactly
+# like /upload-photo; abandoned sessions are collected by PartialUploadCollector.
+
+router = APIRouter()
+
+OFFSET_CONTENT_TYPE = "application/offset+octet-stream"
+
+
+def _session_headers(session: UploadSession) -> dict:
+    return {
+        "Tus-Resumable": TUS_VERSION,
+        "Upload-Offset": str(session.offset),
+        "Upload-Length": str(session.length),
+        "Cache-Control": "no-store",
+    }
+
+
+def _session_response(session: UploadSession, width: Optional[int] = None, height: Optional[int] = None):
+    return UploadSessionResponse(
+        upload_id=session.upload_id,
+        upload_url=f"/uploads/{session.upload_id}",
+        offset=session.offset,
+        length=session.length,
+        status=session.status,
+        expires_at=session.expires_at,
+        image_id=session.image_id,
+        width=width,
+        height=height,
+    )
+
+
+@router.post("/uploads", response_model=UploadSessionResponse, status_code=201)
+async def create_upload(request: CreateUploadRequest, response: Response, db: Session = Depends(get_db)):
+    if request.length <= 0:
+        raise HTTPException(status_code=400, detail="length must be positive")
+    if request.length > settings.MAX_FILE_SIZE:
+        raise HTTPException(
+            status_code=413, detail=f"File exceeds the {settings.MAX_FILE_SIZE // (1024 * 1024)} MB limit"
+        )
+
+    upload_id = f"upl_{generate_id()}"
+    path = partial_path(upload_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Created up front so chunks can be written at their offset
+    async with aiofiles.open(path, "wb"):
+        pass
+
+    session = UploadSession(
+        upload_id=upload_id,
+        farmer_id=request.farmer_id,
+        crop=request.crop,
+        latitude=request.lat,
+        longitude=request.lon,
+        capture_ts=request.capture_ts,
+        length=request.length,
+        offset=0,
+        partial_path=path,
+        status="uploading",
+        expires_at=next_expiry(),
+    )
+    db.add(session)
+    db.commit()
+    db.refresh(session)
+
+    response.headers.update(_session_headers(session))
+    response.headers["Location"] = f"/uploads/{upload_id}"
+    return _session_response(session)
+
+
+@router.head("/uploads/{upload_id}")
+async def upload_offset(upload_id: str, db: Session = Depends(get_db)):
+    session = get_session(db, upload_id)
+    return Response(status_code=200, headers=_session_headers(session))
+
+
+@router.get("/uploads/{upload_id}", response_model=UploadSessionResponse)
+async def get_upload(upload_id: str, response: Response, db: Session = Depends(get_db)):
+    session = get_session(db, upload_id)
+    response.headers.update(_session_headers(session))
+    return _session_response(session)
+
+
+@router.patch("/uploads/{upload_id}", response_model=UploadSessionResponse)
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    response: Response,
+    upload_offset: int = Header(..., alias="Upload-Offset"),
+    content_type: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+):
+    if (content_type or "").split(";")[0].strip() != OFFSET_CONTENT_TYPE:
+        raise HTTPException(status_code=415, detail=f"Content-Type must be {OFFSET_CONTENT_TYPE}")
+
+    session = get_session(db, upload_id)
+    if session.status != "uploading":
+        raise HTTPException(status_code=409, detail=f"Upload is {session.status}", headers=_session_headers(session))
+    if upload_offset != session.offset:
+        # The client's view is stale (e.g. a lost response); it should HEAD and resume from Upload-Offset
+        raise HTTPException(
+            status_code=409,
+            detail=f"Upload-Offset {upload_offset} does not match the server's {session.offset}",
+            headers=_session_headers(session),
+        )
+
+    start, length = session.offset, session.length
+    received = 0
+    head = b""
+    disconnected = False
+    # Chunks are written at their offset rather than appended, so a retried
+    # chunk racing its original only rewrites the same bytes
+    async with aiofiles.open(session.partial_path, "r+b") as f:
+        await f.seek(start)
+        try:
+            async for chunk in request.stream():
+                if not chunk:
+                    continue
+                if start + received + len(chunk) > length:
+                    raise HTTPException(status_code=413, detail="Chunk runs past the declared upload length")
+                # Reject a non-image on its first bytes instead of after the whole upload
+                if start == 0 and len(head) < 12:
+                    head += chunk[: 12 - len(head)]
+                    if len(head) >= 12:
+                        _check_first_bytes(db, session, head)
+                await f.write(chunk)
+                received += len(chunk)
+        except ClientDisconnect:
+            # Keep what arrived; the client resumes from the offset it gets from HEAD
+            disconnected = True
+
+    # Conditional update: if a concurrent PATCH from the same offset won, this one is stale
+    result = db.execute(
+        update(UploadSession)
+        .where(UploadSession.upload_id == upload_id, UploadSession.offset == start)
+        .values(offset=start + received, expires_at=next_expiry(), updated_at=datetime.utcnow())
+    )
+    db.commit()
+    if result.rowcount != 1:
+        db.refresh(session)
+        raise HTTPException(
+            status_code=409, detail="Upload moved on concurrently", headers=_session_headers(session)
+        )
+    db.refresh(session)
+
+    width = height = None
+    if session.offset == session.length and not disconnected:
+        image = await _finalize(db, session)
+        width, height = image.width, image.height
+
+    response.headers.update(_session_headers(session))
+    return _session_response(session, width, height)
+
+
+def _check_first_bytes(db: Session, session: UploadSession, head: bytes):
+    try:
+        check_format(sniff_format(head))
+    except HTTPException:
+        remove_partial(session.partial_path)
+        _set_status(db, session, "failed")
+        raise
+
+
+async def _finalize(db: Session, session: UploadSession):
+    """Turn the completed upload into an Image, through the same checks as /upload-photo"""
+    # Only one request finalizes, even if the last chunk is retried concurrently
+    claimed = db.execute(
+        update(UploadSession)
+        .where(UploadSession.upload_id == session.upload_id, UploadSession.status == "uploading")
+        .values(status="finalizing", updated_at=datetime.utcnow())
+    )
+    db.commit()
+    if claimed.rowcount != 1:
+        raise HTTPException(status_code=409, detail="Upload is already being finalized")
+
+    image_id = f"img_{generate_id()}"
+    partial = session.partial_path
+    ingested = None
+    try:
+        ingested = await ingest_file(partial, image_id)
+        image = create_image(
+            db, image_id, session.farmer_id, session.crop, ingested,
+            session.latitude, session.longitude, session.capture_ts,
+        )
+    except HTTPException:
+        remove_partial(partial)
+        _set_status(db, session, "failed")
+        raise
+    except Exception:
+        db.rollback()
+        # ingest_file moves the file on success; put it back so a retry finds it
+        try:
+            if ingested is not None:
+                os.replace(ingested["file_path"], partial)
+            retryable = os.path.exists(partial)
+        except OSError:
+            retryable = False
+        _set_status(db, session, "uploading" if retryable else "failed")
+        raise
+
+    session.image_id = image_id
+    _set_status(db, session, "complete")
+    return image
+
+
+def _set_status(db: Session, session: UploadSession, status: str):
+    session.status = status
+    session.updated_at = datetime.utcnow()
+    db.commit()
+    db.refresh(session)
+
+
+@router.delete("/uploads/{upload_id}", status_code=204)
+async def cancel_upload(upload_id: str, db: Session = Depends(get_db)):
+    session = get_session(db, upload_id)
+    if session.status == "complete":
+        raise HTTPException(status_code=409, detail="Upload is already complete")
+    if session.status == "finalizing":
+        raise HTTPException(status_code=409, detail="Upload is being finalized")
+    remove_partial(session.partial_path)
+    db.delete(session)
+    db.commit()
+    return Response(status_code=204, headers={"Tus-Resumable": TUS_VERSION})
@@ -4,10 +4,11 @@ from app.database import get_db, generate_id
 from app.models import Image, Farmer
 from app.schemas import UploadPhotoResponse, UploadRemoteImageRequest
 from app.services.directory_service import DirectoryService
+from app.services.analysis_cache import hash_file
+from app.services.ingest import create_image, ingest_stream, read_image_info, upload_chunks
 from app.config import settings
 from datetime import datetime
 import os
-import shutil
 from typing import Optional, List
 
 router = APIRouter()
@@ -26,16 +27,11 @@ async def upload_photo(
     capture_ts: Optional[str] = Form(None),
     db: Session = Depends(get_db),
 ):
-    if not file.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="File must be an image")
-
     image_id = f"img_{generate_id()}"
 
-    file_extension = os.path.splitext(file.filename)[1]
-    file_path = os.path.join(UPLOAD_DIR, f"{image_id}{file_extension}")
-
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # One pass: non-blocking write, size limit, hash, format sniffing and EXIF.
+    # The format comes from the bytes, not the client's content type or filename
+    ingested = await ingest_stream(upload_chunks(file), image_id, UPLOAD_DIR)
 
     capture_timestamp = None
     if capture_ts:
@@ -46,27 +42,11 @@ async def upload_photo(
         except:
             capture_timestamp = None
 
-    farmer = db.query(Farmer).filter(Farmer.farmer_id == farmer_id).first()
-    if not farmer:
-        farmer = Farmer(farmer_id=farmer_id)
-        db.add(farmer)
-
-    db_image = Image(
-        image_id=image_id,
-        farmer_id=farmer_id,
-        crop=crop,
-        file_path=file_path,
-        latitude=lat,
-        longitude=lon,
-        capture_ts=capture_timestamp,
-        upload_ts=datetime.utcnow(),
-    )
-
-    db.add(db_image)
-    db.commit()
-    db.refresh(db_image)
+    db_image = create_image(db, image_id, farmer_id, crop, ingested, lat, lon, capture_timestamp)
 
-    return UploadPhotoResponse(image_id=image_id, upload_ts=db_image.upload_ts)
+    return UploadPhotoResponse(
+        image_id=image_id, upload_ts=db_image.upload_ts, width=db_image.width, height=db_image.height
+    )
 
 
 @router.post("/upload-remote", response_model=UploadPhotoResponse)
@@ -108,6 +88,7 @@ async def upload_remote_image(
 
         # Generate image ID
         image_id = f"img_{generate_id()}"
+        info = read_image_info(local_path) or {}
 
         # Create database entry
         db_image = Image(
@@ -115,9 +96,12 @@ async def upload_remote_image(
             farmer_id=request.farmer_id,
             crop=request.crop,
             file_path=local_path,
-            latitude=request.lat,
-            longitude=request.lon,
-            capture_ts=request.capture_ts,
+            content_hash=hash_file(local_path),
+            width=info.get("width"),
+            height=info.get("height"),
+            latitude=request.lat if request.lat is not None else info.get("latitude"),
+            longitude=request.lon if request.lon is not None else info.get("longitude"),
+            capture_ts=request.capture_ts or info.get("capture_ts"),
             upload_ts=datetime.utcnow(),
         )
 
@@ -125,7 +109,9 @@ async def upload_remote_image(
         db.commit()
         db.refresh(db_image)
 
-        return UploadPhotoResponse(image_id=image_id, upload_ts=db_image.upload_ts)
+        return UploadPhotoResponse(
+            image_id=image_id, upload_ts=db_image.upload_ts, width=db_image.width, height=db_image.height
+        )
 
     except HTTPException:
         raise
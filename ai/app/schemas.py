@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Literal
 from datetime import datetime
 
 
@@ -23,11 +23,73 @@ class UploadRemoteImageRequest(BaseModel):
 class UploadPhotoResponse(BaseModel):
     image_id: str
     upload_ts: datetime
+    width: Optional[int] = None
+    height: Optional[int] = None
+
+
+class CreateUploadRequest(BaseModel):
+    farmer_id: str
+    crop: str
+    length: int  # total size of the image in bytes
+    lat: Optional[float] = None
+    lon: Optional[float] = None
+    capture_ts: Optional[datetime] = None
+
+
+class UploadSessionResponse(BaseModel):
+    upload_id: str
+    upload_url: str
+    offset: int
+    length: int
+    status: str
+    expires_at: datetime
+    image_id: Optional[str] = None  # set once the last chunk is in
+    width: Optional[int] = None
+    height: Optional[int] = None
 
 
 class AnalyzeRequest(BaseModel):
     image_id: str
     crop: str
+    # claim (insurance deadlines) runs before normal, normal before bulk backfills
+    priority: Literal["claim", "normal", "bulk"] = "normal"
+
+
+class AnalyzeBatchItem(BaseModel):
+    image_id: str
+    crop: str
+
+
+class AnalyzeBatchRequest(BaseModel):
+    items: List[AnalyzeBatchItem]
+    farmer_id: Optional[str] = None  # submitter, e.g. a cooperative or insurer
+    priority: Literal["claim", "normal", "bulk"] = "normal"
+
+
+class AnalyzeBatchResponse(BaseModel):
+    batch_id: str
+    status: str  # pending, processing or done (every job finished, failed or dead)
+    total: int
+    completed: int
+    progress: float
+    counts: Dict[str, int]
+    created_at: datetime
+
+
+class AnalyzeBatchResult(BaseModel):
+    job_id: str
+    image_id: str
+    crop: str
+    status: str
+    results: Optional[Dict[str, Any]] = None
+
+
+class AnalyzeBatchResultsResponse(BaseModel):
+    batch_id: str
+    page: int
+    page_size: int
+    total: int
+    items: List[AnalyzeBatchResult]
 
 
 class DiseaseResult(BaseModel):
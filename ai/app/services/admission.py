@@ -0,0 +1,174 @@
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+
+from app.config import settings
+from app.metrics import ADMISSION_IN_FLIGHT, ADMISSION_LIMIT, ADMISSION_REJECTED, ADMISSION_WAITING
+
+
+def too_many_requests(detail: str, retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=429, detail=detail, headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+
+def overloaded(detail: str, retry_after: float = None) -> HTTPException:
+    retry_after = settings.ADMISSION_RETRY_AFTER_SECONDS if retry_after is None else retry_after
+    return HTTPException(
+        status_code=503, detail=detail, headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+
+class TokenBucket:
+    """
+    Per-key token buckets: each key earns rate_per_minute tokens, holds at most
+    burst, and spends one per request (or per item of a batch). A batch larger
+    than burst is admitted from a full bucket and leaves it in debt, so the key
+    still averages rate_per_minute. Idle keys are evicted beyond max_keys.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: int, max_keys: int = 10000):
+        self.rate = rate_per_minute / 60.0
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, tokens: int = 1) -> Optional[float]:
+        """Spend tokens; returns None if allowed, else seconds until they are available"""
+        return self.take_many({key: tokens})
+
+    def take_many(self, costs: Dict[str, int]) -> Optional[float]:
+        """Spend tokens from several keys, all or none; returns None if allowed, else seconds to wait"""
+        if self.rate <= 0:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            balances, wait = {}, None
+            for key, cost in costs.items():
+                tokens, updated = self._buckets.get(key, (float(self.burst), now))
+                balances[key] = tokens = min(float(self.burst), tokens + (now - updated) * self.rate)
+                needed = min(cost, self.burst)
+                if tokens < needed:
+                    wait = max(wait or 0.0, (needed - tokens) / self.rate)
+            for key, tokens in balances.items():
+                self._buckets.pop(key, None)
+                self._buckets[key] = (tokens if wait is not None else tokens - costs[key], now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+class EndpointLimiter:
+    """
+    Concurrency limit for one endpoint with a bounded wait line. Requests beyond
+    max_concurrency wait up to wait_seconds for a slot; once max_waiting are
+    already waiting, or the wait times out, they are rejected with 503.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, max_waiting: int, wait_seconds: float):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_waiting = max(0, max_waiting)
+        self.wait_seconds = wait_seconds
+        self.in_flight = 0
+        self.waiting = 0
+        self._semaphore = None
+        ADMISSION_LIMIT.labels(endpoint=name, limit="concurrency").set(self.max_concurrency)
+        ADMISSION_LIMIT.labels(endpoint=name, limit="waiting").set(self.max_waiting)
+
+    @asynccontextmanager
+    async def slot(self):
+        if self._semaphore is None:
+            # Created lazily so it binds to the server's event loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        if self._semaphore.locked():
+            if self.waiting >= self.max_waiting:
+                ADMISSION_REJECTED.labels(endpoint=self.name, reason="concurrency").inc()
+                raise overloaded(f"Too many concurrent {self.name} requests, please retry shortly")
+            self.waiting += 1
+            ADMISSION_WAITING.labels(endpoint=self.name).set(self.waiting)
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.wait_seconds)
+            except asyncio.TimeoutError:
+                ADMISSION_REJECTED.labels(endpoint=self.name, reason="wait_timeout").inc()
+                raise overloaded(f"Too many concurrent {self.name} requests, please retry shortly")
+            finally:
+                self.waiting -= 1
+                ADMISSION_WAITING.labels(endpoint=self.name).set(self.waiting)
+        else:
+            await self._semaphore.acquire()
+
+        self.in_flight += 1
+        ADMISSION_IN_FLIGHT.labels(endpoint=self.name).set(self.in_flight)
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            ADMISSION_IN_FLIGHT.labels(endpoint=self.name).set(self.in_flight)
+            self._semaphore.release()
+
+
+class AdmissionController:
+    """Admission for one endpoint: per-farmer token bucket, then the concurrency limit"""
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int,
+        max_waiting: int,
+        farmer_rate_per_minute: float,
+        farmer_burst: int,
+        wait_seconds: float = settings.ADMISSION_WAIT_SECONDS,
+    ):
+        self.name = name
+        self.limiter = EndpointLimiter(name, max_concurrency, max_waiting, wait_seconds)
+        self.farmer_buckets = TokenBucket(farmer_rate_per_minute, farmer_burst)
+        ADMISSION_LIMIT.labels(endpoint=name, limit="farmer_rate_per_minute").set(farmer_rate_per_minute)
+        ADMISSION_LIMIT.labels(endpoint=name, limit="farmer_burst").set(farmer_burst)
+
+    async def slot(self):
+        """FastAPI dependency that holds a concurrency slot for the whole request"""
+        async with self.limiter.slot():
+            yield
+
+    def check_farmer(self, farmer_id: Optional[str]):
+        """Raise 429 when this farmer has used up their share"""
+        self.check_farmers({farmer_id: 1})
+
+    def check_farmers(self, items_per_farmer: Dict[Optional[str], int]):
+        """Charge each farmer one token per item, all or none; raise 429 when any is over their share"""
+        costs = {farmer_id: items for farmer_id, items in items_per_farmer.items() if farmer_id and items > 0}
+        if not costs:
+            return
+        retry_after = self.farmer_buckets.take_many(costs)
+        if retry_after is not None:
+            ADMISSION_REJECTED.labels(endpoint=self.name, reason="farmer_rate").inc()
+            raise too_many_requests(f"Too many {self.name} requests for this farmer, please slow down", retry_after)
+
+    def reject_queue_full(self, detail: str, retry_after: float = None) -> HTTPException:
+        ADMISSION_REJECTED.labels(endpoint=self.name, reason="queue_depth").inc()
+        return overloaded(detail, retry_after)
+
+
+analyze_admission = AdmissionController(
+    "analyze",
+    max_concurrency=settings.ANALYZE_MAX_CONCURRENCY,
+    max_waiting=settings.ANALYZE_MAX_WAITING,
+    farmer_rate_per_minute=settings.ANALYZE_FARMER_RATE_PER_MINUTE,
+    farmer_burst=settings.ANALYZE_FARMER_BURST,
+)
+chat_admission = AdmissionController(
+    "chat",
+    max_concurrency=settings.CHAT_MAX_CONCURRENCY,
+    max_waiting=settings.CHAT_MAX_WAITING,
+    farmer_rate_per_minute=settings.CHAT_FARMER_RATE_PER_MINUTE,
+    farmer_burst=settings.CHAT_FARMER_BURST,
+)
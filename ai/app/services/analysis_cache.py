@@ -0,0 +1,119 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.models import Image, Analysis
+from app.services.resolution_policy import resolution_policy
+from app.services.segmentation import model_version
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Result fields copied from a cached analysis onto a new one
+RESULT_FIELDS = (
+    "mask_path",
+    "mask_rle",
+    "inference_imgsz",
+    "infected_area_pct",
+    "severity",
+    "top_diseases",
+    "confidence",
+    "model_version",
+)
+
+
+def hash_file(file_path: str) -> str:
+    """sha256 of a file's bytes, read in chunks"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AnalysisCache:
+    """
+    Content-addressed cache of completed analyses.
+
+    Keyed by (image content hash, crop, text prompt, model version). Hot keys live
+    in a bounded in-memory LRU; misses fall back to looking up a completed
+    analysis of an identical image in the database. When the model files change
+    the version changes, the LRU is dropped and older rows stop matching.
+    """
+
+    def __init__(self, max_size: Optional[int] = None):
+        self.max_size = max_size or settings.ANALYSIS_CACHE_SIZE
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, content_hash: str, crop: str, text_prompt: str, version: str) -> Tuple:
+        return (content_hash, crop.lower(), text_prompt, version)
+
+    def _check_version(self, version: str):
+        if version != self._version:
+            if self._version is not None:
+                print(f"Model version changed {self._version} -> {version}, clearing analysis cache")
+            self._entries.clear()
+            self._version = version
+
+    def lookup(self, db: Session, content_hash: Optional[str], crop: str, text_prompt: str) -> Optional[dict]:
+        """Return the result fields of a reusable analysis (plus its job_id), or None"""
+        if not content_hash:
+            return None
+
+        version = model_version()
+        key = self._key(content_hash, crop, text_prompt, version)
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        source = (
+            db.query(Analysis)
+            .join(Image, Image.image_id == Analysis.image_id)
+            .filter(
+                Image.content_hash == content_hash,
+                # Case-insensitive equality; ilike would treat % and _ in the crop as wildcards
+                func.lower(Analysis.crop) == crop.lower(),
+                Analysis.text_prompt == text_prompt,
+                Analysis.model_version == version,
+                Analysis.status == "done",
+                # Results degraded under load are not worth reusing
+                or_(
+                    Analysis.inference_imgsz.is_(None),
+                    Analysis.inference_imgsz.notin_(resolution_policy.degraded_sizes),
+                ),
+            )
+            .order_by(Analysis.completed_at.desc())
+            .first()
+        )
+        if source is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        entry = {field: getattr(source, field) for field in RESULT_FIELDS}
+        entry["job_id"] = source.cached_from or source.job_id
+        with self._lock:
+            self.hits += 1
+            self._store(key, entry)
+        return entry
+
+    def _store(self, key: Tuple, entry: dict):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+analysis_cache = AnalysisCache()
@@ -0,0 +1,15 @@
+import cv2
+import numpy as np
+
+
+def load_image(image_path: str) -> np.ndarray:
+    """
+    Decode an image once into a BGR uint8 array for every analysis stage.
+
+    cv2.IMREAD_COLOR applies the EXIF orientation tag, so phone photos come out
+    upright, the same way ultralytics would have read them from the path.
+    """
+    image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Could not load image: {image_path}")
+    return image
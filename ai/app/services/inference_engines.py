@@ -0,0 +1,339 @@
+import hashlib
+import json
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+# Classifier / FastSAM artifacts. The native files are what the service always
+# shipped with; the others are produced by export_models.py.
+KERAS_CLASSIFIER = "plant_disease_model.h5"
+TORCH_CLASSIFIER = "plant_disease_model.pt"
+ONNX_CLASSIFIER = "plant_disease_model.onnx"
+OPENVINO_CLASSIFIER = "plant_disease_model.xml"
+# Written next to exported classifiers: which framework it came from, its layout and input size
+CLASSIFIER_META = "plant_disease_model.meta.json"
+
+# INT8 classifiers built by quantize_classifier.py, and the accuracy report that gates them
+TFLITE_INT8_CLASSIFIER = "plant_disease_model_int8.tflite"
+TORCH_INT8_CLASSIFIER = "plant_disease_model_int8.pt"
+INT8_REPORT = "plant_disease_model_int8.report.json"
+
+FASTSAM_WEIGHTS = "FastSAM-x.pt"
+FASTSAM_ONNX = "FastSAM-x.onnx"
+FASTSAM_OPENVINO = "FastSAM-x_openvino_model"
+
+ENGINES = ("torch", "onnxruntime", "openvino")
+
+
+def _softmax(x: np.ndarray) -> np.ndarray:
+    e = np.exp(x - x.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+def _layout_from_shape(shape) -> str:
+    """NCHW if the second axis looks like channels, otherwise NHWC"""
+    return "NCHW" if len(shape) == 4 and shape[1] in (1, 3) else "NHWC"
+
+
+def _spatial_size(shape, layout: str) -> Optional[Tuple[int, int]]:
+    h, w = (shape[2], shape[3]) if layout == "NCHW" else (shape[1], shape[2])
+    if isinstance(h, int) and isinstance(w, int) and h > 0 and w > 0:
+        return h, w
+    return None
+
+
+class ClassifierEngine:
+    """
+    A loaded disease classifier. predict() takes an NHWC float32 batch scaled to
+    [0, 1] and returns class probabilities of shape (N, num_classes).
+    """
+
+    name = "base"
+    framework = None
+    layout = "NHWC"
+    input_size: Tuple[int, int] = (224, 224)
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def _to_layout(self, batch: np.ndarray) -> np.ndarray:
+        if self.layout == "NCHW":
+            return np.ascontiguousarray(batch.transpose(0, 3, 1, 2))
+        return batch
+
+
+class KerasEngine(ClassifierEngine):
+    name = "torch"  # the native engine setting; Keras models keep running in TensorFlow
+    framework = "tensorflow"
+
+    def __init__(self, path: str):
+        import tensorflow as tf
+
+        self.model = tf.keras.models.load_model(path)
+        # Determine expected input size dynamically, e.g. (None, H, W, C)
+        try:
+            inp_shape = self.model.input_shape
+            if inp_shape and len(inp_shape) == 4 and inp_shape[1] and inp_shape[2]:
+                self.input_size = (int(inp_shape[1]), int(inp_shape[2]))
+        except Exception:
+            pass
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        preds = self.model.predict(batch, batch_size=len(batch), verbose=0)
+        if isinstance(preds, (list, tuple)):
+            preds = preds[0]
+        return np.asarray(preds)
+
+
+class TorchEngine(ClassifierEngine):
+    name = "torch"
+    framework = "torch"
+    layout = "NCHW"
+
+    def __init__(self, path: str, device: str = "cpu"):
+        import torch
+
+        self.device = device
+        self.model = torch.load(path, map_location=device)
+        self.model.eval()
+        # You may have saved input size on the model; else keep default 224
+        ts = getattr(self.model, "input_size", None)
+        if isinstance(ts, (tuple, list)) and len(ts) == 2:
+            self.input_size = (int(ts[0]), int(ts[1]))
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        import torch
+
+        tensor = torch.from_numpy(self._to_layout(batch)).to(self.device)
+        with torch.no_grad():
+            out = self.model(tensor)
+            # if model returns logits, apply softmax
+            if isinstance(out, (tuple, list)):
+                out = out[0]
+            return torch.softmax(out, dim=1).cpu().numpy()
+
+
+class _ExportedEngine(ClassifierEngine):
+    """Shared handling of the sidecar metadata written by export_models.py"""
+
+    def _load_meta(self, shape):
+        meta = {}
+        if os.path.exists(CLASSIFIER_META):
+            with open(CLASSIFIER_META) as f:
+                meta = json.load(f)
+        self.layout = meta.get("layout") or _layout_from_shape(shape)
+        self.input_size = tuple(meta.get("input_size") or _spatial_size(shape, self.layout) or self.input_size)
+        # torch classifiers emit logits; Keras ones already end in softmax
+        self.apply_softmax = meta.get("source", "torch") == "torch"
+
+    def _finish(self, out) -> np.ndarray:
+        out = np.asarray(out, dtype=np.float32)
+        return _softmax(out) if self.apply_softmax else out
+
+
+class OnnxEngine(_ExportedEngine):
+    name = "onnxruntime"
+    framework = "onnxruntime"
+
+    def __init__(self, path: str, num_threads: int = 0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self._load_meta(self.session.get_inputs()[0].shape)
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        out = self.session.run(None, {self.input_name: self._to_layout(batch)})[0]
+        return self._finish(out)
+
+
+class OpenVINOEngine(_ExportedEngine):
+    name = "openvino"
+    framework = "openvino"
+
+    def __init__(self, path: str):
+        import openvino as ov
+
+        core = ov.Core()
+        self.compiled = core.compile_model(core.read_model(path), "CPU", {"PERFORMANCE_HINT": "LATENCY"})
+        shape = [d.get_length() if d.is_static else -1 for d in self.compiled.input(0).partial_shape]
+        self._load_meta(shape)
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        out = self.compiled(self._to_layout(batch))[self.compiled.output(0)]
+        return self._finish(out)
+
+
+class TFLiteEngine(ClassifierEngine):
+    name = "int8"
+    framework = "tflite"
+
+    def __init__(self, path: str, num_threads: int = 0):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+
+            Interpreter = tf.lite.Interpreter
+
+        self.interpreter = Interpreter(model_path=path, num_threads=num_threads or None)
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        shape = [int(d) for d in self._input["shape"]]
+        self.input_size = (shape[1], shape[2])
+        self._batch = shape[0]
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        # The converted model has a fixed batch dimension; resize it when the batch changes
+        if len(batch) != self._batch:
+            self.interpreter.resize_tensor_input(self._input["index"], [len(batch), *self.input_size, 3])
+            self.interpreter.allocate_tensors()
+            self._input = self.interpreter.get_input_details()[0]
+            self._output = self.interpreter.get_output_details()[0]
+            self._batch = len(batch)
+
+        data = batch
+        scale, zero_point = self._input["quantization"]
+        if self._input["dtype"] != np.float32 and scale:
+            data = np.clip(np.round(batch / scale + zero_point), *_int_range(self._input["dtype"]))
+        self.interpreter.set_tensor(self._input["index"], data.astype(self._input["dtype"]))
+        self.interpreter.invoke()
+
+        out = self.interpreter.get_tensor(self._output["index"])
+        scale, zero_point = self._output["quantization"]
+        if self._output["dtype"] != np.float32 and scale:
+            out = (out.astype(np.float32) - zero_point) * scale
+        return np.asarray(out, dtype=np.float32)
+
+
+class TorchScriptInt8Engine(TorchEngine):
+    name = "int8"
+    framework = "torch-int8"
+
+    def __init__(self, path: str, input_size: Tuple[int, int]):
+        import torch
+
+        # Quantized kernels are CPU-only
+        self.device = "cpu"
+        self.model = torch.jit.load(path, map_location="cpu")
+        self.model.eval()
+        self.input_size = tuple(input_size)
+
+
+def _int_range(dtype) -> Tuple[int, int]:
+    info = np.iinfo(dtype)
+    return info.min, info.max
+
+
+_sha256_cache = {}
+
+
+def file_sha256(path: str) -> str:
+    """sha256 of a file, memoized on its size and mtime"""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key in _sha256_cache:
+        return _sha256_cache[key]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    _sha256_cache[key] = digest.hexdigest()
+    return _sha256_cache[key]
+
+
+def load_int8_report() -> Optional[dict]:
+    if not os.path.exists(INT8_REPORT):
+        return None
+    with open(INT8_REPORT) as f:
+        return json.load(f)
+
+
+def int8_classifier_path(min_top1_agreement: float, min_top3_overlap: float, verbose: bool = False) -> Optional[str]:
+    """
+    The INT8 classifier, but only if quantize_classifier.py --compare has validated
+    exactly this file against FP32 and it met both accuracy thresholds.
+    """
+    reason = None
+    path = None
+    report = load_int8_report()
+    if report is None:
+        reason = f"no {INT8_REPORT}, run quantize_classifier.py --compare"
+    else:
+        path = report.get("artifact")
+        top1, top3 = report.get("top1_agreement", 0.0), report.get("top3_overlap", 0.0)
+        if not path or not os.path.exists(path):
+            reason = f"{path} is missing"
+        elif file_sha256(path) != report.get("artifact_sha256"):
+            reason = f"{path} changed since it was validated"
+        elif top1 < min_top1_agreement or top3 < min_top3_overlap:
+            reason = (
+                f"top-1 agreement {top1:.3f} (min {min_top1_agreement}), "
+                f"top-3 overlap {top3:.3f} (min {min_top3_overlap})"
+            )
+
+    if reason is not None:
+        if verbose:
+            print(f"INT8 classifier not served: {reason}")
+        return None
+    return path
+
+
+def load_int8_classifier(path: str, num_threads: int = 0) -> ClassifierEngine:
+    if path.endswith(".tflite"):
+        return TFLiteEngine(path, num_threads=num_threads)
+    report = load_int8_report() or {}
+    return TorchScriptInt8Engine(path, input_size=report.get("input_size", (224, 224)))
+
+
+def classifier_path(engine: str) -> Optional[str]:
+    """Model file the given engine would load, or None if it is not on disk"""
+    if engine == "onnxruntime":
+        candidates = [ONNX_CLASSIFIER]
+    elif engine == "openvino":
+        # OpenVINO also reads ONNX directly when no IR has been exported
+        candidates = [OPENVINO_CLASSIFIER, ONNX_CLASSIFIER]
+    else:
+        candidates = [KERAS_CLASSIFIER, TORCH_CLASSIFIER]
+    return next((path for path in candidates if os.path.exists(path)), None)
+
+
+def load_classifier_engine(engine: str, device: str = "cpu", num_threads: int = 0) -> Optional[ClassifierEngine]:
+    """Load the classifier with the requested engine, falling back to the native model"""
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown inference engine {engine!r}, expected one of {ENGINES}")
+
+    path = classifier_path(engine)
+    if engine != "torch":
+        if path is None:
+            print(f"No exported classifier for {engine}, run export_models.py; using native model")
+        else:
+            try:
+                if engine == "onnxruntime":
+                    return OnnxEngine(path, num_threads=num_threads)
+                return OpenVINOEngine(path)
+            except Exception as e:
+                print(f"Could not load {path} with {engine}, using native model: {e}")
+        path = classifier_path("torch")
+
+    if path is None:
+        return None
+    if path.endswith(".h5"):
+        return KerasEngine(path)
+    return TorchEngine(path, device=device)
+
+
+def fastsam_path(engine: str) -> str:
+    """Weights ultralytics should load for FastSAM; exported models run through its AutoBackend"""
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown inference engine {engine!r}, expected one of {ENGINES}")
+    exported = {"onnxruntime": FASTSAM_ONNX, "openvino": FASTSAM_OPENVINO}.get(engine)
+    if exported and os.path.exists(exported):
+        return exported
+    return FASTSAM_WEIGHTS
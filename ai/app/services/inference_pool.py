@@ -0,0 +1,577 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from sqlalchemy import update
+
+from app.config import settings
+from app.database import SessionLocal
+from app.models import Image, Analysis
+from app.services.segmentation import DEFAULT_TEXT_PROMPT
+from app.services.image_io import load_image
+from app.services.job_events import job_events
+from app.services.job_queue import JobQueue, retry_or_bury
+from app.services.resolution_policy import resolution_policy
+from app.metrics import MODEL_LOAD_SECONDS, WORKER_RSS_BYTES, process_rss_bytes, stage_timer
+
+
+class QueueFullError(Exception):
+    """Raised when the inference queue cannot accept another job"""
+
+
+# Per-process segmentation service, created once by _init_worker in every
+# worker process so models are loaded once per worker and never in the API process.
+_segmentation_service = None
+# Progress events back to the API process, see InferencePool._forward_events
+_events = None
+
+
+def _init_worker(num_threads: int, events=None):
+    global _segmentation_service, _events
+
+    import torch
+    from app.services.segmentation import SegmentationService
+
+    # Keep workers from oversubscribing the CPU: each gets its own share of cores
+    torch.set_num_threads(num_threads)
+    _events = events
+    # Stage timings go back to the API process with the events
+    stage_timer.buffered = events is not None
+    _segmentation_service = SegmentationService()
+    _segmentation_service.warm_up()
+    print(f"Inference worker {os.getpid()} ready ({num_threads} threads)")
+    # Every worker announces itself; a probe may be answered by whichever worker is free first
+    if events is not None:
+        try:
+            events.put_nowait({"event": "worker_ready", **_worker_status()})
+        except Exception:
+            pass
+
+
+def _worker_status() -> dict:
+    """Status of this worker process; only runs once its initializer has loaded the models"""
+    return {
+        "pid": os.getpid(),
+        "fastsam_loaded": _segmentation_service.fastsam_model is not None,
+        "classifier": (
+            _segmentation_service.classifier_engine.framework
+            if _segmentation_service.classifier_engine is not None
+            else None
+        ),
+        "model_version": _segmentation_service.model_version,
+        "load_times": _segmentation_service.load_times,
+        "rss_bytes": process_rss_bytes(),
+    }
+
+
+def _emit(job_id: str, event: str, **data):
+    """Best effort: progress events never fail a job"""
+    if _events is None:
+        return
+    try:
+        _events.put_nowait({"job_id": job_id, "event": event, **data})
+    except Exception:
+        pass
+
+
+def _complete(db, job_id: str, owner_id: Optional[str], status: str, error: Optional[str] = None, **fields) -> bool:
+    """
+    Final state for a claimed job; drops its lease. Written only while the job is
+    still processing under owner_id's lease: once the lease expired and the job was
+    reaped (then perhaps re-claimed or dead-lettered), this result is dropped.
+    Returns whether it was written.
+    """
+    conditions = [Analysis.job_id == job_id, Analysis.status == "processing"]
+    if owner_id is not None:
+        conditions.append(Analysis.lease_owner == owner_id)
+    values = dict(fields, status=status, lease_owner=None, lease_expires_at=None)
+    if error is not None:
+        values["last_error"] = error
+    with stage_timer.time("db_commit"):
+        result = db.execute(update(Analysis).where(*conditions).values(**values))
+        db.commit()
+    if result.rowcount != 1:
+        print(f"Lease on analysis {job_id} was lost, dropping its {status} result")
+        return False
+    return True
+
+
+def _holds_lease(analysis: Analysis, owner_id: Optional[str]) -> bool:
+    return analysis.status == "processing" and (owner_id is None or analysis.lease_owner == owner_id)
+
+
+def _ship_metrics():
+    """Send this batch's stage timings and the worker's memory to the API process"""
+    if _events is None:
+        return
+    try:
+        _events.put_nowait(
+            {"event": "metrics", "pid": os.getpid(), "timings": stage_timer.drain(), "rss_bytes": process_rss_bytes()}
+        )
+    except Exception:
+        pass
+
+
+def run_analysis_batch(jobs: List[Tuple[str, str, str]], owner_id: Optional[str] = None):
+    """
+    Run segmentation + classification for a batch of (job_id, image_id, crop)
+    claimed by owner_id. Executes inside a worker process; FastSAM and the
+    classifier each see the whole batch in one forward pass.
+    """
+    db = SessionLocal()
+    try:
+        analyses = {}
+        items = []
+        for job_id, image_id, crop in jobs:
+            analysis = db.query(Analysis).filter(Analysis.job_id == job_id).first()
+            if not analysis or not _holds_lease(analysis, owner_id):
+                continue
+
+            image_record = db.query(Image).filter(Image.image_id == image_id).first()
+            if not image_record or not os.path.exists(image_record.file_path):
+                if _complete(db, job_id, owner_id, "failed", "image not found"):
+                    _emit(job_id, "failed", status="failed")
+                continue
+
+            # Decode once; segmentation, prompt scoring, overlay and classification share the array
+            try:
+                with stage_timer.time("image_load"):
+                    image = load_image(image_record.file_path)
+            except ValueError as e:
+                print(f"Error processing analysis {job_id}: {e}")
+                if _complete(db, job_id, owner_id, "failed", str(e)):
+                    _emit(job_id, "failed", status="failed")
+                continue
+
+            analyses[job_id] = analysis
+            items.append((job_id, image, image_id, crop))
+        for job_id in analyses:
+            _emit(job_id, "processing", status="processing")
+
+        if not items:
+            return
+
+        def classify():
+            with stage_timer.time("classification"):
+                return _segmentation_service.classify_batch(
+                    [image for _, image, _, _ in items], [crop for _, _, _, crop in items]
+                )
+
+        # classify_first runs the cheap classifier up front and skips segmentation for
+        # confidently healthy leaves; they are recorded with no mask and 0% infection
+        classifications = None
+        to_segment = list(range(len(items)))
+        if settings.ANALYSIS_PIPELINE_ORDER == "classify_first":
+            classifications = classify()
+            for job_id in analyses:
+                _emit(job_id, "progress", stage="classified")
+            to_segment = [
+                i for i, (diseases, confidence) in enumerate(classifications)
+                if not _segmentation_service.is_confidently_healthy(
+                    diseases, confidence, settings.HEALTHY_SKIP_CONFIDENCE
+                )
+            ]
+            if len(to_segment) < len(items):
+                print(f"Skipping segmentation for {len(items) - len(to_segment)} healthy images")
+
+        # Smaller inference size when the queue would otherwise miss the latency SLO
+        imgsz = settings.FASTSAM_IMGSZ
+        if to_segment:
+            imgsz = resolution_policy.choose(db.query(Analysis).filter(Analysis.status == "pending").count())
+            if imgsz < settings.FASTSAM_IMGSZ:
+                print(f"Queue is deep, segmenting {len(to_segment)} images at imgsz {imgsz}")
+
+        # One forward pass per distinct prompt (normally the whole batch shares one)
+        segmentations = [(None, 0.0)] * len(items)
+        sizes = [None] * len(items)
+        prompts = {}
+        for i in to_segment:
+            prompts.setdefault(analyses[items[i][0]].text_prompt or DEFAULT_TEXT_PROMPT, []).append(i)
+        for text_prompt, indices in prompts.items():
+            started = time.perf_counter()
+            results = _segmentation_service.segment_batch(
+                [(items[i][1], items[i][2]) for i in indices], text_prompt, imgsz
+            )
+            at_imgsz = [i for i in indices if not _segmentation_service.use_tiles(items[i][1])]
+            if len(at_imgsz) == len(indices):
+                resolution_policy.observe(imgsz, len(indices), time.perf_counter() - started)
+            for i, result in zip(indices, results):
+                segmentations[i] = result
+                # Tiled images run at native resolution, TILE_SIZE at a time
+                sizes[i] = imgsz if i in at_imgsz else settings.TILE_SIZE
+                _emit(items[i][0], "progress", stage="segmented")
+
+        if classifications is None:
+            classifications = classify()
+            for job_id in analyses:
+                _emit(job_id, "progress", stage="classified")
+
+        for (job_id, _, _, _), (mask_rle, infected_percentage), (diseases, confidence), size in zip(
+            items, segmentations, classifications, sizes
+        ):
+            try:
+                result = dict(
+                    mask_rle=mask_rle,
+                    inference_imgsz=size,
+                    infected_area_pct=infected_percentage,
+                    severity=_segmentation_service.determine_severity(infected_percentage),
+                    top_diseases=diseases,
+                    confidence=confidence,
+                    model_version=_segmentation_service.model_version,
+                    completed_at=datetime.utcnow(),
+                )
+                status, error = "done", None
+            except Exception as e:
+                print(f"Error processing analysis {job_id}: {e}")
+                result, status, error = {}, "failed", str(e)
+            if _complete(db, job_id, owner_id, status, error, **result):
+                _emit(job_id, status, status=status)
+
+    except Exception as e:
+        print(f"Error processing analysis batch {[job[0] for job in jobs]}: {e}")
+        db.rollback()
+        released = []
+        for job_id, _, _ in jobs:
+            analysis = db.query(Analysis).filter(Analysis.job_id == job_id).first()
+            if analysis and _holds_lease(analysis, owner_id):
+                # Transient until proven otherwise: retried, then dead-lettered after JOB_MAX_ATTEMPTS
+                released.append((job_id, retry_or_bury(analysis, str(e))))
+        db.commit()
+        for job_id, status in released:
+            _emit(job_id, status, status=status)
+    finally:
+        db.close()
+        _ship_metrics()
+
+
+def _record_worker_metrics(info: dict):
+    for model, seconds in (info.get("load_times") or {}).items():
+        MODEL_LOAD_SECONDS.labels(model=model).set(seconds)
+    if info.get("rss_bytes"):
+        WORKER_RSS_BYTES.labels(pid=str(info["pid"])).set(info["rss_bytes"])
+
+
+class InferencePool:
+    """
+    Pool of worker processes that run analysis jobs off the API process.
+
+    Jobs are pending rows in the analyses table (see JobQueue). Whenever a worker
+    is free, a dispatcher thread claims up to batch_size of them, waiting at most
+    batch_wait_ms for the batch to fill, and sends them to the process pool as a
+    single batch. A lease keeper thread heartbeats the leases of running jobs and
+    reaps expired ones, so jobs survive restarts and crashes of any pool sharing
+    the database. A batch running past JOB_MAX_RUNTIME_SECONDS is taken for a
+    hung worker: its leases are no longer renewed and the workers are killed, so
+    the batch fails like a crash and its jobs are retried or dead-lettered.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        queue_size: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        batch_wait_ms: Optional[int] = None,
+    ):
+        self.workers = workers or settings.INFERENCE_WORKERS
+        self.queue_size = queue_size or settings.INFERENCE_QUEUE_SIZE
+        self.batch_size = batch_size or settings.FASTSAM_BATCH_SIZE
+        self.batch_wait_ms = settings.FASTSAM_BATCH_WAIT_MS if batch_wait_ms is None else batch_wait_ms
+        self.threads_per_worker = max(1, (os.cpu_count() or 1) // self.workers)
+        self.job_queue = JobQueue()
+
+        self._slots = threading.Semaphore(self.workers)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        # job_id -> time.monotonic() when its batch was sent to a worker
+        self._in_flight = {}
+        # In-flight jobs whose workers were killed for running too long
+        self._hung = set()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._dispatcher = None
+        self._lease_keeper = None
+        self._events = None
+        self._event_forwarder = None
+        # pid -> _worker_status of every worker of the current executor that has loaded its models
+        self._warm_workers = {}
+
+    @property
+    def running(self) -> bool:
+        return self._executor is not None
+
+    @property
+    def ready(self) -> bool:
+        """True once the workers have loaded their models and can take jobs"""
+        with self._lock:
+            return self.running and len(self._warm_workers) >= self.workers
+
+    def status(self) -> dict:
+        with self._lock:
+            workers = dict(self._warm_workers)
+        return {
+            "ready": self.ready,
+            "workers": self.workers,
+            "workers_warm": len(workers),
+            "models": list(workers.values()),
+            "queue_depth": self.depth,
+            "in_flight": len(self._in_flight),
+            "queue_wait_seconds": self.job_queue.wait_percentiles(),
+            "lease_owner": self.job_queue.owner_id,
+        }
+
+    @property
+    def depth(self) -> int:
+        """Number of jobs waiting for a worker"""
+        return self.job_queue.depth()
+
+    def start(self):
+        if self._executor is not None:
+            return
+
+        self._stop.clear()
+        self._events = multiprocessing.get_context("spawn").Queue()
+        self._event_forwarder = threading.Thread(
+            target=self._forward_events, name="inference-events", daemon=True
+        )
+        self._event_forwarder.start()
+        self._executor = self._new_executor()
+        self._spawn_workers()
+        self._dispatcher = threading.Thread(
+            target=self._dispatch, name="inference-dispatcher", daemon=True
+        )
+        self._dispatcher.start()
+        self._lease_keeper = threading.Thread(
+            target=self._keep_leases, name="inference-leases", daemon=True
+        )
+        self._lease_keeper.start()
+        print(
+            f"Inference pool {self.job_queue.owner_id} started with {self.workers} workers, "
+            f"queue size {self.queue_size}, batch size {self.batch_size}, batch wait {self.batch_wait_ms}ms"
+        )
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # spawn rather than fork: torch/tensorflow thread pools do not survive fork
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.threads_per_worker, self._events),
+        )
+
+    def _spawn_workers(self):
+        """
+        Submitting one probe per worker spawns the workers now, so models load in
+        the background while the API is already serving. Readiness counts distinct
+        pids, reported by each worker once warm, since one warm worker can answer
+        several probes.
+        """
+        with self._lock:
+            self._warm_workers = {}
+        for _ in range(self.workers):
+            self._executor.submit(_worker_status).add_done_callback(self._on_probe)
+
+    def _on_probe(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        self._record_worker(future.result())
+
+    def _record_worker(self, info: dict):
+        with self._lock:
+            self._warm_workers[info["pid"]] = info
+        _record_worker_metrics(info)
+
+    def _restart_executor(self):
+        broken, self._executor = self._executor, self._new_executor()
+        # Reaps what is left of the broken pool; its futures have already failed
+        broken.shutdown(wait=False, cancel_futures=True)
+        # The replacement workers are cold until they report in again
+        self._spawn_workers()
+
+    def shutdown(self):
+        if self._executor is None:
+            return
+
+        self._stop.set()
+        self._wake.set()
+        self._dispatcher.join(timeout=5)
+        self._lease_keeper.join(timeout=5)
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        # Batches cancelled before they started go straight back to the queue
+        with self._lock:
+            unfinished = list(self._in_flight)
+        self._publish(self.job_queue.release(unfinished))
+        self._events.put(None)
+        self._event_forwarder.join(timeout=5)
+        self._executor = None
+        self._dispatcher = None
+        self._lease_keeper = None
+        self._events = None
+        self._event_forwarder = None
+        with self._lock:
+            self._warm_workers = {}
+
+    def check_capacity(self, priority: Optional[str] = None):
+        """
+        Raise QueueFullError when queue_size single jobs of this priority or higher
+        are already waiting. Batches are bounded by BATCH_QUEUE_LIMIT instead, so a
+        bulk backlog never turns away single analyses, and claims only wait on claims.
+        """
+        depth = self.job_queue.depth_ahead(priority)
+        if depth >= self.queue_size:
+            raise QueueFullError(f"Inference queue is full ({depth} jobs waiting)")
+
+    def wake(self):
+        """A job was committed as pending; claim it now instead of at the next poll"""
+        self._wake.set()
+
+    def _forward_events(self):
+        """Relay worker progress events to streaming clients in this process"""
+        while True:
+            try:
+                event = self._events.get()
+            except (EOFError, OSError):
+                return
+            if event is None:
+                return
+            if event.get("event") == "worker_ready":
+                event.pop("event")
+                self._record_worker(event)
+                continue
+            if event.get("event") == "metrics":
+                stage_timer.observe_all(event["timings"])
+                if event.get("rss_bytes"):
+                    WORKER_RSS_BYTES.labels(pid=str(event["pid"])).set(event["rss_bytes"])
+                continue
+            job_events.publish(event)
+
+    def _dispatch(self):
+        while not self._stop.is_set():
+            # Wait for a free worker first so jobs keep accumulating into the next batch
+            if not self._slots.acquire(timeout=settings.JOB_POLL_SECONDS):
+                continue
+            batch = self._collect_batch()
+            if not batch:
+                self._slots.release()
+                continue
+
+            job_ids = [job[0] for job in batch]
+            with self._lock:
+                self._in_flight.update(dict.fromkeys(job_ids, time.monotonic()))
+            try:
+                future = self._executor.submit(run_analysis_batch, batch, self.job_queue.owner_id)
+            except BrokenProcessPool:
+                # A worker died (e.g. OOM-killed); replace the pool and retry once
+                print("Inference pool broken, restarting workers")
+                try:
+                    self._restart_executor()
+                    future = self._executor.submit(run_analysis_batch, batch, self.job_queue.owner_id)
+                except Exception as e:
+                    # Release the jobs rather than leave them in flight with live leases
+                    print(f"Failed to dispatch analyses {job_ids} after restarting workers: {e}")
+                    self._finish(job_ids, f"dispatch failed: {e}")
+                    continue
+            except Exception as e:
+                print(f"Failed to dispatch analyses {job_ids}: {e}")
+                self._finish(job_ids, f"dispatch failed: {e}")
+                continue
+            future.add_done_callback(partial(self._on_done, job_ids))
+
+    def _collect_batch(self) -> list:
+        """Claim the oldest pending jobs, then keep claiming until the batch is full or the wait expires"""
+        batch = self.job_queue.claim(self.batch_size)
+        if not batch:
+            self._wake.wait(settings.JOB_POLL_SECONDS)
+            self._wake.clear()
+            return []
+
+        deadline = time.monotonic() + self.batch_wait_ms / 1000.0
+        while len(batch) < self.batch_size and not self._stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._wake.wait(remaining)
+            self._wake.clear()
+            batch += self.job_queue.claim(self.batch_size - len(batch))
+        return batch
+
+    def _on_done(self, job_ids: List[str], future):
+        error = None
+        if future.cancelled():
+            # Shutdown: leave the jobs in flight so shutdown() releases them without an attempt
+            self._slots.release()
+            return
+        if future.exception() is not None:
+            error = f"inference worker failed: {future.exception()}"
+            print(f"Inference worker failed on analyses {job_ids}: {future.exception()}")
+        self._finish(job_ids, error)
+
+    def _finish(self, job_ids: List[str], error: Optional[str]):
+        with self._lock:
+            for job_id in job_ids:
+                self._in_flight.pop(job_id, None)
+            self._hung.difference_update(job_ids)
+        self._slots.release()
+        if error is not None:
+            # Jobs the worker never finished: retried, or dead-lettered after JOB_MAX_ATTEMPTS
+            self._publish(self.job_queue.release(job_ids, error))
+        self._wake.set()
+
+    def _keep_leases(self):
+        next_heartbeat = next_reap = time.monotonic()
+        while not self._stop.is_set():
+            now = time.monotonic()
+            try:
+                if now >= next_heartbeat:
+                    running, hung = self._split_hung(now)
+                    self.job_queue.heartbeat(running)
+                    if hung:
+                        self._kill_hung(hung)
+                    next_heartbeat = now + settings.JOB_HEARTBEAT_SECONDS
+                if now >= next_reap:
+                    reaped = self.job_queue.reap()
+                    self._publish(reaped)
+                    if any(status == "pending" for _, status in reaped):
+                        self._wake.set()
+                    next_reap = now + settings.JOB_REAPER_SECONDS
+            except Exception as e:
+                print(f"Lease keeper failed: {e}")
+            self._stop.wait(max(0.0, min(next_heartbeat, next_reap) - time.monotonic()))
+
+    def _split_hung(self, now: float) -> Tuple[List[str], List[str]]:
+        """In-flight jobs within JOB_MAX_RUNTIME_SECONDS, and newly hung ones"""
+        limit = settings.JOB_MAX_RUNTIME_SECONDS
+        with self._lock:
+            running, hung = [], []
+            for job_id, started in self._in_flight.items():
+                if job_id in self._hung:
+                    continue
+                if limit > 0 and now - started > limit:
+                    hung.append(job_id)
+                else:
+                    running.append(job_id)
+            self._hung.update(hung)
+        return running, hung
+
+    def _kill_hung(self, job_ids: List[str]):
+        """
+        Kill the workers so the hung batch's future fails with BrokenProcessPool and
+        _on_done releases its jobs through retry_or_bury; the dispatcher replaces the
+        pool on its next submit. Other batches on the pool fail and are retried too.
+        """
+        print(f"Analyses {job_ids} exceeded {settings.JOB_MAX_RUNTIME_SECONDS}s, restarting inference workers")
+        # ProcessPoolExecutor has no way to cancel a running call other than killing its process
+        for process in list((getattr(self._executor, "_processes", None) or {}).values()):
+            process.terminate()
+
+    def _publish(self, transitions: List[Tuple[str, str]]):
+        for job_id, status in transitions:
+            job_events.publish({"job_id": job_id, "event": status, "status": status})
+
+
+inference_pool = InferencePool()
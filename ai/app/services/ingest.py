@@ -0,0 +1,264 @@
+import hashlib
+import io
+import os
+from datetime import datetime
+from typing import AsyncIterator, Optional, Union
+
+import aiofiles
+from fastapi import HTTPException, UploadFile
+from PIL import Image as PILImage
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.models import Farmer, Image
+
+CHUNK_SIZE = 1024 * 1024
+# Image headers are parsed from the first bytes of the stream; JPEG EXIF (APP1)
+# is at most 64 KB and precedes the frame header in practically every photo
+HEADER_BYTES = 256 * 1024
+
+# Sniffed format -> extension the file is stored with
+FORMAT_EXTENSIONS = {"jpeg": ".jpg", "png": ".png", "bmp": ".bmp", "tiff": ".tiff", "webp": ".webp"}
+
+EXIF_DATETIME = 0x0132
+EXIF_ORIENTATION = 0x0112
+EXIF_IFD = 0x8769
+EXIF_DATETIME_ORIGINAL = 0x9003
+GPS_IFD = 0x8825
+GPS_LATITUDE_REF, GPS_LATITUDE, GPS_LONGITUDE_REF, GPS_LONGITUDE = 1, 2, 3, 4
+# Orientations that rotate by 90 degrees; load_image applies them, so width and height swap
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def sniff_format(head: bytes) -> Optional[str]:
+    """Image format from its magic bytes, whatever the client claimed"""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith(b"BM"):
+        return "bmp"
+    if head.startswith((b"II*\x00", b"MM\x00*")):
+        return "tiff"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def _allowed_extensions() -> set:
+    return {ext.lower() for ext in settings.ALLOWED_EXTENSIONS}
+
+
+def check_format(fmt: Optional[str]):
+    """415 unless the sniffed format is one of ALLOWED_EXTENSIONS"""
+    if fmt is None or FORMAT_EXTENSIONS[fmt] not in _allowed_extensions():
+        raise HTTPException(
+            status_code=415, detail=f"File must be an image of type {', '.join(sorted(_allowed_extensions()))}"
+        )
+
+
+def _gps_degrees(value, ref) -> Optional[float]:
+    try:
+        degrees, minutes, seconds = (float(v) for v in value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    decimal = degrees + minutes / 60.0 + seconds / 3600.0
+    return -decimal if ref in ("S", "W") else decimal
+
+
+def _exif_datetime(value) -> Optional[datetime]:
+    try:
+        return datetime.strptime(str(value).strip("\x00 "), "%Y:%m:%d %H:%M:%S")
+    except ValueError:
+        return None
+
+
+def _header_exif(img: PILImage.Image) -> PILImage.Exif:
+    """
+    EXIF without decoding pixels. For PNG, getexif() loads the whole image to look
+    for an eXIf chunk after the pixel data, so only a chunk ahead of it is read.
+    """
+    if img.format == "PNG":
+        exif = PILImage.Exif()
+        if img.info.get("exif"):
+            exif.load(img.info["exif"])
+        return exif
+    return img.getexif()
+
+
+def read_image_info(source: Union[str, bytes]) -> Optional[dict]:
+    """
+    Dimensions, GPS position and capture time of an image, from its header only.
+    PIL parses the header lazily and never decodes pixels here. source is a path
+    or the first bytes of the file; returns None when the header is not readable.
+    """
+    try:
+        with PILImage.open(io.BytesIO(source) if isinstance(source, bytes) else source) as img:
+            width, height = img.size
+            exif = _header_exif(img)
+    except Exception:
+        return None
+
+    info = {"width": width, "height": height, "latitude": None, "longitude": None, "capture_ts": None}
+    if not exif:
+        return info
+    if exif.get(EXIF_ORIENTATION) in TRANSPOSED_ORIENTATIONS:
+        info["width"], info["height"] = height, width
+    try:
+        gps = exif.get_ifd(GPS_IFD)
+        if GPS_LATITUDE in gps and GPS_LONGITUDE in gps:
+            info["latitude"] = _gps_degrees(gps[GPS_LATITUDE], gps.get(GPS_LATITUDE_REF))
+            info["longitude"] = _gps_degrees(gps[GPS_LONGITUDE], gps.get(GPS_LONGITUDE_REF))
+        info["capture_ts"] = _exif_datetime(
+            exif.get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL) or exif.get(EXIF_DATETIME) or ""
+        )
+    except Exception as e:
+        print(f"Could not read EXIF: {e}")
+    return info
+
+
+async def upload_chunks(file: UploadFile, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+class _Inspection:
+    """Size limit, sha256, retained header bytes and format sniffing over a stream of chunks"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.digest = hashlib.sha256()
+        self.head = bytearray()
+        self.size = 0
+        self.format = None
+
+    def feed(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise HTTPException(
+                status_code=413, detail=f"File exceeds the {self.max_size // (1024 * 1024)} MB limit"
+            )
+        if len(self.head) < HEADER_BYTES:
+            self.head += chunk[: HEADER_BYTES - len(self.head)]
+            if self.format is None and len(self.head) >= 12:
+                self.format = sniff_format(bytes(self.head))
+                check_format(self.format)
+        self.digest.update(chunk)
+
+    def finish(self) -> str:
+        if self.format is None:
+            self.format = sniff_format(bytes(self.head))
+            check_format(self.format)
+        return self.format
+
+    def read_info(self, path: str) -> dict:
+        """read_image_info of the stream, 415 when it is not readable"""
+        # Headers bigger than what was kept are read from the file, still without decoding pixels
+        info = read_image_info(bytes(self.head)) or read_image_info(path)
+        if info is None:
+            raise HTTPException(status_code=415, detail="File is not a readable image")
+        return info
+
+    def result(self, file_path: str, info: dict) -> dict:
+        return {
+            "file_path": file_path,
+            "content_hash": self.digest.hexdigest(),
+            "size": self.size,
+            "format": self.format,
+            **info,
+        }
+
+
+async def ingest_stream(
+    chunks: AsyncIterator[bytes], image_id: str, upload_dir: str = None, max_size: int = None
+) -> dict:
+    """
+    Store an uploaded image in one pass over its bytes.
+
+    Chunks are written with aiofiles so the event loop keeps serving, the size
+    limit is enforced as they arrive, and the sha256, the sniffed format and
+    the header (dimensions and EXIF) all come from the same pass. Returns
+    file_path, content_hash, size and format plus read_image_info's fields.
+    Raises 413 for oversized uploads and 415 for anything that is not an
+    allowed image; the partial file is removed either way.
+    """
+    upload_dir = upload_dir or settings.UPLOAD_DIR
+    os.makedirs(upload_dir, exist_ok=True)
+    # The extension is only known once the first bytes are in
+    partial_path = os.path.join(upload_dir, f"{image_id}.part")
+    inspection = _Inspection(max_size or settings.MAX_FILE_SIZE)
+    try:
+        async with aiofiles.open(partial_path, "wb") as f:
+            async for chunk in chunks:
+                inspection.feed(chunk)
+                await f.write(chunk)
+        file_path = os.path.join(upload_dir, f"{image_id}{FORMAT_EXTENSIONS[inspection.finish()]}")
+        info = inspection.read_info(partial_path)
+        os.replace(partial_path, file_path)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    return inspection.result(file_path, info)
+
+
+async def ingest_file(path: str, image_id: str, upload_dir: str = None, max_size: int = None) -> dict:
+    """
+    Adopt an image already on disk, e.g. a finished resumable upload, with the
+    same checks as ingest_stream. The file is moved into upload_dir, not copied;
+    on failure it is left where it was.
+    """
+    upload_dir = upload_dir or settings.UPLOAD_DIR
+    os.makedirs(upload_dir, exist_ok=True)
+    inspection = _Inspection(max_size or settings.MAX_FILE_SIZE)
+    async with aiofiles.open(path, "rb") as f:
+        while True:
+            chunk = await f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            inspection.feed(chunk)
+    file_path = os.path.join(upload_dir, f"{image_id}{FORMAT_EXTENSIONS[inspection.finish()]}")
+    info = inspection.read_info(path)
+    os.replace(path, file_path)
+    return inspection.result(file_path, info)
+
+
+def create_image(
+    db: Session,
+    image_id: str,
+    farmer_id: str,
+    crop: str,
+    ingested: dict,
+    lat: Optional[float] = None,
+    lon: Optional[float] = None,
+    capture_ts: Optional[datetime] = None,
+) -> Image:
+    """
+    Record an ingested image, creating its farmer if needed. Caller values win;
+    the photo's own EXIF fills in what the client left out.
+    """
+    farmer = db.query(Farmer).filter(Farmer.farmer_id == farmer_id).first()
+    if not farmer:
+        farmer = Farmer(farmer_id=farmer_id)
+        db.add(farmer)
+
+    image = Image(
+        image_id=image_id,
+        farmer_id=farmer_id,
+        crop=crop,
+        file_path=ingested["file_path"],
+        content_hash=ingested["content_hash"],
+        width=ingested["width"],
+        height=ingested["height"],
+        latitude=lat if lat is not None else ingested["latitude"],
+        longitude=lon if lon is not None else ingested["longitude"],
+        capture_ts=capture_ts or ingested["capture_ts"],
+        upload_ts=datetime.utcnow(),
+    )
+    db.add(image)
+    db.commit()
+    db.refresh(image)
+    return image
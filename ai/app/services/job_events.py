@@ -0,0 +1,54 @@
+import asyncio
+import threading
+from collections import defaultdict
+
+TERMINAL_EVENTS = ("done", "failed", "dead")
+
+
+class JobEvents:
+    """
+    In-process fan-out of analysis progress events to streaming clients.
+
+    Inference workers put events on a multiprocessing queue; the inference pool
+    forwards them here, and each /analyze/{job_id}/events connection receives
+    the events for its job on its own asyncio queue.
+    """
+
+    def __init__(self):
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, job_id: str) -> asyncio.Queue:
+        """Must be called from the event loop that will consume the queue"""
+        events = asyncio.Queue()
+        with self._lock:
+            self._subscribers[job_id].add((asyncio.get_running_loop(), events))
+        return events
+
+    def unsubscribe(self, job_id: str, events: asyncio.Queue):
+        with self._lock:
+            subscribers = self._subscribers.get(job_id)
+            if subscribers is None:
+                return
+            subscribers.difference_update({s for s in subscribers if s[1] is events})
+            if not subscribers:
+                del self._subscribers[job_id]
+
+    def publish(self, event: dict):
+        """Thread-safe; events for jobs nobody is watching are dropped"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(event.get("job_id"), ()))
+        for loop, events in subscribers:
+            try:
+                loop.call_soon_threadsafe(events.put_nowait, event)
+            except RuntimeError:
+                # The subscriber's loop has closed
+                pass
+
+    @property
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return sum(len(s) for s in self._subscribers.values())
+
+
+job_events = JobEvents()
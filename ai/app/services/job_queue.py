@@ -0,0 +1,308 @@
+import math
+import os
+import socket
+import threading
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from itertools import groupby
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, case, func, or_, update
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.database import SessionLocal
+from app.metrics import ANALYSIS_QUEUE_WAIT
+from app.models import Analysis
+
+
+# Highest priority first
+PRIORITY_CLASSES = ("claim", "normal", "bulk")
+PRIORITY_RANK = {name: rank for rank, name in enumerate(PRIORITY_CLASSES)}
+MAX_TRACKED_FARMERS = 100000
+
+
+def _priority_class(priority: Optional[str]) -> str:
+    return priority if priority in PRIORITY_RANK else "normal"
+
+
+def _percentile(sorted_values: list, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def new_owner_id() -> str:
+    """Lease owner for one inference pool: unique per host, process and start"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def retry_or_bury(analysis: Analysis, error: str, max_attempts: int = None) -> str:
+    """
+    Return a job whose run failed to the queue, or dead-letter it once it has
+    used all its attempts. Returns the new status.
+    """
+    max_attempts = max_attempts or settings.JOB_MAX_ATTEMPTS
+    analysis.last_error = error[:2000]
+    analysis.lease_owner = None
+    analysis.lease_expires_at = None
+    analysis.status = "dead" if (analysis.attempts or 0) >= max_attempts else "pending"
+    return analysis.status
+
+
+class JobQueue:
+    """
+    The analyses table used as a durable work queue.
+
+    pending rows are claimed with a conditional UPDATE that sets status,
+    lease_owner and lease_expires_at, so concurrent pools (in other processes or
+    on other hosts sharing the database) never run the same job twice. Owners
+    heartbeat their leases while jobs run; the reaper returns jobs whose lease
+    expired (their owner crashed or hung) to pending, and dead-letters them
+    after JOB_MAX_ATTEMPTS claims.
+    """
+
+    def __init__(
+        self,
+        owner_id: Optional[str] = None,
+        lease_seconds: float = settings.JOB_LEASE_SECONDS,
+        max_attempts: int = settings.JOB_MAX_ATTEMPTS,
+    ):
+        self.owner_id = owner_id or new_owner_id()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Fair share: farmer -> sequence number of their last claim (oldest first)
+        self._served = OrderedDict()
+        self._serve_seq = 0
+        self._waits = {name: deque(maxlen=settings.SCHEDULER_WAIT_SAMPLES) for name in PRIORITY_CLASSES}
+        self._lock = threading.Lock()
+
+    def depth(self, db: Optional[Session] = None) -> int:
+        """Number of jobs waiting to be claimed"""
+        return self._with_session(db, lambda s: s.query(Analysis).filter(Analysis.status == "pending").count())
+
+    def depth_ahead(self, priority: Optional[str], db: Optional[Session] = None) -> int:
+        """
+        Single (non-batch) jobs waiting that would be claimed before or alongside
+        a new job of this priority. Batch jobs have their own limit and are not counted.
+        """
+        rank = PRIORITY_RANK[_priority_class(priority)]
+        ahead = [Analysis.priority.in_(PRIORITY_CLASSES[: rank + 1])]
+        if rank >= PRIORITY_RANK["normal"]:
+            # Rows without a priority are claimed as normal
+            ahead.append(Analysis.priority.is_(None))
+        return self._with_session(
+            db,
+            lambda s: s.query(Analysis)
+            .filter(Analysis.status == "pending", Analysis.batch_id.is_(None), or_(*ahead))
+            .count(),
+        )
+
+    def claim(self, limit: int) -> List[Tuple[str, str, str]]:
+        """
+        Claim up to limit pending jobs; returns (job_id, image_id, crop).
+
+        Higher priority classes go first. Within a class, farmers take turns:
+        each gets one job per round, starting with the farmer served longest ago,
+        so a cooperative's bulk upload cannot push a single photo to the back.
+        """
+        if limit <= 0:
+            return []
+        db = SessionLocal()
+        try:
+            rank = case(PRIORITY_RANK, value=Analysis.priority, else_=PRIORITY_RANK["normal"])
+            # Each farmer's oldest jobs per class, numbered; no farmer can take more than limit of them
+            # in one claim, and ordering by that number before age puts every waiting farmer's first
+            # job inside the scan window however large one cooperative's backlog is
+            pending = (
+                db.query(
+                    Analysis.job_id,
+                    Analysis.image_id,
+                    Analysis.crop,
+                    Analysis.farmer_id,
+                    Analysis.priority,
+                    Analysis.created_at,
+                    rank.label("rank"),
+                    func.row_number()
+                    .over(partition_by=(rank, func.coalesce(Analysis.farmer_id, "")), order_by=Analysis.created_at)
+                    .label("turn"),
+                )
+                .filter(Analysis.status == "pending")
+                .subquery()
+            )
+            candidates = (
+                db.query(
+                    pending.c.job_id,
+                    pending.c.image_id,
+                    pending.c.crop,
+                    pending.c.farmer_id,
+                    pending.c.priority,
+                    pending.c.created_at,
+                )
+                .filter(pending.c.turn <= limit)
+                .order_by(pending.c.rank, pending.c.turn, pending.c.created_at)
+                .limit(settings.SCHEDULER_SCAN_LIMIT)
+                .all()
+            )
+            now = datetime.utcnow()
+            claimed = []
+            for job_id, image_id, crop, farmer_id, priority, created_at in self._fair_order(candidates):
+                if len(claimed) >= limit:
+                    break
+                result = db.execute(
+                    update(Analysis)
+                    .where(Analysis.job_id == job_id, Analysis.status == "pending")
+                    .values(
+                        status="processing",
+                        lease_owner=self.owner_id,
+                        lease_expires_at=now + timedelta(seconds=self.lease_seconds),
+                        heartbeat_at=now,
+                        claimed_at=now,
+                        attempts=func.coalesce(Analysis.attempts, 0) + 1,
+                    )
+                )
+                if result.rowcount == 1:
+                    claimed.append((job_id, image_id, crop))
+                    self._record_claim(farmer_id, priority, (now - created_at).total_seconds() if created_at else 0.0)
+            db.commit()
+            return claimed
+        finally:
+            db.close()
+
+    def wait_percentiles(self) -> Dict[str, dict]:
+        """Queue wait (created to claimed) per priority class over the recent claims"""
+        with self._lock:
+            samples = {name: sorted(waits) for name, waits in self._waits.items() if waits}
+        return {
+            name: {
+                "count": len(waits),
+                "p50": _percentile(waits, 50),
+                "p90": _percentile(waits, 90),
+                "p99": _percentile(waits, 99),
+                "max": waits[-1],
+            }
+            for name, waits in samples.items()
+        }
+
+    def _fair_order(self, candidates: list):
+        """Candidates are sorted by class first; yield them class by class, round-robin across farmers"""
+        for _, jobs in groupby(candidates, key=lambda job: _priority_class(job[4])):
+            per_farmer = OrderedDict()
+            for job in jobs:
+                per_farmer.setdefault(job[3] or "", deque()).append(job)
+            with self._lock:
+                turns = deque(sorted(per_farmer, key=lambda farmer: self._served.get(farmer, 0)))
+            while turns:
+                farmer = turns.popleft()
+                yield per_farmer[farmer].popleft()
+                if per_farmer[farmer]:
+                    turns.append(farmer)
+
+    def _record_claim(self, farmer_id: Optional[str], priority: Optional[str], wait_seconds: float):
+        priority = _priority_class(priority)
+        with self._lock:
+            self._serve_seq += 1
+            self._served.pop(farmer_id or "", None)
+            self._served[farmer_id or ""] = self._serve_seq
+            while len(self._served) > MAX_TRACKED_FARMERS:
+                self._served.popitem(last=False)
+            self._waits[priority].append(wait_seconds)
+        ANALYSIS_QUEUE_WAIT.labels(priority=priority).observe(wait_seconds)
+
+    def heartbeat(self, job_ids: List[str]) -> int:
+        """Extend the leases this owner still holds; returns how many were extended"""
+        if not job_ids:
+            return 0
+        db = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            result = db.execute(
+                update(Analysis)
+                .where(
+                    Analysis.job_id.in_(job_ids),
+                    Analysis.lease_owner == self.owner_id,
+                    Analysis.status == "processing",
+                )
+                .values(lease_expires_at=now + timedelta(seconds=self.lease_seconds), heartbeat_at=now)
+            )
+            db.commit()
+            return result.rowcount
+        finally:
+            db.close()
+
+    def release(self, job_ids: List[str], error: Optional[str] = None) -> List[Tuple[str, str]]:
+        """
+        Give back jobs this owner could not finish. With an error the attempt
+        counts; without one (shutdown) it does not. Returns (job_id, new status).
+        """
+        if not job_ids:
+            return []
+        db = SessionLocal()
+        try:
+            released = []
+            analyses = (
+                db.query(Analysis)
+                .filter(
+                    Analysis.job_id.in_(job_ids),
+                    Analysis.lease_owner == self.owner_id,
+                    Analysis.status == "processing",
+                )
+                .all()
+            )
+            for analysis in analyses:
+                if error is None:
+                    analysis.attempts = max(0, (analysis.attempts or 0) - 1)
+                    analysis.lease_owner = None
+                    analysis.lease_expires_at = None
+                    analysis.status = "pending"
+                else:
+                    retry_or_bury(analysis, error, self.max_attempts)
+                released.append((analysis.job_id, analysis.status))
+            db.commit()
+            return released
+        finally:
+            db.close()
+
+    def reap(self) -> List[Tuple[str, str]]:
+        """Requeue or dead-letter jobs whose lease expired; returns (job_id, new status)"""
+        db = SessionLocal()
+        try:
+            expired = and_(
+                Analysis.status == "processing",
+                # Rows stranded before leases existed have none
+                or_(Analysis.lease_expires_at < datetime.utcnow(), Analysis.lease_expires_at.is_(None)),
+            )
+            reaped = []
+            for job_id, attempts, owner in db.query(
+                Analysis.job_id, Analysis.attempts, Analysis.lease_owner
+            ).filter(expired).all():
+                status = "dead" if (attempts or 0) >= self.max_attempts else "pending"
+                # Conditional so a lease renewed in the meantime is left alone
+                result = db.execute(
+                    update(Analysis)
+                    .where(Analysis.job_id == job_id, expired)
+                    .values(
+                        status=status,
+                        lease_owner=None,
+                        lease_expires_at=None,
+                        last_error=f"lease expired (owner {owner})",
+                    )
+                )
+                if result.rowcount == 1:
+                    reaped.append((job_id, status))
+            db.commit()
+            if reaped:
+                print(f"Reaped {len(reaped)} analyses with expired leases")
+            return reaped
+        finally:
+            db.close()
+
+    def _with_session(self, db: Optional[Session], fn):
+        if db is not None:
+            return fn(db)
+        db = SessionLocal()
+        try:
+            return fn(db)
+        finally:
+            db.close()
@@ -0,0 +1,110 @@
+import hashlib
+import struct
+import zlib
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+# Binary masks as run-length counts, COCO style: runs alternate 0s and 1s starting
+# with 0s, over the pixels in column-major order. Stored as a small header
+# (magic, height, width) followed by the zlib-compressed uint32 counts.
+MAGIC = b"RLE1"
+HEADER = struct.Struct("<4sII")
+
+
+def encode(mask: np.ndarray) -> bytes:
+    """Encode a 2-D mask (any dtype, nonzero = set) into the compact format"""
+    mask = np.asarray(mask)
+    if mask.ndim != 2:
+        raise ValueError(f"Expected a 2-D mask, got shape {mask.shape}")
+    h, w = mask.shape
+    flat = (mask != 0).T.ravel()
+    if flat.size:
+        changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+        if flat[0]:
+            counts = np.concatenate(([0], counts))
+    else:
+        counts = np.zeros(0, dtype=np.int64)
+    return HEADER.pack(MAGIC, h, w) + zlib.compress(counts.astype("<u4").tobytes(), 6)
+
+
+def shape(blob: bytes) -> Tuple[int, int]:
+    magic, h, w = HEADER.unpack_from(blob)
+    if magic != MAGIC:
+        raise ValueError("Not an encoded mask")
+    return h, w
+
+
+def counts(blob: bytes) -> np.ndarray:
+    shape(blob)
+    return np.frombuffer(zlib.decompress(blob[HEADER.size :]), dtype="<u4").astype(np.int64)
+
+
+def decode(blob: bytes) -> np.ndarray:
+    """(h, w) uint8 array of 0 and 1"""
+    h, w = shape(blob)
+    runs = counts(blob)
+    values = (np.arange(len(runs)) % 2).astype(np.uint8)
+    return np.ascontiguousarray(np.repeat(values, runs).reshape(w, h).T)
+
+
+def to_png(blob: bytes) -> bytes:
+    """Rasterize to an 8-bit PNG (0 or 255), the format masks used to be stored in"""
+    ok, png = cv2.imencode(".png", decode(blob) * 255)
+    if not ok:
+        raise ValueError("Could not encode mask as PNG")
+    return png.tobytes()
+
+
+def digest(blob: bytes) -> str:
+    return hashlib.sha1(blob).hexdigest()[:12]
+
+
+def _runs(blob: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    """Start offsets and lengths of the runs of set pixels"""
+    runs = counts(blob)
+    ends = np.cumsum(runs)
+    return (ends - runs)[1::2], runs[1::2]
+
+
+def area(blob: bytes) -> int:
+    """Number of set pixels"""
+    return int(counts(blob)[1::2].sum())
+
+
+def bbox(blob: bytes) -> Optional[List[int]]:
+    """[x, y, width, height] of the set pixels, or None for an empty mask"""
+    h, _ = shape(blob)
+    starts, lengths = _runs(blob)
+    keep = lengths > 0
+    starts, lengths = starts[keep], lengths[keep]
+    if not len(starts):
+        return None
+    last = starts + lengths - 1
+    first_col, last_col = starts // h, last // h
+    # A run that wraps into the next column covers every row in between
+    single = first_col == last_col
+    y0 = int(np.where(single, starts % h, 0).min())
+    y1 = int(np.where(single, last % h, h - 1).max())
+    x0, x1 = int(first_col.min()), int(last_col.max())
+    return [x0, y0, x1 - x0 + 1, y1 - y0 + 1]
+
+
+def iou(a: bytes, b: bytes) -> float:
+    """Intersection over union of two masks of the same shape, without decoding them"""
+    if shape(a) != shape(b):
+        raise ValueError(f"Mask shapes differ: {shape(a)} vs {shape(b)}")
+    bounds_a = np.concatenate(([0], np.cumsum(counts(a))))
+    bounds_b = np.concatenate(([0], np.cumsum(counts(b))))
+    # Split the pixels at every run boundary of either mask; each piece is
+    # wholly inside or outside each mask, and odd runs are the set pixels
+    points = np.union1d(bounds_a, bounds_b)
+    starts, lengths = points[:-1], np.diff(points)
+    in_a = (np.searchsorted(bounds_a, starts, side="right") - 1) % 2 == 1
+    in_b = (np.searchsorted(bounds_b, starts, side="right") - 1) % 2 == 1
+    union = int(lengths[in_a | in_b].sum())
+    if union == 0:
+        return 1.0
+    return int(lengths[in_a & in_b].sum()) / union
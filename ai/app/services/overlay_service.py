@@ -0,0 +1,161 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import Optional, Tuple, Union
+
+import cv2
+import numpy as np
+
+from app.config import settings
+from app.metrics import stage_timer
+from app.services import mask_codec
+from app.services.image_io import load_image
+
+OVERLAY_ALPHA = 0.35
+OVERLAY_COLOR = (0, 0, 255)  # BGR red
+# Requested sizes are rounded up to one of these (or OVERLAY_MAX_SIZE), so each image has a few derivatives
+OVERLAY_SIZES = (256, 512, 1024, 2048)
+
+
+class OverlayService:
+    """
+    Renders mask overlays on request instead of inside every analysis job.
+
+    Each (image, size) derivative is rendered once into OVERLAY_CACHE_DIR and
+    reused until its mask changes. Fresh derivatives can also be queued for S3.
+    Masks are either run-length encoded (mask_codec) or, for older analyses, PNG paths.
+    Sizes snap to OVERLAY_SIZES, and once the cache holds more than
+    OVERLAY_CACHE_MAX_MB the least recently served derivatives are deleted.
+    """
+
+    def __init__(self, cache_dir: str = None, max_bytes: Optional[int] = None):
+        self.cache_dir = cache_dir or settings.OVERLAY_CACHE_DIR
+        self.max_bytes = settings.OVERLAY_CACHE_MAX_MB * 1024 * 1024 if max_bytes is None else max_bytes
+        # path -> [lock, renders holding or waiting for it]; entries go once nobody uses them
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def cache_path(self, image_id: str, size: Optional[int] = None, mask: Union[str, bytes, None] = None) -> str:
+        suffix = f"_{size}" if size else ""
+        # An encoded mask has no file to compare mtimes with, so its digest names the derivative
+        if isinstance(mask, bytes):
+            suffix += f"_{mask_codec.digest(mask)}"
+        return os.path.join(self.cache_dir, f"{image_id}_overlay{suffix}.png")
+
+    def bucket(self, size: Optional[int]) -> Optional[int]:
+        """The derivative size served for a requested size: the next OVERLAY_SIZES step up"""
+        if not size:
+            return None
+        for step in OVERLAY_SIZES:
+            if size <= step:
+                return min(step, settings.OVERLAY_MAX_SIZE)
+        return settings.OVERLAY_MAX_SIZE
+
+    def s3_key(self, overlay_path: str) -> str:
+        return f"masks/{os.path.basename(overlay_path)}"
+
+    def render(
+        self, image_id: str, image_path: str, mask: Union[str, bytes], size: Optional[int] = None
+    ) -> Tuple[str, bool]:
+        """
+        Path of the overlay for image_id, scaled so its longest side is at most
+        size rounded up to its bucket. mask is an encoded mask or the path of a PNG mask.
+        Returns (path, created); created is False when the cached derivative was reused.
+        """
+        size = self.bucket(size)
+        path = self.cache_path(image_id, size, mask)
+        if self._is_fresh(path, mask):
+            self._touch(path)
+            return path, False
+
+        # One render per derivative even when several requests arrive together
+        with self._locked(path):
+            if self._is_fresh(path, mask):
+                self._touch(path)
+                return path, False
+
+            with stage_timer.time("overlay_render"):
+                image = load_image(image_path)
+                if isinstance(mask, bytes):
+                    mask = mask_codec.decode(mask)
+                else:
+                    mask_path, mask = mask, cv2.imread(mask, cv2.IMREAD_GRAYSCALE)
+                    if mask is None:
+                        raise ValueError(f"Could not load mask: {mask_path}")
+
+                h, w = image.shape[:2]
+                if size and max(h, w) > size:
+                    scale = size / float(max(h, w))
+                    h, w = max(1, round(h * scale)), max(1, round(w * scale))
+                    image = cv2.resize(image, (w, h), interpolation=cv2.INTER_AREA)
+                if mask.shape[:2] != (h, w):
+                    mask = cv2.resize(mask, (w, h), interpolation=cv2.INTER_NEAREST)
+
+                mask_rgb = np.zeros((h, w, 3), dtype=np.uint8)
+                mask_rgb[mask > 0] = OVERLAY_COLOR
+                overlay = cv2.addWeighted(image, 1 - OVERLAY_ALPHA, mask_rgb, OVERLAY_ALPHA, 0)
+
+                # Write then rename so concurrent readers never see a partial file
+                tmp_path = f"{path}.{os.getpid()}.tmp.png"
+                cv2.imwrite(tmp_path, overlay)
+                os.replace(tmp_path, path)
+        self._evict(keep=path)
+        return path, True
+
+    def _is_fresh(self, path: str, mask: Union[str, bytes]) -> bool:
+        if isinstance(mask, bytes):
+            return os.path.exists(path)
+        try:
+            return os.path.getmtime(path) >= os.path.getmtime(mask)
+        except OSError:
+            return False
+
+    def _touch(self, path: str):
+        # mtime doubles as last use, since atime is often not kept
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _evict(self, keep: str):
+        """Delete the least recently served derivatives until the cache fits max_bytes"""
+        if self.max_bytes <= 0:
+            return
+        files, total = [], 0
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".png") or ".tmp." in entry.name:
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        for _, file_size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= file_size
+            except OSError:
+                pass
+
+    @contextmanager
+    def _locked(self, path: str):
+        with self._locks_lock:
+            entry = self._locks.setdefault(path, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._locks_lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[path]
+
+overlay_service = OverlayService()
@@ -0,0 +1,107 @@
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+class PromptScorer:
+    """
+    Resident CLIP model for FastSAM text prompts.
+
+    FastSAMPrompt.text_prompt reloads CLIP and re-encodes the prompt on every call.
+    Here the model is loaded once per process and text embeddings are memoized per
+    prompt string, so scoring an image costs one batched encode of the mask crops
+    plus a dot product.
+    """
+
+    def __init__(self, device: str = "cpu", model_name: str = "ViT-B/32", min_mask_area: int = 100):
+        self.device = device
+        self.model_name = model_name
+        self.min_mask_area = min_mask_area
+        self._model = None
+        self._preprocess = None
+        self._tokenize = None
+        self._text_features: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        return self._model is not None
+
+    def load(self) -> bool:
+        """Load CLIP; returns False when the clip package is not installed"""
+        try:
+            try:
+                import clip
+            except ImportError:
+                # Same package FastSAMPrompt installs on first use
+                from ultralytics.utils import checks
+
+                checks.check_requirements("git+https://github.com/ultralytics/CLIP.git")
+                import clip
+
+            self._model, self._preprocess = clip.load(self.model_name, device=self.device)
+            self._model.eval()
+            self._tokenize = clip.tokenize
+            print(f"CLIP {self.model_name} loaded for prompt scoring")
+            return True
+        except Exception as e:
+            print(f"CLIP not available, falling back to FastSAMPrompt: {e}")
+            self._model = None
+            return False
+
+    def precompute(self, prompts: Iterable[str]):
+        for prompt in prompts:
+            self.text_features(prompt)
+
+    def text_features(self, prompt: str):
+        """Normalized CLIP embedding of a prompt, computed once per string"""
+        import torch
+
+        with self._lock:
+            features = self._text_features.get(prompt)
+            if features is None:
+                with torch.no_grad():
+                    tokens = self._tokenize([prompt]).to(self.device)
+                    features = self._model.encode_text(tokens).float()
+                    features /= features.norm(dim=-1, keepdim=True)
+                self._text_features[prompt] = features
+            return features
+
+    def best_mask(self, image: np.ndarray, masks, prompt: str) -> Optional[int]:
+        """
+        Index of the mask whose crop best matches the prompt, or None if no mask is
+        large enough to score. image is BGR (H, W, 3); masks is a boolean (N, H, W) tensor
+        at the image's resolution.
+        """
+        match = self.best_match(image, masks, prompt)
+        return None if match is None else match[0]
+
+    def best_match(self, image: np.ndarray, masks, prompt: str) -> Optional[Tuple[int, float]]:
+        """best_mask with its CLIP similarity, so matches from different crops can be compared"""
+        import torch
+
+        areas = masks.sum(dim=(1, 2))
+        candidates = torch.nonzero(areas >= self.min_mask_area).flatten().tolist()
+        if not candidates:
+            return None
+
+        rgb = image[:, :, ::-1]
+        crops = []
+        for i in candidates:
+            mask = masks[i].cpu().numpy()
+            ys, xs = np.nonzero(mask)
+            y0, y1, x0, x1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+            # Like FastSAMPrompt: keep the segment, paint the rest of its box white
+            crop = np.where(mask[y0:y1, x0:x1, None], rgb[y0:y1, x0:x1], 255).astype(np.uint8)
+            crops.append(self._preprocess(Image.fromarray(crop)))
+
+        text_features = self.text_features(prompt)
+        with torch.no_grad():
+            image_features = self._model.encode_image(torch.stack(crops).to(self.device)).float()
+            image_features /= image_features.norm(dim=-1, keepdim=True)
+            scores = (image_features @ text_features.T)[:, 0]
+
+        best = int(torch.argmax(scores))
+        return candidates[best], float(scores[best])
@@ -0,0 +1,73 @@
+import threading
+from typing import List, Optional
+
+from app.config import settings
+
+
+class ResolutionPolicy:
+    """
+    Chooses FastSAM's inference size from the queue depth and a latency SLO.
+
+    Each worker keeps a moving average of segmentation seconds per image at the
+    sizes it has run; sizes it has not run yet are estimated from the nearest
+    measured one, scaling with pixel count. A batch runs at the largest size at
+    which the pending queue, shared across all workers, would still drain within
+    LATENCY_SLO_SECONDS, and at the smallest size when none would.
+    """
+
+    def __init__(
+        self,
+        sizes: Optional[List[int]] = None,
+        max_size: int = settings.FASTSAM_IMGSZ,
+        slo_seconds: float = settings.LATENCY_SLO_SECONDS,
+        workers: int = settings.INFERENCE_WORKERS,
+        smoothing: float = 0.3,
+    ):
+        sizes = settings.ADAPTIVE_IMGSZ_SIZES if sizes is None else sizes
+        self.max_size = max_size
+        self.sizes = sorted({s for s in sizes if 0 < s <= max_size} | {max_size})
+        self.slo_seconds = slo_seconds
+        self.workers = max(1, workers)
+        self.smoothing = smoothing
+        self._seconds = {}  # imgsz -> moving average of seconds per image
+        self._lock = threading.Lock()
+
+    @property
+    def degraded_sizes(self) -> List[int]:
+        """Sizes below max_size; their results are not reused by the analysis cache"""
+        return [s for s in self.sizes if s < self.max_size]
+
+    def observe(self, imgsz: int, images: int, seconds: float):
+        if images <= 0:
+            return
+        per_image = seconds / images
+        with self._lock:
+            previous = self._seconds.get(imgsz)
+            self._seconds[imgsz] = (
+                per_image if previous is None else previous + self.smoothing * (per_image - previous)
+            )
+
+    def estimate(self, imgsz: int) -> Optional[float]:
+        """Expected segmentation seconds per image at imgsz, or None before any measurement"""
+        with self._lock:
+            if imgsz in self._seconds:
+                return self._seconds[imgsz]
+            if not self._seconds:
+                return None
+            nearest = min(self._seconds, key=lambda s: abs(s - imgsz))
+            return self._seconds[nearest] * (imgsz / nearest) ** 2
+
+    def choose(self, queue_depth: int) -> int:
+        if self.slo_seconds <= 0 or len(self.sizes) == 1:
+            return self.max_size
+        for size in reversed(self.sizes):
+            per_image = self.estimate(size)
+            if per_image is None:
+                return size
+            # This batch and everything already waiting, spread over the workers
+            if (queue_depth + 1) * per_image / self.workers <= self.slo_seconds:
+                return size
+        return self.sizes[0]
+
+
+resolution_policy = ResolutionPolicy()
@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.database import SessionLocal
+from app.models import UploadSession
+
+TUS_VERSION = "1.0.0"
+PARTIAL_SUFFIX = ".part"
+# Finalizing takes seconds; a session finalizing for longer lost its process mid-way
+FINALIZE_TIMEOUT_SECONDS = 600
+
+
+def partial_path(upload_id: str) -> str:
+    return os.path.join(settings.RESUMABLE_UPLOAD_DIR, f"{upload_id}{PARTIAL_SUFFIX}")
+
+
+def next_expiry() -> datetime:
+    return datetime.utcnow() + timedelta(seconds=settings.RESUMABLE_UPLOAD_TTL_SECONDS)
+
+
+def get_session(db: Session, upload_id: str) -> UploadSession:
+    """The upload session, 404 if unknown and 410 once collected or past its expiry"""
+    session = db.query(UploadSession).filter(UploadSession.upload_id == upload_id).first()
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    if session.status == "expired" or (
+        session.status == "uploading" and session.expires_at < datetime.utcnow()
+    ):
+        raise HTTPException(status_code=410, detail="Upload expired, start a new one")
+    return session
+
+
+def remove_partial(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class PartialUploadCollector:
+    """
+    Garbage-collects abandoned resumable uploads.
+
+    Every chunk pushes a session's expiry RESUMABLE_UPLOAD_TTL_SECONDS ahead, so
+    only uploads nobody resumed for that long are collected: their partial files
+    are deleted and the session is marked expired. Session rows are deleted one
+    more TTL later, once clients polling for them have given up, and partial
+    files no session claims (a crash between creating the file and committing
+    the session) are deleted once they are older than the TTL. Sessions stuck
+    finalizing after a crash go back to uploading (at their full offset, so the
+    client's next PATCH finalizes again) when the partial file is still there,
+    and are expired otherwise.
+    """
+
+    def __init__(
+        self,
+        interval_seconds: float = settings.RESUMABLE_UPLOAD_GC_SECONDS,
+        ttl_seconds: int = settings.RESUMABLE_UPLOAD_TTL_SECONDS,
+    ):
+        self.interval_seconds = interval_seconds
+        self.ttl_seconds = ttl_seconds
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running or self.interval_seconds <= 0:
+            return
+        os.makedirs(settings.RESUMABLE_UPLOAD_DIR, exist_ok=True)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="partial-upload-gc", daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                collected = self.collect()
+                if any(collected.values()):
+                    print(f"Partial upload GC: {collected}")
+            except Exception as e:
+                print(f"Partial upload GC failed: {e}")
+            self._stop.wait(self.interval_seconds)
+
+    def collect(self) -> dict:
+        now = datetime.utcnow()
+        db = SessionLocal()
+        try:
+            expired = (
+                db.query(UploadSession)
+                .filter(UploadSession.status == "uploading", UploadSession.expires_at < now)
+                .all()
+            )
+            for session in expired:
+                remove_partial(session.partial_path)
+                session.status = "expired"
+                session.updated_at = now
+            stuck = (
+                db.query(UploadSession)
+                .filter(
+                    UploadSession.status == "finalizing",
+                    UploadSession.updated_at < now - timedelta(seconds=FINALIZE_TIMEOUT_SECONDS),
+                )
+                .all()
+            )
+            for session in stuck:
+                if os.path.exists(session.partial_path):
+                    session.status = "uploading"
+                    session.expires_at = next_expiry()
+                else:
+                    session.status = "expired"
+                session.updated_at = now
+            deleted = (
+                db.query(UploadSession)
+                .filter(
+                    UploadSession.status.notin_(("uploading", "finalizing")),
+                    UploadSession.expires_at < now - timedelta(seconds=self.ttl_seconds),
+                )
+                .delete(synchronize_session=False)
+            )
+            db.commit()
+            live = {
+                os.path.basename(path)
+                for (path,) in db.query(UploadSession.partial_path).filter(
+                    UploadSession.status.in_(("uploading", "finalizing"))
+                )
+            }
+        finally:
+            db.close()
+
+        orphans = 0
+        cutoff = time.time() - self.ttl_seconds
+        directory = settings.RESUMABLE_UPLOAD_DIR
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if name.endswith(PARTIAL_SUFFIX) and name not in live and os.path.getmtime(path) < cutoff:
+                    remove_partial(path)
+                    orphans += 1
+        return {"expired": len(expired), "stuck": len(stuck), "deleted": deleted, "orphans": orphans}
+
+
+partial_upload_collector = PartialUploadCollector()
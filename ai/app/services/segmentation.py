@@ -1,76 +1,175 @@
 import cv2
+import hashlib
+import heapq
 import numpy as np
-from ultralytics import FastSAM
-
-try:
-    from ultralytics.models.fastsam import FastSAMPrompt
-except ImportError:
-    try:
-        from ultralytics import FastSAM as FastSAMPrompt
-    except ImportError:
-        FastSAMPrompt = None
-import torch
-import tensorflow as tf
 from PIL import Image
 import os
-from typing import Tuple, Optional
-import boto3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Optional, Union
 from app.config import settings
+from app.metrics import stage_timer
+from app.services import mask_codec, tiling
+from app.services.prompt_scorer import PromptScorer
+from app.services.image_io import load_image
+from app.services.inference_engines import (
+    classifier_path,
+    fastsam_path,
+    int8_classifier_path,
+    load_classifier_engine,
+    load_int8_classifier,
+)
+
+# torch, tensorflow, ultralytics and the optional runtimes are imported lazily in
+# load_models so that importing this module is cheap and only what a model needs is loaded.
+
+DEFAULT_TEXT_PROMPT = "brown spots around green leaf"
+# ultralytics' default detection cap, and its retina masks are float32
+DEFAULT_MAX_DET = 300
+MASK_BYTES_PER_PIXEL = 4
+# Below this many affordable masks, keep masks at inference size and resize only the union
+MIN_RETINA_MASKS = 8
+
+
+def _letterbox_content(mask_shape: Tuple[int, int], image_shape: Tuple[int, int]) -> Tuple[int, int, int, int]:
+    """
+    (top, bottom, left, right) of the image inside a mask of mask_shape that
+    ultralytics letterboxed (scaled to fit, padding centered), as ops.scale_image crops it
+    """
+    mh, mw = mask_shape
+    h, w = image_shape
+    gain = min(mh / h, mw / w)
+    pad_x, pad_y = (mw - w * gain) / 2, (mh - h * gain) / 2
+    top, left = int(round(pad_y - 0.1)), int(round(pad_x - 0.1))
+    bottom, right = mh - int(round(pad_y + 0.1)), mw - int(round(pad_x + 0.1))
+    return top, bottom, left, right
+
+
+def model_version() -> str:
+    """
+    Short fingerprint of the model files on disk. Cached analyses are keyed by it,
+    so replacing FastSAM or the classifier invalidates every earlier result.
+    """
+    # Engines change numerics slightly, so the files actually served are what counts
+    parts = [f"engines:{settings.FASTSAM_ENGINE}:{settings.CLASSIFIER_ENGINE}"]
+    # Healthy early exits record 0% without segmenting, so the pipeline order is part of the result
+    if settings.ANALYSIS_PIPELINE_ORDER == "classify_first":
+        parts.append(f"classify_first:{settings.HEALTHY_SKIP_CONFIDENCE}")
+    parts.append(
+        f"fastsam:{settings.FASTSAM_IMGSZ}:{settings.FASTSAM_CONF}:{settings.FASTSAM_IOU}"
+        f":{settings.JOB_MEMORY_BUDGET_MB}"
+    )
+    # Large images are segmented per tile, which finds different (smaller) lesions
+    if settings.TILED_MIN_PIXELS > 0:
+        parts.append(
+            f"tiled:{settings.TILED_MIN_PIXELS}:{settings.TILE_SIZE}:{settings.TILE_OVERLAP}"
+            f":{settings.TILE_PROMPT_TOP_K}"
+        )
+    paths = [fastsam_path(settings.FASTSAM_ENGINE), _served_classifier_path()]
+    for path in paths:
+        if path is None:
+            continue
+        try:
+            stat = os.stat(path)
+            parts.append(f"{path}:{stat.st_size}:{int(stat.st_mtime)}")
+        except OSError:
+            parts.append(f"{path}:missing")
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()[:12]
 
 
-class SegmentationService:
-    def __init__(self):
-        self.fastsam_model = None
-        self.classification_model = None
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.s3_client = None
-        print(f"Using device: {self.device}")
-        self.load_models()
-        self._init_s3_client()
+def _served_classifier_path() -> Optional[str]:
+    if settings.CLASSIFIER_INT8:
+        int8_path = int8_classifier_path(settings.INT8_MIN_TOP1_AGREEMENT, settings.INT8_MIN_TOP3_OVERLAP)
+        if int8_path:
+            return int8_path
+    return classifier_path(settings.CLASSIFIER_ENGINE)
 
-    def _init_s3_client(self):
-        """Initialize S3 client if AWS credentials are available"""
-        try:
-            if settings.AWS_ACCESS_KEY_ID and settings.AWS_SECRET_ACCESS_KEY:
-                self.s3_client = boto3.client(
-                    "s3",
-                    aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                    region_name=settings.AWS_REGION,
-                )
-                print("S3 client initialized successfully")
-            else:
-                print("AWS credentials not found")
-        except Exception as e:
-            print(f"Failed to initialize S3 client: {e}")
 
-    def _upload_to_s3(self, file_path: str, s3_key: str) -> Optional[str]:
-        """
-        Upload a file to S3 and return the S3 URL
-        Args:
-            file_path: Local path to the file
-            s3_key: The key (path) where the file will be stored in S3
-        Returns:
-            S3 URL if successful, None otherwise
-        """
-        if not self.s3_client:
-            print("S3 client not initialized")
-            return None
+def text_prompt_for_crop(crop: str) -> str:
+    return settings.CROP_TEXT_PROMPTS.get(crop.lower(), DEFAULT_TEXT_PROMPT)
+
 
+def _import_fastsam_prompt():
+    try:
+        from ultralytics.models.fastsam import FastSAMPrompt
+    except ImportError:
         try:
-            bucket = settings.AWS_S3_BUCKET
-            self.s3_client.upload_file(file_path, bucket, s3_key)
+            from ultralytics import FastSAM as FastSAMPrompt
+        except ImportError:
+            FastSAMPrompt = None
+    return FastSAMPrompt
 
-            # Generate S3 URL
-            s3_url = f"https://{bucket}.s3.{settings.AWS_REGION}.amazonaws.com/{s3_key}"
-            print(f"Uploaded to S3: {s3_url}")
-            return s3_url
-        except Exception as e:
-            print(f"Error uploading to S3: {e}")
-            return None
+
+class SegmentationService:
+    def __init__(self):
+        self.fastsam_model = None
+        self.fastsam_prompt_cls = None
+        self.classifier_engine = None  # ClassifierEngine, see inference_engines.py
+        self.model_version = None
+        self.prompt_scorer = None
+        self.device = "cpu"
+        self.load_times = {}
+        self._loaded = False
+        self._load_lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def warm_up(self):
+        """Load models now instead of on the first request"""
+        self.ensure_loaded()
+
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._load_lock:
+            if not self._loaded:
+                self.load_models()
+                self._loaded = True
 
     def load_models(self):
+        """Load FastSAM, the classifier and CLIP concurrently; loading is mostly I/O and C code"""
+        import torch
+
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.model_version = model_version()
+        print(f"Using device: {self.device}, model version {self.model_version}")
+
+        with ThreadPoolExecutor(max_workers=3, thread_name_prefix="model-load") as executor:
+            fastsam_future = executor.submit(self._timed_load, "fastsam", self._load_fastsam)
+            classifier_future = executor.submit(self._timed_load, "classifier", self._load_classifier)
+            clip_future = executor.submit(self._timed_load, "clip", self._load_prompt_scorer)
+            fastsam_future.result()
+            classifier_future.result()
+            clip_future.result()
+
+    def _load_prompt_scorer(self):
+        scorer = PromptScorer(device=self.device)
+        if scorer.load():
+            # Embed every known prompt up front so requests only encode image crops
+            scorer.precompute({DEFAULT_TEXT_PROMPT, *settings.CROP_TEXT_PROMPTS.values()})
+            self.prompt_scorer = scorer
+
+    def _timed_load(self, name: str, loader):
+        started = time.perf_counter()
+        loader()
+        self.load_times[name] = time.perf_counter() - started
+        print(f"Loaded {name} in {self.load_times[name]:.2f}s")
+
+    def _load_fastsam(self):
         try:
+            import torch
+            from ultralytics import FastSAM
+
+            self.fastsam_prompt_cls = _import_fastsam_prompt()
+            # .pt for torch; exported ONNX/OpenVINO models run through ultralytics' AutoBackend
+            weights = fastsam_path(settings.FASTSAM_ENGINE)
+            if settings.FASTSAM_ENGINE != "torch" and weights.endswith(".pt"):
+                print(f"No exported FastSAM for {settings.FASTSAM_ENGINE}, run export_models.py; using {weights}")
+
             # Add safe globals for torch loading including ultralytics classes
             try:
                 import ultralytics.nn.tasks
@@ -93,8 +192,8 @@ class SegmentationService:
             # Try loading with different approaches based on ultralytics version
             try:
                 # Method 1: Direct load (should work with ultralytics 8.3.0+)
-                self.fastsam_model = FastSAM("FastSAM-x.pt")
-                print("FastSAM model loaded successfully")
+                self.fastsam_model = FastSAM(weights)
+                print(f"FastSAM model loaded successfully ({weights})")
             except Exception as e1:
                 print(f"Direct load failed: {e1}")
                 # Method 2: Try with explicit weights_only=False for older PyTorch/ultralytics
@@ -102,9 +201,9 @@ class SegmentationService:
                     print("Attempting load with weights_only=False")
                     # Create a temporary model file with the weights_only flag
                     temp_model = torch.load(
-                        "FastSAM-x.pt", map_location=self.device, weights_only=False
+                        weights, map_location=self.device, weights_only=False
                     )
-                    self.fastsam_model = FastSAM("FastSAM-x.pt")
+                    self.fastsam_model = FastSAM(weights)
                     print("FastSAM model loaded with weights_only=False")
                 except Exception as e2:
                     print(f"weights_only=False load failed: {e2}")
@@ -114,139 +213,261 @@ class SegmentationService:
             print(f"Error loading FastSAM model: {e}")
             print("FastSAM segmentation will not be available")
             self.fastsam_model = None
+
+    def _load_classifier(self):
         try:
-            if os.path.exists("plant_disease_model.h5"):
-                self.classification_model = tf.keras.models.load_model(
-                    "plant_disease_model.h5"
+            import torch
+
+            int8_path = None
+            if settings.CLASSIFIER_INT8:
+                int8_path = int8_classifier_path(
+                    settings.INT8_MIN_TOP1_AGREEMENT, settings.INT8_MIN_TOP3_OVERLAP, verbose=True
                 )
-                print("Disease classification model loaded successfully (Keras)")
-            elif os.path.exists("plant_disease_model.pt"):
-                self.classification_model = torch.load(
-                    "plant_disease_model.pt", map_location=self.device
+            if int8_path:
+                try:
+                    self.classifier_engine = load_int8_classifier(int8_path, num_threads=torch.get_num_threads())
+                except Exception as e:
+                    print(f"Error loading INT8 classifier {int8_path}, using FP32: {e}")
+            if self.classifier_engine is None:
+                self.classifier_engine = load_classifier_engine(
+                    settings.CLASSIFIER_ENGINE, device=self.device, num_threads=torch.get_num_threads()
                 )
-                self.classification_model.eval()
-                print("Disease classification model loaded successfully (PyTorch)")
+            if self.classifier_engine is not None:
+                print(f"Disease classification model loaded successfully ({self.classifier_engine.framework})")
             else:
                 print("No disease classification model found, using fallback database")
         except Exception as e:
             print(f"Error loading classification model: {e}")
-            self.classification_model = None
+            self.classifier_engine = None
 
     def segment_infection(
-        self, image_path: str, image_id: str, text_prompt: str = "brown spots around green leaf"
-    ) -> Tuple[Optional[str], Optional[float]]:
+        self,
+        image: Union[str, np.ndarray],
+        image_id: str,
+        text_prompt: str = DEFAULT_TEXT_PROMPT,
+        imgsz: Optional[int] = None,
+    ) -> Tuple[Optional[bytes], Optional[float]]:
         """
-        Returns: (mask_path, infected_percentage)
-        Writes overlay to same directory with suffix _overlay.png (useful for UI).
+        Returns: (mask_rle, infected_percentage), mask_rle from mask_codec.encode
         Robustly extracts masks from ultralytics/Results.
         """
+        return self.segment_batch([(image, image_id)], text_prompt, imgsz)[0]
+
+    def segment_batch(
+        self,
+        items: List[Tuple[Union[str, np.ndarray], str]],
+        text_prompt: str = DEFAULT_TEXT_PROMPT,
+        imgsz: Optional[int] = None,
+    ) -> List[Tuple[Optional[bytes], Optional[float]]]:
+        """
+        Segment several images with a single FastSAM forward pass.
+        items: list of (image, image_id), where image is a decoded BGR array from
+        load_image (or a path, which is decoded here once)
+        imgsz: inference size, FASTSAM_IMGSZ by default (see resolution_policy.py)
+        Returns one (mask_rle, infected_percentage) per item, in order.
+        """
+        self.ensure_loaded()
         if not self.fastsam_model:
             raise Exception("FastSAM model not loaded")
 
-        if FastSAMPrompt is None:
+        if self.fastsam_prompt_cls is None:
             raise Exception("FastSAMPrompt not available in this ultralytics version")
 
         try:
-            # Run FastSAM inference
-            results = self.fastsam_model(
-                image_path, imgsz=1024, conf=0.4, iou=0.9, retina_masks=True
+            images = [load_image(image) if isinstance(image, str) else image for image, _ in items]
+        except Exception as e:
+            print(f"Error in batched segmentation: {e}")
+            return [(None, 0.0)] * len(items)
+
+        # Very large images go tile by tile; the rest share one forward pass
+        outputs = [None] * len(items)
+        batched = []
+        for i, image in enumerate(images):
+            if self.use_tiles(image):
+                outputs[i] = self.segment_tiled(image, items[i][1], text_prompt)
+            else:
+                batched.append(i)
+        if not batched:
+            return outputs
+
+        max_det, retina_masks = self._mask_limits(
+            max(images[i].shape[0] * images[i].shape[1] for i in batched),
+            under_load=bool(imgsz) and imgsz < settings.FASTSAM_IMGSZ,
+        )
+        try:
+            # ultralytics takes the decoded arrays as-is (BGR) and letterboxes a
+            # list source into one batch tensor, so this is a single forward pass
+            with stage_timer.time("fastsam_forward"):
+                results = self.fastsam_model(
+                    [images[i] for i in batched],
+                    imgsz=imgsz or settings.FASTSAM_IMGSZ,
+                    conf=settings.FASTSAM_CONF,
+                    iou=settings.FASTSAM_IOU,
+                    retina_masks=retina_masks,
+                    max_det=max_det,
+                    batch=len(batched),
+                )
+        except Exception as e:
+            print(f"Error in batched segmentation: {e}")
+            results = None
+
+        for n, i in enumerate(batched):
+            outputs[i] = (
+                (None, 0.0) if results is None
+                else self._process_segmentation(images[i], items[i][1], [results[n]], text_prompt)
             )
+        return outputs
 
-            # Use FastSAMPrompt to get mask annotations for text prompt
-            # Handle different FastSAMPrompt APIs
-            try:
-                # prompt_proc = FastSAMPrompt(image_path, results, device=self.device)
-                prompt_proc = FastSAMPrompt(image_path, results, device=self.device)
-                ann = prompt_proc.text_prompt(text=text_prompt)
-            except (TypeError, AttributeError) as e:
-                print(f"FastSAMPrompt API error: {e}")
-                # Fallback: try different parameter order or method
-                try:
-                    prompt_proc = FastSAMPrompt(results, image_path, device=self.device)
-                    ann = prompt_proc.text_prompt(text=text_prompt)
-                except Exception:
-                    # Another fallback: use results directly if prompt processing fails
-                    ann = results
+    def use_tiles(self, image: np.ndarray) -> bool:
+        h, w = image.shape[:2]
+        return settings.TILED_MIN_PIXELS > 0 and h * w >= settings.TILED_MIN_PIXELS
+
+    def _mask_limits(self, pixels: int, under_load: bool = False) -> Tuple[int, bool]:
+        """
+        (max_det, retina_masks) for a FastSAM call. Normally FastSAM's defaults, so
+        ordinary results never depend on the budget. Under load (the resolution
+        policy stepped imgsz down, and those results are not cached) they keep one
+        job's image-resolution masks within JOB_MEMORY_BUDGET_MB; max_det keeps
+        FastSAM's most confident masks.
+        """
+        budget = settings.JOB_MEMORY_BUDGET_MB * 1024 * 1024
+        if not under_load or budget <= 0:
+            return DEFAULT_MAX_DET, True
+        affordable = budget // (max(1, pixels) * MASK_BYTES_PER_PIXEL)
+        if affordable >= MIN_RETINA_MASKS:
+            return min(DEFAULT_MAX_DET, affordable), True
+        print(f"Masks for {pixels} px images exceed the memory budget, keeping them at inference size")
+        return DEFAULT_MAX_DET, False
+
+    def segment_tiled(
+        self, image: np.ndarray, image_id: str, text_prompt: str = DEFAULT_TEXT_PROMPT
+    ) -> Tuple[Optional[bytes], Optional[float]]:
+        """
+        Segment a large image at native resolution as overlapping TILE_SIZE tiles.
+
+        Tiles go through FastSAM FASTSAM_BATCH_SIZE at a time, so retina masks are
+        only ever materialized at tile size. Each tile is prompt-filtered on a
+        TILE_WORKERS thread pool while the next batch runs, and writes only its
+        core (see tiling.py) into the full-size mask, so overlaps count once.
+
+        Every tile has a best match for the prompt, lesion or not, so only the
+        TILE_PROMPT_TOP_K best-scoring tile segments across the image are kept,
+        like the single best segment of an untiled image. Without resident CLIP
+        there are no scores to rank, and every tile's FastSAMPrompt match is kept.
+        """
+        self.ensure_loaded()
+        h, w = image.shape[:2]
+        tile_size = max(64, settings.TILE_SIZE)
+        union = np.zeros((h, w), dtype=np.uint8)
+        tiles = list(tiling.grid(h, w, tile_size, settings.TILE_OVERLAP))
+        batch_size = max(1, settings.FASTSAM_BATCH_SIZE)
+        workers = max(1, settings.TILE_WORKERS)
+        print(f"Segmenting {image_id} ({w}x{h}) as {len(tiles)} tiles of {tile_size}px")
+
+        top_k = max(1, settings.TILE_PROMPT_TOP_K)
+        # Min-heap of (score, tile index, core mask, core origin): the best top_k tile segments so far
+        best = []
+        best_lock = threading.Lock()
+
+        def stitch(index: int, tile: np.ndarray, result, row: tiling.Span, column: tiling.Span):
+            mask, score = self._tile_mask(tile, result, text_prompt)
+            (y0, _, cy0, cy1), (x0, _, cx0, cx1) = row, column
+            core = mask[cy0 - y0 : cy1 - y0, cx0 - x0 : cx1 - x0]
+            if score is None:
+                # Cores never overlap, so threads write disjoint regions
+                union[cy0:cy1, cx0:cx1] = core
+                return
+            if not core.any():
+                return
+            with best_lock:
+                heapq.heappush(best, (score, index, core, (cy0, cx0)))
+                if len(best) > top_k:
+                    heapq.heappop(best)
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tile") as executor:
+                pending = deque()
+                for start in range(0, len(tiles), batch_size):
+                    batch = tiles[start : start + batch_size]
+                    crops = [image[r[0] : r[1], c[0] : c[1]] for r, c in batch]
+                    with stage_timer.time("fastsam_forward"):
+                        results = self.fastsam_model(
+                            crops,
+                            imgsz=tile_size,
+                            conf=settings.FASTSAM_CONF,
+                            iou=settings.FASTSAM_IOU,
+                            # Tiles run at their own size, so these masks are never upscaled
+                            retina_masks=True,
+                            batch=len(crops),
+                        )
+                    for index, crop, result, (row, column) in zip(
+                        range(start, start + len(batch)), crops, results, batch
+                    ):
+                        pending.append(executor.submit(stitch, index, crop, result, row, column))
+                    # Bound the tile results held in memory to what the workers can take
+                    while len(pending) > workers * batch_size:
+                        pending.popleft().result()
+                for future in pending:
+                    future.result()
+        except Exception as e:
+            print(f"Error in tiled segmentation: {e}")
+            return None, 0.0
+        for _, _, core, (cy0, cx0) in best:
+            union[cy0 : cy0 + core.shape[0], cx0 : cx0 + core.shape[1]] = core
+
+        with stage_timer.time("mask_encode"):
+            mask_rle = mask_codec.encode(union)
+        return mask_rle, (mask_codec.area(mask_rle) / float(h * w)) * 100.0
+
+    def _tile_mask(self, tile: np.ndarray, result, text_prompt: str) -> Tuple[np.ndarray, Optional[float]]:
+        """
+        Prompt-filtered mask of one tile at tile resolution, with the CLIP score of
+        its segment (None when FastSAMPrompt selected it and there is no score)
+        """
+        th, tw = tile.shape[:2]
+        score = None
+        with stage_timer.time("prompt_scoring"):
+            masks = self._scorable_masks(tile, [result])
+            if masks is not None:
+                match = self.prompt_scorer.best_match(tile, masks, text_prompt) if masks.shape[0] else None
+                if match is None:
+                    return np.zeros((th, tw), dtype=np.uint8), None
+                ann, score = [masks[match[0] : match[0] + 1]], match[1]
+            else:
+                ann = self._prompt_annotations(tile, [result], text_prompt)
+        if not ann:
+            return np.zeros((th, tw), dtype=np.uint8), score
+        with stage_timer.time("mask_union"):
+            return self._union_masks(ann, th, tw), score
+
+    def _process_segmentation(
+        self, image: np.ndarray, image_id: str, results: list, text_prompt: str
+    ) -> Tuple[Optional[bytes], Optional[float]]:
+        """Prompt-filter one image's FastSAM results and encode its mask"""
+        try:
+            h, w = image.shape[:2]
+            total_pixels = h * w
+
+            with stage_timer.time("prompt_scoring"):
+                ann = self._prompt_annotations(image, results, text_prompt)
             print(f"{text_prompt=}")
-            print(f"{ann=}")
             if not ann:
                 print(
                     "No annotations returned by FastSAMPrompt for prompt:", text_prompt
                 )
                 return None, 0.0
 
-            # load image
-            image = cv2.imread(image_path)
-            if image is None:
-                raise Exception(f"Could not load image: {image_path}")
-            h, w = image.shape[:2]
-            total_pixels = h * w
+            # Area filter, union and resize all happen on the stacked mask tensors
+            with stage_timer.time("mask_union"):
+                union_mask = self._union_masks(ann, h, w)
 
-            union_mask = np.zeros((h, w), dtype=np.uint8)
-            all_masks = []
+            # Stored run-length encoded on the analysis row; overlays and PNGs are
+            # rendered on request, and the area comes straight from the runs
+            with stage_timer.time("mask_encode"):
+                mask_rle = mask_codec.encode(union_mask)
+            infected_percentage = (mask_codec.area(mask_rle) / float(total_pixels)) * 100.0
 
-            # Handle different types of annotations returned by FastSAMPrompt
-            if isinstance(ann, (list, tuple)):
-                # ann is a list of Results objects or tensors
-                for idx, a in enumerate(ann):
-                    masks = self._extract_masks_from_annotation(a, h, w, idx)
-                    all_masks.extend(masks)
-            else:
-                # ann is a single Results object or tensor
-                masks = self._extract_masks_from_annotation(ann, h, w, 0)
-                all_masks.extend(masks)
-
-            # Filter masks by area to remove noisy segmentations
-            if all_masks:
-                filtered_masks = self._filter_masks_by_area(all_masks, total_pixels)
-
-                # Combine all valid masks into union mask
-                for mask in filtered_masks:
-                    union_mask = np.logical_or(union_mask, mask).astype(np.uint8)
-            else:
-                print("No valid masks found after extraction")
-
-            infected_pixels = int(union_mask.sum())
-            infected_percentage = (infected_pixels / float(total_pixels)) * 100.0
-
-            # Create local directories for temporary storage
-            local_mask_dir = "uploads/masks"
-            os.makedirs(local_mask_dir, exist_ok=True)
-            # image_id = os.path.splitext(os.path.basename(image_path))[0]
-
-            # Local paths for temporary storage
-            local_mask_path = os.path.join(local_mask_dir, f"{image_id}_mask.png")
-            local_overlay_path = os.path.join(local_mask_dir, f"{image_id}_overlay.png")
-
-            # Save mask locally
-            cv2.imwrite(local_mask_path, (union_mask * 255).astype(np.uint8))
-
-            # Create and save overlay locally
-            mask_rgb = np.zeros((h, w, 3), dtype=np.uint8)
-            mask_rgb[union_mask > 0] = [0, 0, 255]
-            alpha = 0.35
-            overlay = cv2.addWeighted(image, 1 - alpha, mask_rgb, alpha, 0)
-            cv2.imwrite(local_overlay_path, overlay)
-
-            # Upload overlay to S3
-            s3_overlay_key = f"masks/{image_id}_overlay.png"
-            s3_overlay_url = self._upload_to_s3(local_overlay_path, s3_overlay_key)
-
-            # Upload mask to S3
-            s3_mask_key = f"masks/{image_id}_mask.png"
-            # self._upload_to_s3(local_mask_path, s3_mask_key)
-
-            # # Clean up local files
-            # try:
-            #     os.remove(local_mask_path)
-            #     os.remove(local_overlay_path)
-            # except Exception as e:
-            #     print(f"Error cleaning up local files: {e}")
-
-            # Return the S3 URL for the overlay if available, otherwise return local path as fallback
-            overlay_path = s3_overlay_url if s3_overlay_url else local_overlay_path
-            print(f"{overlay_path=}")
-            return overlay_path, infected_percentage
+            return mask_rle, infected_percentage
 
         except Exception as e:
             print(f"Error in segmentation: {e}")
@@ -258,227 +479,193 @@ class SegmentationService:
                 pass
             return None, 0.0
 
-    def _extract_masks_from_annotation(
-        self, annotation, target_h: int, target_w: int, idx: int
-    ) -> list:
-        """Extract all binary masks from various annotation formats"""
-        masks = []
-
+    def _prompt_annotations(self, image: np.ndarray, results: list, text_prompt: str) -> list:
+        """Select the masks matching the text prompt"""
+        masks = self._scorable_masks(image, results)
+        if masks is not None:
+            if masks.shape[0] == 0:
+                return []
+            best = self.prompt_scorer.best_mask(image, masks, text_prompt)
+            return [] if best is None else [masks[best : best + 1]]
+
+        # Use FastSAMPrompt to get mask annotations for text prompt
+        # Handle different FastSAMPrompt APIs
+        FastSAMPrompt = self.fastsam_prompt_cls
         try:
-            # Case 1: Results object with masks attribute
-            if hasattr(annotation, "masks") and annotation.masks is not None:
-                mask_obj = annotation.masks
-                if hasattr(mask_obj, "data"):
-                    # masks.data is typically a tensor with shape (N, H, W)
-                    mask_data = mask_obj.data
-                    if hasattr(mask_data, "cpu"):
-                        mask_data = mask_data.cpu().numpy()
-                    elif hasattr(mask_data, "numpy"):
-                        mask_data = mask_data.numpy()
-
-                    if mask_data.ndim == 3 and mask_data.shape[0] > 0:
-                        # Process all masks
-                        for i in range(mask_data.shape[0]):
-                            seg_mask = mask_data[i]
-                            processed_mask = self._process_single_mask(
-                                seg_mask, target_h, target_w
-                            )
-                            if processed_mask is not None:
-                                masks.append(processed_mask)
-                    elif mask_data.ndim == 2:
-                        processed_mask = self._process_single_mask(
-                            mask_data, target_h, target_w
-                        )
-                        if processed_mask is not None:
-                            masks.append(processed_mask)
-
-            # Case 2: Direct tensor/array with .cpu() method
-            elif hasattr(annotation, "cpu") and callable(getattr(annotation, "cpu")):
-                mask_data = annotation.cpu().numpy()
-                processed_mask = self._process_single_mask(
-                    mask_data, target_h, target_w
-                )
-                if processed_mask is not None:
-                    masks.append(processed_mask)
-
-            # Case 3: Direct tensor/array with .numpy() method
-            elif hasattr(annotation, "numpy") and callable(
-                getattr(annotation, "numpy")
-            ):
-                mask_data = annotation.numpy()
-                processed_mask = self._process_single_mask(
-                    mask_data, target_h, target_w
-                )
-                if processed_mask is not None:
-                    masks.append(processed_mask)
-
-            # Case 4: Already a numpy array
-            elif isinstance(annotation, np.ndarray):
-                processed_mask = self._process_single_mask(
-                    annotation, target_h, target_w
-                )
-                if processed_mask is not None:
-                    masks.append(processed_mask)
-
-            # Case 5: Try direct conversion
-            else:
-                try:
-                    mask_data = np.asarray(annotation)
-                    processed_mask = self._process_single_mask(
-                        mask_data, target_h, target_w
-                    )
-                    if processed_mask is not None:
-                        masks.append(processed_mask)
-                except Exception:
-                    pass
-
-            if not masks:
-                print(
-                    f"Warning: could not extract any masks from annotation #{idx}; type={type(annotation)}"
-                )
+            # FastSAMPrompt crops from results[0].orig_img, so the array avoids another decode
+            prompt_proc = FastSAMPrompt(image, results, device=self.device)
+            ann = prompt_proc.text_prompt(text=text_prompt)
+        except (TypeError, AttributeError) as e:
+            print(f"FastSAMPrompt API error: {e}")
+            # Fallback: try different parameter order or method
+            try:
+                prompt_proc = FastSAMPrompt(results, image, device=self.device)
+                ann = prompt_proc.text_prompt(text=text_prompt)
+            except Exception:
+                # Another fallback: use results directly if prompt processing fails
+                ann = results
+        return ann
 
+    def _scorable_masks(self, image: np.ndarray, results: list):
+        """The masks to score with resident CLIP, or None when FastSAMPrompt has to select them"""
+        if self.prompt_scorer is None or not self.prompt_scorer.available:
+            return None
+        masks = self._mask_stack(results[0], 0)
+        # Resident CLIP needs masks at image resolution (retina_masks=True)
+        if masks is not None and tuple(masks.shape[1:]) == image.shape[:2]:
             return masks
+        return None
 
-        except Exception as e:
-            print(f"Error extracting masks from annotation #{idx}: {e}")
-            return []
+    def _union_masks(self, annotation, target_h: int, target_w: int) -> np.ndarray:
+        """
+        Reduce every mask in the annotations to one (target_h, target_w) uint8 union.
+        Filtering, the any-reduction and the resize run on the masks' device; only
+        the final union is copied back to host memory.
+        """
+        import torch
+        import torch.nn.functional as F
+
+        annotations = annotation if isinstance(annotation, (list, tuple)) else [annotation]
+        union = None
+        for idx, a in enumerate(annotations):
+            masks = self._mask_stack(a, idx)
+            if masks is None or masks.shape[0] == 0:
+                continue
+
+            masks = self._filter_masks_by_area(masks)
+            if masks.shape[0] == 0:
+                continue
+
+            reduced = masks.any(dim=0)
+            if tuple(reduced.shape) != (target_h, target_w):
+                # Masks at inference size still carry the letterbox padding
+                top, bottom, left, right = _letterbox_content(reduced.shape, (target_h, target_w))
+                reduced = reduced[top:bottom, left:right]
+                # Nearest-neighbour resize commutes with the union, so one resize suffices
+                reduced = F.interpolate(
+                    reduced[None, None].to(torch.uint8), size=(target_h, target_w), mode="nearest"
+                )[0, 0].bool()
+            union = reduced if union is None else (union | reduced.to(union.device))
+
+        if union is None:
+            print("No valid masks found after extraction")
+            return np.zeros((target_h, target_w), dtype=np.uint8)
+
+        return union.to(torch.uint8).cpu().numpy()
+
+    def _mask_stack(self, annotation, idx: int):
+        """Return the masks of one annotation as a boolean (N, H, W) tensor, or None"""
+        import torch
 
-    def _process_single_mask(
-        self, seg_mask, target_h: int, target_w: int
-    ) -> Optional[np.ndarray]:
-        """Process a single mask: normalize dimensions, convert to binary, resize"""
         try:
-            # Normalize dimensions
-            if seg_mask.ndim == 3:
-                if seg_mask.shape[0] == 1:
-                    seg_mask = seg_mask.squeeze(0)
-                else:
-                    seg_mask = seg_mask[0]
-            elif seg_mask.ndim > 3:
-                seg_mask = seg_mask[0]
-                while seg_mask.ndim > 2:
-                    seg_mask = seg_mask[0]
-
-            # Convert to binary mask
-            if seg_mask.dtype == bool:
-                bin_mask = seg_mask.astype(np.uint8)
+            # Results object with masks attribute: masks.data is (N, H, W)
+            if hasattr(annotation, "masks") and annotation.masks is not None:
+                data = getattr(annotation.masks, "data", None)
+                if data is None:
+                    return None
             else:
-                bin_mask = (seg_mask > 0.5).astype(np.uint8)
+                data = annotation
 
-            # Resize to target dimensions if needed
-            if bin_mask.shape != (target_h, target_w):
-                bin_mask = cv2.resize(
-                    bin_mask, (target_w, target_h), interpolation=cv2.INTER_NEAREST
-                )
-                bin_mask = (bin_mask > 0).astype(np.uint8)
+            if not isinstance(data, torch.Tensor):
+                data = torch.as_tensor(np.asarray(data))
 
-            return bin_mask
+            # Normalize dimensions to (N, H, W)
+            if data.ndim == 2:
+                data = data.unsqueeze(0)
+            while data.ndim > 3:
+                data = data[:, 0]
+
+            return data if data.dtype == torch.bool else data > 0.5
 
         except Exception as e:
-            print(f"Error processing single mask: {e}")
+            print(f"Warning: could not extract masks from annotation #{idx}; type={type(annotation)}: {e}")
             return None
 
     def _filter_masks_by_area(
         self,
-        masks: list,
-        total_pixels: int,
+        masks,
         min_area_percent: float = 0.1,
         max_area_percent: float = 40.0,
-    ) -> list:
+    ):
         """Filter out masks that are too small or too large based on area percentage"""
-        filtered_masks = []
+        total_pixels = masks.shape[1] * masks.shape[2]
         min_pixels = int((min_area_percent / 100.0) * total_pixels)
         max_pixels = int((max_area_percent / 100.0) * total_pixels)
 
-        for i, mask in enumerate(masks):
-            mask_pixels = int(mask.sum())
-            mask_percent = (mask_pixels / total_pixels) * 100.0
+        areas = masks.sum(dim=(1, 2))
+        keep = (areas >= min_pixels) & (areas <= max_pixels)
+        filtered = masks[keep]
 
-            if min_pixels <= mask_pixels <= max_pixels:
-                filtered_masks.append(mask)
-                print(f"Mask {i}: {mask_pixels} pixels ({mask_percent:.2f}%) - KEPT")
-            else:
-                print(
-                    f"Mask {i}: {mask_pixels} pixels ({mask_percent:.2f}%) - FILTERED OUT (too {'small' if mask_pixels < min_pixels else 'large'})"
-                )
+        print(f"Filtered {masks.shape[0]} masks -> {filtered.shape[0]} valid masks")
+        return filtered
 
-        print(f"Filtered {len(masks)} masks -> {len(filtered_masks)} valid masks")
-        return filtered_masks
+    def classify_disease(self, image: Union[str, np.ndarray], crop: str) -> Tuple[list, float]:
+        return self.classify_batch([image], [crop])[0]
 
-    def classify_disease(self, image_path: str, crop: str) -> Tuple[list, float]:
-        if self.classification_model:
+    def classify_batch(
+        self, paths_or_arrays: List[Union[str, np.ndarray]], crops: List[str]
+    ) -> List[Tuple[list, float]]:
+        """
+        Classify several images with one forward pass through the loaded model.
+        Arrays are expected in OpenCV BGR order, as returned by load_image.
+        Returns one (top_diseases, confidence) per image, in order.
+        """
+        self.ensure_loaded()
+        if self.classifier_engine is not None:
             try:
-                return self._classify_with_model(image_path, crop)
+                return self._classify_batch_with_model(paths_or_arrays, crops)
             except Exception as e:
                 print(f"Error in model classification: {e}")
-                return self._classify_with_fallback(crop)
-        else:
-            return self._classify_with_fallback(crop)
+        return [self._classify_with_fallback(crop) for crop in crops]
 
     def _classify_with_model(self, image_path: str, crop: str) -> Tuple[list, float]:
-        # Load image as RGB
-        bgr = cv2.imread(image_path)
-        if bgr is None:
-            raise ValueError("Could not read image for classification: " + image_path)
-        rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
-
-        # Default target
-        target_h, target_w = 224, 224
-        use_tf = isinstance(self.classification_model, tf.keras.Model)
-        use_torch = (not use_tf) and (self.classification_model is not None)
-
-        # Determine expected input size dynamically for TF model
-        if use_tf:
-            try:
-                inp_shape = (
-                    self.classification_model.input_shape
-                )  # e.g. (None, H, W, C)
-                if inp_shape and len(inp_shape) == 4:
-                    _, th, tw, tc = inp_shape
-                    if th is not None and tw is not None:
-                        target_h, target_w = int(th), int(tw)
-            except Exception:
-                pass
-        elif use_torch:
-            # If PyTorch model, attempt to read a stored input size attribute if present
-            try:
-                # Common pattern: model expects (batch, channels, H, W)
-                # You may have saved input size somewhere; else keep default 224
-                if hasattr(self.classification_model, "input_size"):
-                    ts = getattr(self.classification_model, "input_size")
-                    if isinstance(ts, (tuple, list)) and len(ts) == 2:
-                        target_h, target_w = int(ts[0]), int(ts[1])
-            except Exception:
-                pass
+        return self._classify_batch_with_model([image_path], [crop])[0]
 
-        # Resize & preprocess
-        resized = cv2.resize(rgb, (target_w, target_h), interpolation=cv2.INTER_AREA)
-        arr = (
-            resized.astype(np.float32) / 255.0
-        )  # scale to [0,1] — change if your model used mean/std
+    def _classify_batch_with_model(
+        self, paths_or_arrays: List[Union[str, np.ndarray]], crops: List[str]
+    ) -> List[Tuple[list, float]]:
+        target_h, target_w = self.classifier_engine.input_size
 
-        if use_tf:
-            batch = np.expand_dims(arr, axis=0)  # shape (1, H, W, 3)
-            preds = self.classification_model.predict(batch)
-            if isinstance(preds, (list, tuple)):
-                preds = preds[0]
-            preds = np.asarray(preds).squeeze()
-        else:
-            # PyTorch: convert to tensor, move to device, shape (1, C, H, W)
-            tensor = torch.from_numpy(arr).permute(2, 0, 1).unsqueeze(0).to(self.device)
-            self.classification_model.eval()
-            with torch.no_grad():
-                out = self.classification_model(tensor)
-                # if model returns logits, apply softmax
-                if isinstance(out, tuple) or isinstance(out, list):
-                    out = out[0]
-                preds = torch.softmax(out, dim=1).cpu().numpy()[0]
+        # Resize & preprocess into one NHWC float batch; unreadable images use the fallback
+        results = [None] * len(paths_or_arrays)
+        arrays, indices = [], []
+        for i, (image, crop) in enumerate(zip(paths_or_arrays, crops)):
+            try:
+                arrays.append(self._preprocess_for_classifier(image, target_h, target_w))
+                indices.append(i)
+            except Exception as e:
+                print(f"Error preparing image for classification: {e}")
+                results[i] = self._classify_with_fallback(crop)
+        if not arrays:
+            return results
+        batch = np.stack(arrays)
+
+        # The engine converts to its own layout (NCHW for torch) and returns probabilities
+        preds = self.classifier_engine.predict(batch)
+
+        preds = np.asarray(preds).reshape(len(batch), -1)
+        for i, row in zip(indices, preds):
+            results[i] = self._top_predictions(row, crops[i])
+        return results
+
+    def _preprocess_for_classifier(
+        self, image: Union[str, np.ndarray], target_h: int, target_w: int
+    ) -> np.ndarray:
+        bgr = load_image(image) if isinstance(image, str) else image
+
+        # Resize first so the colour conversion touches target-size pixels only
+        resized = cv2.resize(bgr, (target_w, target_h), interpolation=cv2.INTER_AREA)
+        rgb = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
+        return (
+            rgb.astype(np.float32) / 255.0
+        )  # scale to [0,1] — change if your model used mean/std
 
+    def _top_predictions(self, preds: np.ndarray, crop: str) -> Tuple[list, float]:
         # get class names and top-k
         class_names = self._get_class_names(crop)
-        if preds.ndim == 0:
+        if preds.size == 1:
             # single-value? treat as binary
-            preds = np.array([1 - preds, preds])
+            preds = np.array([1 - preds[0], preds[0]])
 
         top_indices = np.argsort(preds)[::-1][:3]
         results = []
@@ -555,6 +742,13 @@ class SegmentationService:
 
         return crop_diseases, confidence
 
+    def is_confidently_healthy(self, diseases: list, confidence: float, min_confidence: float) -> bool:
+        """True when the model's top prediction is a "Healthy" class with at least min_confidence"""
+        if self.classifier_engine is None or not diseases:
+            # The fallback database never predicts healthy leaves
+            return False
+        return diseases[0]["label"].lower().endswith("healthy") and confidence >= min_confidence
+
     def determine_severity(self, infected_percentage: float) -> str:
         if infected_percentage < 10:
             return "Mild"
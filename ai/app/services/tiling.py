@@ -0,0 +1,29 @@
+from typing import Iterator, List, Tuple
+
+# (start, end, core_start, core_end) along one axis. Tiles overlap; the cores
+# partition the axis, each boundary falling mid-way through an overlap, so every
+# pixel is decided by the tile that sees it furthest from an edge.
+Span = Tuple[int, int, int, int]
+
+
+def spans(length: int, tile: int, overlap: int) -> List[Span]:
+    """Tile positions along an axis of the given length"""
+    if length <= tile:
+        return [(0, length, 0, length)]
+    stride = max(1, tile - max(0, overlap))
+    starts = list(range(0, length - tile, stride)) + [length - tile]
+    result = []
+    for i, start in enumerate(starts):
+        end = start + tile
+        core_start = 0 if i == 0 else (result[-1][1] + start) // 2
+        core_end = length if i == len(starts) - 1 else (end + starts[i + 1]) // 2
+        result.append((start, end, core_start, core_end))
+    return result
+
+
+def grid(height: int, width: int, tile: int, overlap: int) -> Iterator[Tuple[Span, Span]]:
+    """(row span, column span) of every tile, row by row"""
+    columns = spans(width, tile, overlap)
+    for row in spans(height, tile, overlap):
+        for column in columns:
+            yield row, column
@@ -0,0 +1,279 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from sqlalchemy import or_, update
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.database import SessionLocal, generate_id
+from app.metrics import stage_timer
+from app.models import S3Upload
+
+MB = 1024 * 1024
+MAX_BACKOFF_SECONDS = 300
+
+
+def s3_enabled() -> bool:
+    return bool(settings.AWS_S3_BUCKET and settings.AWS_ACCESS_KEY_ID and settings.AWS_SECRET_ACCESS_KEY)
+
+
+def s3_url(s3_key: str) -> str:
+    bucket = settings.AWS_S3_BUCKET
+    if settings.AWS_S3_ENDPOINT_URL:
+        return f"{settings.AWS_S3_ENDPOINT_URL.rstrip('/')}/{bucket}/{s3_key}"
+    return f"https://{bucket}.s3.{settings.AWS_REGION}.amazonaws.com/{s3_key}"
+
+
+def enqueue_upload(
+    db: Session, local_path: str, s3_key: str, artifact: str, job_id: Optional[str] = None
+) -> Optional[S3Upload]:
+    """
+    Record a local artifact for background upload. The row is committed with the
+    caller's transaction, so an artifact is never queued for a job that rolled back.
+    Returns None when S3 is not configured.
+    """
+    if not s3_enabled():
+        return None
+    upload = S3Upload(
+        upload_id=f"upl_{generate_id()}",
+        job_id=job_id,
+        artifact=artifact,
+        local_path=local_path,
+        s3_key=s3_key,
+        status="pending",
+    )
+    db.add(upload)
+    return upload
+
+
+def artifact_location(db: Session, local_path: str) -> Dict[str, Optional[str]]:
+    """Where an artifact currently lives: S3 once its upload finished, otherwise this server"""
+    upload = (
+        db.query(S3Upload)
+        .filter(S3Upload.local_path == local_path)
+        .order_by(S3Upload.created_at.desc())
+        .first()
+    )
+    if upload and upload.status == "done":
+        return {"location": "s3", "s3_url": upload.s3_url, "upload_status": upload.status}
+    return {"location": "local", "s3_url": None, "upload_status": upload.status if upload else None}
+
+
+class UploadQueue:
+    """
+    Copies artifacts from the s3_uploads outbox to S3 in the background.
+
+    Analysis workers only insert outbox rows, so S3 latency never adds to job time.
+    A poller thread claims due rows and hands them to a small thread pool; boto3's
+    TransferConfig splits large files into concurrent multipart uploads. Failures
+    are retried with exponential backoff until S3_UPLOAD_MAX_ATTEMPTS. Rows left
+    uploading by a crashed or restarted process are picked up again once their
+    claim is older than S3_UPLOAD_STALE_SECONDS; rows another live process is
+    uploading are left alone.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = settings.S3_UPLOAD_CONCURRENCY,
+        max_attempts: int = settings.S3_UPLOAD_MAX_ATTEMPTS,
+        backoff_seconds: float = settings.S3_UPLOAD_BACKOFF_SECONDS,
+        poll_seconds: float = settings.S3_UPLOAD_POLL_SECONDS,
+        stale_seconds: float = settings.S3_UPLOAD_STALE_SECONDS,
+    ):
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_seconds = backoff_seconds
+        self.poll_seconds = poll_seconds
+        self.stale_seconds = stale_seconds
+        self.s3_client = None
+        self.transfer_config = None
+        self._executor = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        if not s3_enabled():
+            print("S3 not configured, upload queue disabled")
+            return
+
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+
+        self.s3_client = boto3.client(
+            "s3",
+            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+            region_name=settings.AWS_REGION,
+            endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=settings.S3_MULTIPART_THRESHOLD_MB * MB,
+            multipart_chunksize=settings.S3_MULTIPART_CHUNK_MB * MB,
+            max_concurrency=4,
+            use_threads=True,
+        )
+        self._requeue_interrupted()
+        self._stop.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="s3-upload")
+        self._thread = threading.Thread(target=self._poll, name="s3-upload-poller", daemon=True)
+        self._thread.start()
+        print(f"Upload queue started with {self.concurrency} concurrent uploads")
+
+    def shutdown(self):
+        """Stop claiming new uploads; interrupted ones are retried once they go stale"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def wake(self):
+        """Check the outbox now instead of at the next poll"""
+        self._wake.set()
+
+    def status(self) -> dict:
+        db = SessionLocal()
+        try:
+            counts = {
+                status: db.query(S3Upload).filter(S3Upload.status == status).count()
+                for status in ("pending", "uploading", "done", "failed")
+            }
+        finally:
+            db.close()
+        return {"running": self.running, "in_flight": len(self._in_flight), **counts}
+
+    def _poll(self):
+        next_requeue = time.monotonic() + self.stale_seconds
+        while not self._stop.is_set():
+            try:
+                if time.monotonic() >= next_requeue:
+                    self._requeue_interrupted()
+                    next_requeue = time.monotonic() + self.stale_seconds
+
+                with self._lock:
+                    free = self.concurrency - len(self._in_flight)
+                for upload_id, local_path, s3_key, started_at in self._claim(free):
+                    with self._lock:
+                        self._in_flight.add(upload_id)
+                    self._executor.submit(self._upload, upload_id, local_path, s3_key, started_at)
+            except Exception as e:
+                print(f"Upload queue poll failed: {e}")
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+
+    def _claim(self, limit: int) -> list:
+        if limit <= 0:
+            return []
+        db = SessionLocal()
+        try:
+            candidates = (
+                db.query(S3Upload.upload_id, S3Upload.local_path, S3Upload.s3_key)
+                .filter(S3Upload.status == "pending", S3Upload.next_attempt_at <= datetime.utcnow())
+                .order_by(S3Upload.next_attempt_at)
+                .limit(limit)
+                .all()
+            )
+            claimed = []
+            now = datetime.utcnow()
+            for upload_id, local_path, s3_key in candidates:
+                # Conditional update so two server processes never upload the same row
+                result = db.execute(
+                    update(S3Upload)
+                    .where(S3Upload.upload_id == upload_id, S3Upload.status == "pending")
+                    .values(status="uploading", started_at=now)
+                )
+                if result.rowcount == 1:
+                    claimed.append((upload_id, local_path, s3_key, now))
+            db.commit()
+            return claimed
+        finally:
+            db.close()
+
+    def _upload(self, upload_id: str, local_path: str, s3_key: str, started_at: datetime):
+        error, retry = None, True
+        try:
+            with stage_timer.time("s3_upload"):
+                self.s3_client.upload_file(local_path, settings.AWS_S3_BUCKET, s3_key, Config=self.transfer_config)
+        except FileNotFoundError as e:
+            error, retry = str(e), False
+        except Exception as e:
+            error = str(e)
+
+        db = SessionLocal()
+        try:
+            # Only the attempt that still holds the claim records its outcome
+            upload = (
+                db.query(S3Upload)
+                .filter(
+                    S3Upload.upload_id == upload_id,
+                    S3Upload.status == "uploading",
+                    S3Upload.started_at == started_at,
+                )
+                .first()
+            )
+            if upload is None:
+                return
+            upload.attempts = (upload.attempts or 0) + 1
+            if error is None:
+                upload.status = "done"
+                upload.s3_url = s3_url(s3_key)
+                upload.last_error = None
+                upload.completed_at = datetime.utcnow()
+            elif not retry or upload.attempts >= self.max_attempts:
+                upload.status = "failed"
+                upload.last_error = error
+                print(f"Upload of {local_path} failed permanently: {error}")
+            else:
+                delay = min(MAX_BACKOFF_SECONDS, self.backoff_seconds * 2 ** (upload.attempts - 1))
+                upload.status = "pending"
+                upload.last_error = error
+                upload.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+                print(f"Upload of {local_path} failed (attempt {upload.attempts}), retrying in {delay:.1f}s: {error}")
+            db.commit()
+        finally:
+            db.close()
+            with self._lock:
+                self._in_flight.discard(upload_id)
+            self._wake.set()
+
+    def _requeue_interrupted(self):
+        """Return uploads whose claim went stale (the process uploading them died) to pending"""
+        db = SessionLocal()
+        try:
+            cutoff = datetime.utcnow() - timedelta(seconds=self.stale_seconds)
+            with self._lock:
+                in_flight = list(self._in_flight)
+            count = (
+                db.query(S3Upload)
+                .filter(
+                    S3Upload.status == "uploading",
+                    # Rows claimed before started_at existed have none
+                    or_(S3Upload.started_at < cutoff, S3Upload.started_at.is_(None)),
+                    # A slow upload of our own is not stale
+                    S3Upload.upload_id.notin_(in_flight),
+                )
+                .update({S3Upload.status: "pending"}, synchronize_session=False)
+            )
+            db.commit()
+            if count:
+                print(f"Re-queued {count} interrupted uploads")
+        finally:
+            db.close()
+
+
+upload_queue = UploadQueue()
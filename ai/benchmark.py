@@ -0,0 +1,669 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for the analysis pipeline, claim PDFs and the main routes.
+
+Usage (from the ai/ directory):
+    python benchmark.py                                       # stub models, default matrix
+    python benchmark.py --models real --resolutions 1280x960  # the weights on disk
+    python benchmark.py --only segmentation,postprocess --repeat 20
+    python benchmark.py --images uploads/images --limit 5     # sample photos as well as synthetic leaves
+    python benchmark.py --compare benchmarks/base.json benchmarks/new.json --threshold 10
+
+Stub models return precomputed masks and probabilities instead of running
+FastSAM and the classifier, so their numbers are the service's own Python and
+numpy overhead. --models real loads the weights on disk (auto: real when they
+are present). Every run happens in a throwaway workspace, so the database,
+uploads/ and reports/ of this checkout are untouched. Results are written as
+JSON keyed by case name; --compare reports the median change per case and
+exits non-zero when any case regressed by more than --threshold percent.
+"""
+
+import argparse
+import contextlib
+import glob
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from app.services import inference_engines, mask_codec
+from app.services.inference_engines import ClassifierEngine
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CASE_GROUPS = ("segmentation", "classification", "postprocess", "pdf", "routes")
+# Stub masks are held at image resolution like FastSAM's retina masks; skip matrix cells above this
+DEFAULT_MASK_BUDGET_MB = 1024
+FARMER_ID = "bench_farmer"
+CROP = "tomato"
+
+# The API process must not start workers, throttle the benchmark or talk to S3
+BENCH_ENV = {
+    "INFERENCE_QUEUE_SIZE": "1000000",
+    "ANALYZE_FARMER_RATE_PER_MINUTE": "0",
+    "CHAT_FARMER_RATE_PER_MINUTE": "0",
+    "AWS_S3_BUCKET": "",
+    "OVERLAY_UPLOAD_S3": "false",
+}
+
+
+def say(message: str):
+    """Benchmark output; the service's own prints are silenced unless --verbose"""
+    print(message, file=sys.__stdout__, flush=True)
+
+
+def parse_resolution(value: str):
+    w, h = value.lower().split("x")
+    return int(w), int(h)
+
+
+def git_revision():
+    try:
+        sha = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = bool(
+            subprocess.run(
+                ["git", "status", "--porcelain", "--", "."], cwd=HERE, capture_output=True, text=True
+            ).stdout.strip()
+        )
+        return sha, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+
+
+def summarize(samples_ms: list) -> dict:
+    ordered = sorted(samples_ms)
+    return {
+        "n": len(ordered),
+        "min": ordered[0],
+        "median": statistics.median(ordered),
+        "mean": statistics.fmean(ordered),
+        "p90": ordered[max(0, int(round(0.9 * len(ordered))) - 1)],
+        "max": ordered[-1],
+        "stdev": statistics.stdev(ordered) if len(ordered) > 1 else 0.0,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Inputs
+
+
+def synthetic_leaf(width: int, height: int, seed: int) -> np.ndarray:
+    """A green leaf on soil with brown lesions; deterministic for a given seed"""
+    rng = np.random.default_rng(seed)
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:] = (40, 70, 110)  # BGR soil
+    center = (width // 2, height // 2)
+    axes = (int(width * 0.42), int(height * 0.3))
+    cv2.ellipse(image, center, axes, float(rng.uniform(-30, 30)), 0, 360, (40, 150, 60), -1)
+    for _ in range(int(rng.integers(8, 25))):
+        x = int(rng.integers(center[0] - axes[0] // 2, center[0] + axes[0] // 2))
+        y = int(rng.integers(center[1] - axes[1] // 2, center[1] + axes[1] // 2))
+        r = max(2, int(min(width, height) * rng.uniform(0.01, 0.05)))
+        cv2.ellipse(image, (x, y), (r, int(r * rng.uniform(0.6, 1.4))), 0, 0, 360, (30, 60, 120), -1)
+    noise = rng.integers(0, 12, size=image.shape, dtype=np.uint8)
+    return cv2.add(image, noise)
+
+
+def load_samples(directory: str, limit: int) -> list:
+    paths = []
+    for ext in ("jpg", "jpeg", "png", "webp"):
+        paths.extend(glob.glob(os.path.join(directory, f"*.{ext}")))
+    images = []
+    for path in sorted(paths)[:limit]:
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        if image is not None:
+            images.append(image)
+    return images
+
+
+def inputs_for(resolution, samples: list, count: int) -> list:
+    """count synthetic leaves plus every sample photo, all at resolution"""
+    width, height = resolution
+    images = [synthetic_leaf(width, height, seed) for seed in range(count)]
+    images += [cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA) for image in samples]
+    return images
+
+
+# ---------------------------------------------------------------------------
+# Stub models
+
+
+class StubMasks:
+    def __init__(self, data):
+        self.data = data
+
+
+class StubResult:
+    def __init__(self, masks):
+        self.masks = StubMasks(masks)
+
+
+class StubFastSAM:
+    """Returns precomputed masks at image resolution, like FastSAM with retina_masks=True"""
+
+    def __init__(self, num_masks: int, seed: int = 0):
+        self.num_masks = num_masks
+        self.seed = seed
+        self._masks = {}
+
+    def masks_for(self, h: int, w: int):
+        import torch
+
+        if (h, w) not in self._masks:
+            rng = np.random.default_rng(self.seed)
+            masks = torch.zeros((self.num_masks, h, w), dtype=torch.bool)
+            for i in range(self.num_masks):
+                # Areas from 0.01% to 60% of the image, so the area filter keeps some and drops some
+                area = (10 ** rng.uniform(-4, np.log10(0.6))) * h * w
+                aspect = rng.uniform(0.5, 2.0)
+                mh = int(min(h, max(1, np.sqrt(area / aspect))))
+                mw = int(min(w, max(1, area / mh)))
+                y = int(rng.integers(0, h - mh + 1))
+                x = int(rng.integers(0, w - mw + 1))
+                masks[i, y : y + mh, x : x + mw] = True
+            self._masks[(h, w)] = masks
+        return self._masks[(h, w)]
+
+    def __call__(self, images, **kwargs):
+        images = images if isinstance(images, list) else [images]
+        return [StubResult(self.masks_for(*image.shape[:2])) for image in images]
+
+
+class StubPromptScorer:
+    """Picks the first mask; CLIP itself is model time, not service overhead"""
+
+    available = True
+
+    def best_mask(self, image, masks, text_prompt):
+        return 0 if masks.shape[0] else None
+
+
+class StubClassifier(ClassifierEngine):
+    name = "stub"
+    framework = "stub"
+
+    def __init__(self, num_classes: int = 10, seed: int = 0):
+        self.num_classes = num_classes
+        self.rng = np.random.default_rng(seed)
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        logits = self.rng.normal(size=(len(batch), self.num_classes)).astype(np.float32)
+        return inference_engines._softmax(logits)
+
+
+def stub_service(num_masks: int):
+    from app.services.segmentation import SegmentationService
+
+    service = SegmentationService()
+    service.fastsam_model = StubFastSAM(num_masks)
+    service.fastsam_prompt_cls = object  # only consulted when the prompt scorer is unavailable
+    service.prompt_scorer = StubPromptScorer()
+    service.classifier_engine = StubClassifier()
+    service.model_version = "stub"
+    service._loaded = True
+    return service
+
+
+MODEL_FILES = (
+    inference_engines.KERAS_CLASSIFIER,
+    inference_engines.TORCH_CLASSIFIER,
+    inference_engines.ONNX_CLASSIFIER,
+    inference_engines.OPENVINO_CLASSIFIER,
+    inference_engines.OPENVINO_CLASSIFIER.replace(".xml", ".bin"),
+    inference_engines.CLASSIFIER_META,
+    inference_engines.TFLITE_INT8_CLASSIFIER,
+    inference_engines.TORCH_INT8_CLASSIFIER,
+    inference_engines.INT8_REPORT,
+    inference_engines.FASTSAM_WEIGHTS,
+    inference_engines.FASTSAM_ONNX,
+    inference_engines.FASTSAM_OPENVINO,
+)
+
+
+def link_model_files(workspace: str):
+    """Make the weights next to this script visible from the workspace, where the service looks for them"""
+    for name in MODEL_FILES:
+        source = os.path.join(HERE, name)
+        if os.path.exists(source):
+            os.symlink(source, os.path.join(workspace, name))
+
+
+# ---------------------------------------------------------------------------
+# Runner
+
+
+class Bench:
+    def __init__(self, repeat: int, warmup: int):
+        self.repeat = max(1, repeat)
+        self.warmup = max(0, warmup)
+        self.results = {}
+
+    def measure(self, case: str, fn, setup=None, **labels):
+        """
+        Time fn(setup()) repeat times after warmup runs; setup is not timed.
+        Stage timings recorded by the service during each run are kept per stage.
+        """
+        from app.metrics import stage_timer
+
+        samples, stages = [], defaultdict(list)
+        try:
+            for _ in range(self.warmup):
+                fn(setup() if setup else None)
+            for _ in range(self.repeat):
+                arg = setup() if setup else None
+                stage_timer.drain()
+                started = time.perf_counter()
+                fn(arg)
+                samples.append((time.perf_counter() - started) * 1000.0)
+                totals = defaultdict(float)
+                for stage, seconds in stage_timer.drain():
+                    totals[stage] += seconds * 1000.0
+                for stage, ms in totals.items():
+                    stages[stage].append(ms)
+        except Exception as e:
+            say(f"⚠️  {case} failed: {e}")
+            self.results[case] = {"error": str(e), **labels}
+            return
+
+        result = {"ms": summarize(samples), **labels}
+        if stages:
+            result["stages_ms"] = {stage: statistics.median(values) for stage, values in sorted(stages.items())}
+        self.results[case] = result
+        say(f"{case:<64} median {result['ms']['median']:9.2f} ms  p90 {result['ms']['p90']:9.2f} ms")
+
+
+def cycle(items: list):
+    state = {"i": -1}
+
+    def next_item():
+        state["i"] += 1
+        return items[state["i"] % len(items)]
+
+    return next_item
+
+
+def bench_segmentation(bench: Bench, service, images: list, labels: dict, tag: str, batch_size: int):
+    next_image = cycle(images)
+    bench.measure(
+        f"segmentation/segment_infection/{tag}",
+        lambda image: service.segment_infection(image, "bench"),
+        setup=next_image,
+        **labels,
+    )
+    bench.measure(
+        f"segmentation/segment_tiled/{tag}",
+        lambda image: service.segment_tiled(image, "bench"),
+        setup=next_image,
+        **labels,
+    )
+    batch = [(images[i % len(images)], f"bench_{i}") for i in range(batch_size)]
+    bench.measure(
+        f"segmentation/segment_batch_{batch_size}/{tag}",
+        lambda _: service.segment_batch(batch),
+        batch_size=batch_size,
+        **labels,
+    )
+
+
+def bench_postprocess(bench: Bench, service, images: list, labels: dict, tag: str):
+    h, w = images[0].shape[:2]
+    masks = service.fastsam_model(images[0])[0].masks.data if isinstance(service.fastsam_model, StubFastSAM) else None
+    if masks is None:
+        results = service.fastsam_model(images[0], imgsz=1024, conf=0.4, iou=0.9, retina_masks=True, verbose=False)
+        masks = service._mask_stack(results[0], 0)
+    if masks is None:
+        say(f"⚠️  postprocess/{tag}: no masks to post-process")
+        return
+    labels = {**labels, "masks": int(masks.shape[0])}
+    bench.measure(f"postprocess/filter_masks_by_area/{tag}", lambda _: service._filter_masks_by_area(masks), **labels)
+    bench.measure(f"postprocess/union_masks/{tag}", lambda _: service._union_masks([masks], h, w), **labels)
+    union = service._union_masks([masks], h, w)
+    encoded = mask_codec.encode(union)
+    bench.measure(f"postprocess/mask_encode/{tag}", lambda _: mask_codec.encode(union), **labels)
+    bench.measure(f"postprocess/mask_decode/{tag}", lambda _: mask_codec.decode(encoded), **labels)
+    bench.measure(f"postprocess/mask_area_bbox/{tag}", lambda _: (mask_codec.area(encoded), mask_codec.bbox(encoded)), **labels)
+    bench.measure(f"postprocess/mask_iou/{tag}", lambda _: mask_codec.iou(encoded, encoded), **labels)
+    bench.measure(f"postprocess/mask_png/{tag}", lambda _: mask_codec.to_png(encoded), **labels)
+
+
+def bench_classification(bench: Bench, service, images: list, labels: dict, tag: str, batch_size: int):
+    paths = []
+    for i, image in enumerate(images):
+        path = os.path.join("uploads", "images", f"bench_classify_{tag}_{i}.jpg")
+        cv2.imwrite(path, image)
+        paths.append(path)
+    bench.measure(
+        f"classification/classify_with_model/{tag}",
+        lambda path: service._classify_with_model(path, CROP),
+        setup=cycle(paths),
+        **labels,
+    )
+    batch = [images[i % len(images)] for i in range(batch_size)]
+    bench.measure(
+        f"classification/classify_batch_{batch_size}/{tag}",
+        lambda _: service.classify_batch(batch, [CROP] * batch_size),
+        batch_size=batch_size,
+        **labels,
+    )
+
+
+def bench_pdf(bench: Bench, service, images: list, labels: dict, tag: str):
+    from app.routers.claims import CLAIM_OVERLAY_SIZE, pdf_service
+    from app.services.overlay_service import overlay_service
+
+    image_path = os.path.join("uploads", "images", f"bench_pdf_{tag}.jpg")
+    cv2.imwrite(image_path, images[0])
+    mask_rle, infected_pct = service.segment_infection(images[0], f"bench_pdf_{tag}")
+    if mask_rle is None:
+        say(f"⚠️  pdf/{tag}: segmentation produced no mask")
+        return
+    top_diseases, confidence = service.classify_batch([images[0]], [CROP])[0]
+    overlay_path, _ = overlay_service.render(f"bench_pdf_{tag}", image_path, mask_rle, CLAIM_OVERLAY_SIZE)
+    counter = {"i": 0}
+
+    def generate(_):
+        counter["i"] += 1
+        pdf_service.generate_claim_report(
+            claim_id=f"bench_{tag}_{counter['i']}",
+            farmer_id=FARMER_ID,
+            image_path=image_path,
+            mask_path=overlay_path,
+            overlay_path=overlay_path,
+            infected_area_pct=infected_pct or 0.0,
+            severity="Medium",
+            top_diseases=top_diseases,
+            confidence=confidence * 100,
+            latitude=18.52,
+            longitude=73.85,
+            capture_ts=datetime(2024, 7, 1, 9, 30),
+            crop=CROP,
+        )
+
+    bench.measure(f"pdf/generate_claim_report/{tag}", generate, **labels)
+
+
+def bench_routes(bench: Bench, service, images: list, labels: dict, tag: str):
+    from fastapi.testclient import TestClient
+
+    from app.database import SessionLocal
+    from app.main import app
+    from app.models import Analysis
+    from app.services import inference_pool as pool_module
+
+    # Jobs run in this process with the benchmark's models instead of in pool workers
+    pool_module._segmentation_service = service
+    client = TestClient(app)
+    # A one-pixel change per upload gives every photo its own content hash, so nothing hits the analysis cache
+    seq = {"i": 0}
+
+    def fresh_jpeg():
+        seq["i"] += 1
+        image = images[seq["i"] % len(images)].copy()
+        image[0, 0] = (seq["i"] % 256, (seq["i"] // 256) % 256, 7)
+        return cv2.imencode(".jpg", image)[1].tobytes()
+
+    def upload(payload: bytes) -> str:
+        response = client.post(
+            "/upload-photo",
+            files={"file": ("leaf.jpg", payload, "image/jpeg")},
+            data={"farmer_id": FARMER_ID, "crop": CROP, "lat": "18.52", "lon": "73.85"},
+        )
+        response.raise_for_status()
+        return response.json()["image_id"]
+
+    def submit(image_id: str) -> str:
+        response = client.post("/analyze", json={"image_id": image_id, "crop": CROP})
+        response.raise_for_status()
+        return response.json()["job_id"]
+
+    def run_pending():
+        """What a pool worker does for one dispatched batch"""
+        jobs = pool_module.inference_pool.job_queue.claim(limit=1000)
+        if jobs:
+            pool_module.run_analysis_batch(jobs, pool_module.inference_pool.job_queue.owner_id)
+        return jobs
+
+    def analyzed_image() -> str:
+        image_id = upload(fresh_jpeg())
+        submit(image_id)
+        run_pending()
+        return image_id
+
+    bench.measure(f"routes/upload_photo/{tag}", upload, setup=fresh_jpeg, **labels)
+    bench.measure(f"routes/analyze_submit/{tag}", submit, setup=lambda: upload(fresh_jpeg()), **labels)
+    run_pending()  # the submitted jobs are not part of the next case
+
+    def submitted_job():
+        return submit(upload(fresh_jpeg()))
+
+    bench.measure(f"routes/analyze_run/{tag}", lambda _: run_pending(), setup=submitted_job, **labels)
+
+    image_id = analyzed_image()
+    bench.measure(f"routes/analyze_cached/{tag}", lambda _: client.post(
+        "/analyze", json={"image_id": image_id, "crop": CROP}
+    ).raise_for_status(), **labels)
+
+    db = SessionLocal()
+    try:
+        job_id = db.query(Analysis.job_id).filter(Analysis.image_id == image_id).first()[0]
+    finally:
+        db.close()
+    bench.measure(f"routes/analyze_result/{tag}", lambda _: client.get(f"/analyze/{job_id}").raise_for_status(), **labels)
+
+    def cold_overlay():
+        from app.services.overlay_service import overlay_service
+
+        for path in glob.glob(overlay_service.cache_path(image_id, 1024).replace(".png", "*")):
+            os.remove(path)
+        return image_id
+
+    bench.measure(
+        f"routes/overlay_cold/{tag}",
+        lambda i: client.get(f"/overlay/{i}", params={"size": 1024}).raise_for_status(),
+        setup=cold_overlay,
+        **labels,
+    )
+    bench.measure(
+        f"routes/overlay_warm/{tag}",
+        lambda _: client.get(f"/overlay/{image_id}", params={"size": 1024}).raise_for_status(),
+        **labels,
+    )
+    bench.measure(
+        f"routes/mask/{tag}", lambda _: client.get(f"/mask/{image_id}").raise_for_status(), **labels
+    )
+    bench.measure(
+        f"routes/download_claim/{tag}",
+        lambda _: client.post(
+            "/download-claim", json={"farmer_id": FARMER_ID, "image_id": image_id}
+        ).raise_for_status(),
+        **labels,
+    )
+
+
+# ---------------------------------------------------------------------------
+# Comparison
+
+
+def compare(base_path: str, new_path: str, threshold: float) -> int:
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    for key in ("models", "cpu_count", "platform"):
+        if base["meta"].get(key) != new["meta"].get(key):
+            print(f"⚠️  {key} differs: {base['meta'].get(key)} vs {new['meta'].get(key)}")
+
+    regressions = 0
+    print(f"{'case':<64} {'base ms':>10} {'new ms':>10} {'change':>9}")
+    for case in sorted(set(base["cases"]) & set(new["cases"])):
+        old_ms = base["cases"][case].get("ms", {}).get("median")
+        new_ms = new["cases"][case].get("ms", {}).get("median")
+        if not old_ms or new_ms is None:
+            continue
+        change = (new_ms - old_ms) / old_ms * 100.0
+        flag = ""
+        if change > threshold:
+            flag = "  ⚠️ slower"
+            regressions += 1
+        elif change < -threshold:
+            flag = "  ✅ faster"
+        print(f"{case:<64} {old_ms:10.2f} {new_ms:10.2f} {change:+8.1f}%{flag}")
+    for case in sorted(set(base["cases"]) ^ set(new["cases"])):
+        print(f"{case:<64} only in {'base' if case in base['cases'] else 'new'}")
+
+    print(f"{regressions} case(s) regressed by more than {threshold:g}%")
+    return 1 if regressions else 0
+
+
+# ---------------------------------------------------------------------------
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the analysis pipeline, claim PDFs and routes offline")
+    parser.add_argument("--models", choices=["auto", "stub", "real"], default="auto", help="model implementations")
+    parser.add_argument("--resolutions", default="640x480,1280x960,2048x1536", help="comma-separated WxH list")
+    parser.add_argument("--masks", default="5,50,200", help="comma-separated stub mask counts per image")
+    parser.add_argument("--only", help=f"comma-separated case groups: {','.join(CASE_GROUPS)}")
+    parser.add_argument("--images", help="directory of sample leaf photos, resized to every resolution")
+    parser.add_argument("--limit", type=int, default=5, help="number of sample photos")
+    parser.add_argument("--synthetic", type=int, default=3, help="synthetic leaves per resolution")
+    parser.add_argument("--batch", type=int, default=4, help="images per batched segmentation/classification")
+    parser.add_argument("--repeat", type=int, default=10, help="timed runs per case")
+    parser.add_argument("--warmup", type=int, default=2, help="untimed runs per case")
+    parser.add_argument("--mask-budget-mb", type=int, default=DEFAULT_MASK_BUDGET_MB, help="skip larger stub mask stacks")
+    parser.add_argument("--output", help="result file (default benchmarks/bench_<commit>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="compare two result files")
+    parser.add_argument("--threshold", type=float, default=10.0, help="regression threshold in percent")
+    parser.add_argument("--keep", action="store_true", help="keep the workspace for inspection")
+    parser.add_argument("--verbose", action="store_true", help="show the service's own output")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(compare(*args.compare, args.threshold))
+
+    groups = set(args.only.split(",")) if args.only else set(CASE_GROUPS)
+    unknown = groups - set(CASE_GROUPS)
+    if unknown:
+        parser.error(f"unknown case groups: {', '.join(sorted(unknown))}")
+    resolutions = [parse_resolution(r) for r in args.resolutions.split(",") if r]
+    mask_counts = [int(m) for m in args.masks.split(",") if m]
+
+    mode = args.models
+    if mode == "auto":
+        mode = "real" if os.path.exists(os.path.join(HERE, inference_engines.FASTSAM_WEIGHTS)) else "stub"
+    elif mode == "real" and not os.path.exists(os.path.join(HERE, inference_engines.FASTSAM_WEIGHTS)):
+        print(f"⚠️  {inference_engines.FASTSAM_WEIGHTS} not found, use --models stub")
+        sys.exit(1)
+
+    sha, dirty = git_revision()
+    output = args.output or os.path.join(
+        HERE, "benchmarks", f"bench_{sha or 'nogit'}{'-dirty' if dirty else ''}_{mode}.json"
+    )
+    output = os.path.abspath(output)
+    samples = load_samples(os.path.abspath(args.images), args.limit) if args.images else []
+    if args.images and not samples:
+        print(f"⚠️  No images found in {args.images}")
+
+    # Settings are read at import, and the service writes relative to the working directory
+    os.environ.update(BENCH_ENV)
+    workspace = tempfile.mkdtemp(prefix="khetlink-bench-")
+    os.makedirs(os.path.join(workspace, "storage"))
+    os.chdir(workspace)
+    link_model_files(workspace)
+
+    import torch
+
+    from app.database import engine
+    from app.metrics import stage_timer
+    from app.models import Base
+
+    Base.metadata.create_all(bind=engine)
+    # Keep stage timings for the results instead of the Prometheus histograms
+    stage_timer.buffered = True
+
+    bench = Bench(args.repeat, args.warmup)
+    real_service = None
+    if mode == "real":
+        from app.services.segmentation import SegmentationService
+
+        real_service = SegmentationService()
+        started = time.perf_counter()
+        real_service.warm_up()
+        say(f"Models loaded in {time.perf_counter() - started:.1f}s: {real_service.load_times}")
+
+    say(f"Benchmarking with {mode} models in {workspace}")
+    # The service prints per request; keep only the benchmark's own lines unless asked
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    try:
+        with quiet:
+            for resolution in resolutions:
+                images = inputs_for(resolution, samples, args.synthetic)
+                res = f"{resolution[0]}x{resolution[1]}"
+                # Real models decide their own mask count; stubs sweep it
+                cells = [None] if mode == "real" else mask_counts
+                ran_per_resolution = False
+                for num_masks in cells:
+                    if num_masks is not None:
+                        mask_mb = num_masks * resolution[0] * resolution[1] / (1024 * 1024)
+                        if mask_mb > args.mask_budget_mb:
+                            say(f"⚠️  Skipping {res} with {num_masks} masks ({mask_mb:.0f} MB of masks)")
+                            continue
+                    service = real_service or stub_service(num_masks)
+                    tag = res if num_masks is None else f"{res}/m{num_masks}"
+                    labels = {"resolution": res, "inputs": len(images)}
+                    if num_masks is not None:
+                        labels["masks"] = num_masks
+
+                    if "segmentation" in groups:
+                        bench_segmentation(bench, service, images, labels, tag, args.batch)
+                    if "postprocess" in groups:
+                        bench_postprocess(bench, service, images, labels, tag)
+                    # Neither depends on the mask count, so they run once per resolution
+                    if "classification" in groups and not ran_per_resolution:
+                        bench_classification(bench, service, images, labels, res, args.batch)
+                    if "pdf" in groups and not ran_per_resolution:
+                        bench_pdf(bench, service, images, labels, res)
+                    ran_per_resolution = True
+                    if "routes" in groups:
+                        bench_routes(bench, service, images, labels, tag)
+    finally:
+        os.chdir(HERE)
+        if not args.keep:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "commit": sha,
+            "dirty": dirty,
+            "created_at": datetime.utcnow().isoformat() + "Z",
+            "models": mode,
+            "model_version": real_service.model_version if real_service else "stub",
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "torch": torch.__version__,
+            "torch_threads": torch.get_num_threads(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("compare", "keep", "verbose")},
+        },
+        "cases": bench.results,
+    }
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"✅ {len(bench.results)} cases written to {output}")
+
+
+if __name__ == "__main__":
+    main()
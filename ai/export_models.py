@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Export FastSAM-x and the disease classifier for CPU runtimes, and check them.
+
+Usage (from the ai/ directory):
+    python export_models.py --format onnx                 # writes FastSAM-x.onnx, plant_disease_model.onnx
+    python export_models.py --format openvino             # writes FastSAM-x_openvino_model/, plant_disease_model.xml
+    python export_models.py --check onnxruntime           # latency + output parity vs the torch path
+    python export_models.py --check openvino --images uploads/images --limit 20
+
+Then select the runtime per model with FASTSAM_ENGINE / CLASSIFIER_ENGINE.
+"""
+
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from app.services.inference_engines import (
+    CLASSIFIER_META,
+    FASTSAM_WEIGHTS,
+    ONNX_CLASSIFIER,
+    OPENVINO_CLASSIFIER,
+    classifier_path,
+    fastsam_path,
+    load_classifier_engine,
+)
+
+FASTSAM_IMGSZ = 1024
+ONNX_OPSET = 17
+
+
+def export_fastsam(fmt: str):
+    from ultralytics import FastSAM
+
+    # dynamic batch so micro-batched jobs still run as a single forward pass
+    path = FastSAM(FASTSAM_WEIGHTS).export(format=fmt, imgsz=FASTSAM_IMGSZ, dynamic=True)
+    print(f"✅ FastSAM exported to {path}")
+
+
+def export_classifier_onnx():
+    native = load_classifier_engine("torch")
+    if native is None:
+        print("⚠️  No classifier found, skipping")
+        return
+
+    h, w = native.input_size
+    if native.framework == "tensorflow":
+        import tensorflow as tf
+        import tf2onnx
+
+        spec = [tf.TensorSpec((None, h, w, 3), tf.float32, name="input")]
+        tf2onnx.convert.from_keras(native.model, input_signature=spec, opset=ONNX_OPSET, output_path=ONNX_CLASSIFIER)
+        meta = {"source": "keras", "layout": "NHWC", "input_size": [h, w]}
+    else:
+        import torch
+
+        dummy = torch.zeros(1, 3, h, w)
+        torch.onnx.export(
+            native.model,
+            dummy,
+            ONNX_CLASSIFIER,
+            input_names=["input"],
+            output_names=["output"],
+            dynamic_axes={"input": {0: "batch"}, "output": {0: "batch"}},
+            opset_version=ONNX_OPSET,
+        )
+        meta = {"source": "torch", "layout": "NCHW", "input_size": [h, w]}
+
+    with open(CLASSIFIER_META, "w") as f:
+        json.dump(meta, f, indent=2)
+    print(f"✅ Classifier exported to {ONNX_CLASSIFIER}")
+
+
+def export_classifier_openvino():
+    import openvino as ov
+
+    if not os.path.exists(ONNX_CLASSIFIER):
+        export_classifier_onnx()
+    if not os.path.exists(ONNX_CLASSIFIER):
+        return
+    ov.save_model(ov.convert_model(ONNX_CLASSIFIER), OPENVINO_CLASSIFIER)
+    print(f"✅ Classifier exported to {OPENVINO_CLASSIFIER}")
+
+
+def load_samples(image_dir: str, limit: int) -> list:
+    paths = sorted(
+        p for p in glob.glob(os.path.join(image_dir, "*"))
+        if os.path.splitext(p)[1].lower() in (".jpg", ".jpeg", ".png", ".bmp")
+    )[:limit]
+    images = [img for img in (cv2.imread(p) for p in paths) if img is not None]
+    if not images:
+        print(f"No images in {image_dir}, using random noise samples")
+        rng = np.random.default_rng(0)
+        images = [rng.integers(0, 255, (768, 1024, 3), dtype=np.uint8) for _ in range(limit)]
+    return images
+
+
+def _timed(fn, *args):
+    started = time.perf_counter()
+    out = fn(*args)
+    return out, (time.perf_counter() - started) * 1000.0
+
+
+def check_classifier(engine: str, images: list) -> dict:
+    native = load_classifier_engine("torch")
+    exported = load_classifier_engine(engine)
+    if native is None or exported is None or exported.framework == native.framework:
+        return {"skipped": f"no native or exported classifier for {engine}"}
+
+    h, w = native.input_size
+    max_diff, agree = 0.0, 0
+    native_ms, exported_ms = [], []
+    for image in images:
+        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        batch = (cv2.resize(rgb, (w, h), interpolation=cv2.INTER_AREA).astype(np.float32) / 255.0)[None]
+        ref, t_ref = _timed(native.predict, batch)
+        out, t_out = _timed(exported.predict, batch)
+        native_ms.append(t_ref)
+        exported_ms.append(t_out)
+        max_diff = max(max_diff, float(np.abs(np.asarray(ref) - np.asarray(out)).max()))
+        agree += int(np.argmax(ref) == np.argmax(out))
+
+    return {
+        "native": classifier_path("torch"),
+        "exported": classifier_path(engine),
+        "max_abs_diff": max_diff,
+        "top1_agreement": agree / len(images),
+        "native_ms_median": statistics.median(native_ms),
+        "exported_ms_median": statistics.median(exported_ms),
+    }
+
+
+def check_fastsam(engine: str, images: list) -> dict:
+    from ultralytics import FastSAM
+
+    exported_path = fastsam_path(engine)
+    if exported_path == FASTSAM_WEIGHTS:
+        return {"skipped": f"no exported FastSAM for {engine}"}
+
+    models = {"native": FastSAM(FASTSAM_WEIGHTS), "exported": FastSAM(exported_path)}
+    timings = {name: [] for name in models}
+    ious = []
+    for image in images:
+        unions = {}
+        for name, model in models.items():
+            results, ms = _timed(
+                lambda: model(image, imgsz=FASTSAM_IMGSZ, conf=0.4, iou=0.9, retina_masks=True, verbose=False)
+            )
+            timings[name].append(ms)
+            masks = results[0].masks
+            unions[name] = (
+                masks.data.bool().any(dim=0).cpu().numpy()
+                if masks is not None and len(masks.data)
+                else np.zeros(image.shape[:2], dtype=bool)
+            )
+        union = np.logical_or(unions["native"], unions["exported"]).sum()
+        inter = np.logical_and(unions["native"], unions["exported"]).sum()
+        ious.append(1.0 if union == 0 else inter / union)
+
+    return {
+        "native": FASTSAM_WEIGHTS,
+        "exported": exported_path,
+        "mask_union_iou_mean": float(np.mean(ious)),
+        "mask_union_iou_min": float(np.min(ious)),
+        "native_ms_median": statistics.median(timings["native"]),
+        "exported_ms_median": statistics.median(timings["exported"]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export and verify CPU inference engines")
+    parser.add_argument("--format", choices=["onnx", "openvino"], help="export both models to this format")
+    parser.add_argument("--check", choices=["onnxruntime", "openvino"], help="compare an engine against torch")
+    parser.add_argument("--only", choices=["fastsam", "classifier"], help="restrict to one model")
+    parser.add_argument("--images", default="uploads/images", help="sample images for --check")
+    parser.add_argument("--limit", type=int, default=10, help="number of sample images for --check")
+    args = parser.parse_args()
+
+    if not args.format and not args.check:
+        parser.print_help()
+        sys.exit(1)
+
+    if args.format:
+        if args.only != "classifier":
+            export_fastsam(args.format)
+        if args.only != "fastsam":
+            if args.format == "onnx":
+                export_classifier_onnx()
+            else:
+                export_classifier_openvino()
+
+    if args.check:
+        images = load_samples(args.images, args.limit)
+        report = {}
+        if args.only != "fastsam":
+            report["classifier"] = check_classifier(args.check, images)
+        if args.only != "classifier":
+            report["fastsam"] = check_fastsam(args.check, images)
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
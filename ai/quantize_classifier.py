@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Build an INT8 disease classifier and validate it against FP32 before rollout.
+
+Usage (from the ai/ directory):
+    python quantize_classifier.py --build      # calibrate on uploads/images, write the INT8 model
+    python quantize_classifier.py --compare    # top-3 comparison on held-out images, write the report
+    python quantize_classifier.py --build --compare --calibration 200 --holdout 300
+
+Keras .h5 models become a TFLite model (plant_disease_model_int8.tflite) with
+full-integer weights and activations. Torch .pt models are statically quantized
+with FX graph mode (falling back to dynamic quantization of Linear layers) and
+saved as TorchScript (plant_disease_model_int8.pt).
+
+The service only serves the INT8 model when CLASSIFIER_INT8=true and the report
+written by --compare matches the file and meets INT8_MIN_TOP1_AGREEMENT and
+INT8_MIN_TOP3_OVERLAP.
+"""
+
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from app.config import settings
+from app.services.inference_engines import (
+    INT8_REPORT,
+    TFLITE_INT8_CLASSIFIER,
+    TORCH_INT8_CLASSIFIER,
+    classifier_path,
+    file_sha256,
+    load_classifier_engine,
+    load_int8_classifier,
+)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+def split_images(image_dir: str, calibration: int, holdout: int):
+    """Deterministic split: the first images calibrate, the next ones are held out for comparison"""
+    paths = sorted(
+        p for p in glob.glob(os.path.join(image_dir, "*"))
+        if os.path.splitext(p)[1].lower() in IMAGE_EXTENSIONS
+    )
+    return paths[:calibration], paths[calibration:calibration + holdout]
+
+
+def preprocess(path: str, input_size) -> np.ndarray:
+    """Same preprocessing as SegmentationService._preprocess_for_classifier"""
+    bgr = cv2.imread(path)
+    if bgr is None:
+        return None
+    h, w = input_size
+    rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+    return cv2.resize(rgb, (w, h), interpolation=cv2.INTER_AREA).astype(np.float32) / 255.0
+
+
+def load_batch(paths, input_size) -> list:
+    arrays = [preprocess(p, input_size) for p in paths]
+    return [a for a in arrays if a is not None]
+
+
+def build_tflite(native, calibration: list) -> str:
+    import tensorflow as tf
+
+    def representative_dataset():
+        for array in calibration:
+            yield [array[None]]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(native.model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    # Float input/output keep preprocessing identical; everything inside runs in INT8
+    with open(TFLITE_INT8_CLASSIFIER, "wb") as f:
+        f.write(converter.convert())
+    return TFLITE_INT8_CLASSIFIER
+
+
+def build_torch(native, calibration: list) -> str:
+    import torch
+
+    h, w = native.input_size
+    example = torch.zeros(1, 3, h, w)
+    model = native.model.cpu().eval()
+    backend = "x86" if "x86" in torch.backends.quantized.supported_engines else "fbgemm"
+    torch.backends.quantized.engine = backend
+
+    try:
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+        prepared = prepare_fx(model, get_default_qconfig_mapping(backend), example_inputs=(example,))
+        with torch.no_grad():
+            for array in calibration:
+                prepared(torch.from_numpy(array).permute(2, 0, 1)[None])
+        quantized = convert_fx(prepared)
+        print("Static INT8 quantization (FX graph mode)")
+    except Exception as e:
+        print(f"Static quantization failed ({e}), using dynamic quantization of Linear layers")
+        quantized = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    with torch.no_grad():
+        torch.jit.save(torch.jit.trace(quantized, example), TORCH_INT8_CLASSIFIER)
+    return TORCH_INT8_CLASSIFIER
+
+
+def build(native, calibration_paths: list) -> str:
+    calibration = load_batch(calibration_paths, native.input_size)
+    if not calibration:
+        print("⚠️  No calibration images found; add uploads or pass --images")
+        sys.exit(1)
+    print(f"Calibrating on {len(calibration)} images")
+
+    if native.framework == "tensorflow":
+        path = build_tflite(native, calibration)
+    else:
+        path = build_torch(native, calibration)
+    print(f"✅ INT8 classifier written to {path}")
+    return path
+
+
+def compare(native, holdout_paths: list) -> dict:
+    int8_path = TFLITE_INT8_CLASSIFIER if native.framework == "tensorflow" else TORCH_INT8_CLASSIFIER
+    if not os.path.exists(int8_path):
+        print(f"⚠️  {int8_path} not found, run with --build first")
+        sys.exit(1)
+
+    # TorchScript drops custom attributes, so the input size travels in the report
+    with open(INT8_REPORT, "w") as f:
+        json.dump({"input_size": list(native.input_size)}, f)
+    quantized = load_int8_classifier(int8_path)
+
+    holdout = load_batch(holdout_paths, native.input_size)
+    if not holdout:
+        print("⚠️  No held-out images found; add uploads or pass --images")
+        sys.exit(1)
+
+    top1, top3_overlap, fp32_top1_in_top3 = [], [], []
+    fp32_ms, int8_ms = [], []
+    for array in holdout:
+        batch = array[None]
+        started = time.perf_counter()
+        ref = np.asarray(native.predict(batch)).reshape(-1)
+        fp32_ms.append((time.perf_counter() - started) * 1000.0)
+        started = time.perf_counter()
+        out = np.asarray(quantized.predict(batch)).reshape(-1)
+        int8_ms.append((time.perf_counter() - started) * 1000.0)
+
+        ref_top3 = list(np.argsort(ref)[::-1][:3])
+        out_top3 = list(np.argsort(out)[::-1][:3])
+        top1.append(ref_top3[0] == out_top3[0])
+        top3_overlap.append(len(set(ref_top3) & set(out_top3)) / len(ref_top3))
+        fp32_top1_in_top3.append(ref_top3[0] in out_top3)
+
+    report = {
+        "artifact": int8_path,
+        "artifact_sha256": file_sha256(int8_path),
+        "fp32_model": classifier_path("torch"),
+        "input_size": list(native.input_size),
+        "holdout_images": len(holdout),
+        "top1_agreement": float(np.mean(top1)),
+        "top3_overlap": float(np.mean(top3_overlap)),
+        "fp32_top1_in_int8_top3": float(np.mean(fp32_top1_in_top3)),
+        "fp32_ms_median": statistics.median(fp32_ms),
+        "int8_ms_median": statistics.median(int8_ms),
+        "fp32_size_bytes": os.path.getsize(classifier_path("torch")),
+        "int8_size_bytes": os.path.getsize(int8_path),
+        "min_top1_agreement": settings.INT8_MIN_TOP1_AGREEMENT,
+        "min_top3_overlap": settings.INT8_MIN_TOP3_OVERLAP,
+        "created_at": datetime.utcnow().isoformat(),
+    }
+    report["passed"] = (
+        report["top1_agreement"] >= settings.INT8_MIN_TOP1_AGREEMENT
+        and report["top3_overlap"] >= settings.INT8_MIN_TOP3_OVERLAP
+    )
+    with open(INT8_REPORT, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize the disease classifier to INT8")
+    parser.add_argument("--build", action="store_true", help="build the INT8 model from calibration images")
+    parser.add_argument("--compare", action="store_true", help="compare INT8 against FP32 on held-out images")
+    parser.add_argument("--images", default=settings.UPLOAD_DIR, help="directory of uploaded leaf photos")
+    parser.add_argument("--calibration", type=int, default=100, help="number of calibration images")
+    parser.add_argument("--holdout", type=int, default=200, help="number of held-out comparison images")
+    args = parser.parse_args()
+
+    if not args.build and not args.compare:
+        parser.print_help()
+        sys.exit(1)
+
+    native = load_classifier_engine("torch")
+    if native is None:
+        print("⚠️  No plant_disease_model.h5 or plant_disease_model.pt found")
+        sys.exit(1)
+
+    calibration_paths, holdout_paths = split_images(args.images, args.calibration, args.holdout)
+    if args.build:
+        build(native, calibration_paths)
+    if args.compare:
+        report = compare(native, holdout_paths)
+        print(json.dumps(report, indent=2))
+        print("✅ INT8 model passed, set CLASSIFIER_INT8=true to serve it" if report["passed"]
+              else "⚠️  INT8 model below thresholds, it will not be served")
+
+
+if __name__ == "__main__":
+    main()